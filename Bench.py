@@ -0,0 +1,411 @@
+"""
+This file is part of nand2tetris, as taught in The Hebrew University, and
+was written by Aviv Yaish. It is an extension to the specifications given
+[here](https://www.nand2tetris.org) (Shimon Schocken and Noam Nisan, 2017),
+as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
+Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
+
+Benchmarks of the translator. Usage:
+
+    python Bench.py parser [--commands N] [--repeat R]
+    python Bench.py writer [--commands N] [--repeat R]
+    python Bench.py programs PATH [PATH ...] [translator options]
+        [--max-cycles N] [--set ADDRESS=VALUE ...] [--baseline]
+    python Bench.py interpret PATH [PATH ...] [--max-steps N]
+        [--set ADDRESS=VALUE ...] [--top K]
+"""
+import argparse
+import io
+import os
+import random
+import tempfile
+import time
+import typing
+from Parser import Parser
+from CodeWriter import CodeWriter
+from HackAssembler import HackAssembler
+from HackEmulator import HackEmulator
+from VMInterpreter import VMInterpreter
+import Main
+import WholeProgram
+
+
+class NullWriter:
+    """Accepts the calls of a CodeWriter and discards them, so that only the
+    cost of parsing and dispatching is measured."""
+
+    def write_arithmetic(self, command: str) -> None:
+        pass
+
+    def write_push_pop(self, command: str, segment: str, index: int) -> None:
+        pass
+
+    def write_label(self, label: str) -> None:
+        pass
+
+    def write_goto(self, label: str) -> None:
+        pass
+
+    def write_if(self, label: str) -> None:
+        pass
+
+    def write_function(self, function_name: str, n_vars: int) -> None:
+        pass
+
+    def write_return(self) -> None:
+        pass
+
+    def write_call(self, function_name: str, n_args: int) -> None:
+        pass
+
+    def write_command(self, command: typing.Any) -> None:
+        pass
+
+
+class NullStream:
+    """A text stream that discards everything written to it."""
+
+    def write(self, text: str) -> int:
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+
+def synthetic_program(n_commands: int, seed: int = 0) -> str:
+    """Generates a VM program with a mix of commands similar to compiled Jack
+    code, including comments and blank lines.
+
+    Args:
+        n_commands (int): the number of commands to generate.
+        seed (int): the seed of the random generator.
+
+    Returns:
+        str: the program text.
+    """
+    generator = random.Random(seed)
+    segments = ("local", "argument", "this", "that", "static", "temp",
+                "pointer")
+    arithmetics = ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not")
+    lines = []
+    function_counter = 0
+    label_counter = 0
+    while len(lines) < n_commands:
+        kind = generator.random()
+        if kind < 0.02 or not lines:
+            lines.append("function Bench.f" + str(function_counter) + " " +
+                         str(generator.randint(0, 4)))
+            function_counter += 1
+        elif kind < 0.35:
+            lines.append("push constant " + str(generator.randint(0, 999)))
+        elif kind < 0.55:
+            segment = generator.choice(segments)
+            lines.append("push " + segment + " " +
+                         str(generator.randint(0, 1 if segment == "pointer"
+                                               else 7)))
+        elif kind < 0.7:
+            segment = generator.choice(segments)
+            lines.append("pop " + segment + " " +
+                         str(generator.randint(0, 1 if segment == "pointer"
+                                               else 7)))
+        elif kind < 0.85:
+            lines.append(generator.choice(arithmetics))
+        elif kind < 0.88:
+            lines.append("label L" + str(label_counter))
+            label_counter += 1
+        elif kind < 0.91:
+            lines.append("if-goto L" + str(label_counter))
+        elif kind < 0.93:
+            lines.append("goto L" + str(label_counter))
+        elif kind < 0.97:
+            lines.append("call Bench.f" + str(generator.randint(
+                0, function_counter)) + " " + str(generator.randint(0, 3)))
+        else:
+            lines.append("return")
+        if generator.random() < 0.05:
+            lines.append("   // a comment line")
+            lines.append("")
+    return "\n".join(lines) + "\n"
+
+
+def legacy_loop(parser: Parser, code_writer: typing.Any) -> int:
+    """Drives a writer through the accessor API of the Parser, the way
+    Main.translate_file did before the command IR.
+
+    Returns:
+        int: the number of commands.
+    """
+    count = 0
+    while parser.has_more_commands():
+        parser.advance()
+        count += 1
+        if parser.command_type() == "C_ARITHMETIC":
+            code_writer.write_arithmetic(parser.arg1())
+        elif parser.command_type() == "C_PUSH":
+            code_writer.write_push_pop("C_PUSH", parser.arg1(), parser.arg2())
+        elif parser.command_type() == "C_POP":
+            code_writer.write_push_pop("C_POP", parser.arg1(), parser.arg2())
+        elif parser.command_type() == "C_LABEL":
+            code_writer.write_label(parser.arg1())
+        elif parser.command_type() == "C_GOTO":
+            code_writer.write_goto(parser.arg1())
+        elif parser.command_type() == "C_IF":
+            code_writer.write_if(parser.arg1())
+        elif parser.command_type() == "C_FUNCTION":
+            code_writer.write_function(parser.arg1(), parser.arg2())
+        elif parser.command_type() == "C_RETURN":
+            code_writer.write_return()
+        elif parser.command_type() == "C_CALL":
+            code_writer.write_call(parser.arg1(), parser.arg2())
+    return count
+
+
+def ir_loop(parser: Parser, code_writer: typing.Any) -> int:
+    """Drives a writer through Parser.commands() and write_command.
+
+    Returns:
+        int: the number of commands.
+    """
+    count = 0
+    for command in parser.commands():
+        code_writer.write_command(command)
+        count += 1
+    return count
+
+
+def measure(loop: typing.Callable[[Parser, typing.Any], int], program: str,
+            with_code_writer: bool, repeat: int) -> float:
+    """Runs a translation loop over a program.
+
+    Returns:
+        float: the best throughput over the repetitions, in commands/second.
+    """
+    best = 0.0
+    for _ in range(repeat):
+        parser = Parser(io.StringIO(program))
+        if with_code_writer:
+            code_writer = CodeWriter(NullStream())
+            code_writer.set_file_name("Bench.vm")
+        else:
+            code_writer = NullWriter()
+        start = time.perf_counter()
+        count = loop(parser, code_writer)
+        if with_code_writer:
+            code_writer.flush()
+        elapsed = time.perf_counter() - start
+        best = max(best, count / elapsed)
+    return best
+
+
+def bench_parser(n_commands: int, repeat: int) -> None:
+    """Compares the throughput of the accessor API and of the command IR,
+    both for parsing alone and for a full translation."""
+    program = synthetic_program(n_commands)
+    print("Parser microbenchmark: " + str(n_commands) + " commands, best of " +
+          str(repeat))
+    for with_code_writer in (False, True):
+        stage = "parse + CodeWriter" if with_code_writer else "parse only"
+        legacy = measure(legacy_loop, program, with_code_writer, repeat)
+        ir = measure(ir_loop, program, with_code_writer, repeat)
+        print("  {:<20}accessors {:>12,.0f} commands/s".format(stage, legacy))
+        print("  {:<20}command IR{:>12,.0f} commands/s ({:.2f}x)".format(
+            stage, ir, ir / legacy))
+
+
+def flushing_loop(parser: Parser, code_writer: typing.Any) -> int:
+    """Drives a writer like ir_loop, but writes the code of every command
+    to the output as soon as it is generated.
+
+    Returns:
+        int: the number of commands.
+    """
+    count = 0
+    for command in parser.commands():
+        code_writer.write_command(command)
+        code_writer.flush()
+        count += 1
+    return count
+
+
+def bench_writer(n_commands: int, repeat: int) -> None:
+    """Measures the throughput of a full translation of a multi-megabyte
+    file to a file on disk, with and without the buffering and the template
+    cache of the CodeWriter. The baseline writes the code of every command
+    as it is generated and without the cache, and every other run is
+    compared with it."""
+    program = synthetic_program(n_commands, seed=1)
+    print("Writer benchmark: " + str(n_commands) + " commands (" +
+          "{:.1f}".format(len(program) / 1e6) + " MB of VM code), best of " +
+          str(repeat))
+    baseline = None
+    for name, loop, cache_templates in (
+            ("write per command", flushing_loop, False),
+            ("template cache", flushing_loop, True),
+            ("buffered", ir_loop, False),
+            ("buffered and cached", ir_loop, True)):
+        best = None
+        for _ in range(repeat):
+            with tempfile.TemporaryFile("w") as output_file:
+                parser = Parser(io.StringIO(program))
+                code_writer = CodeWriter(
+                    output_file, cache_templates=cache_templates)
+                code_writer.set_file_name("Bench.vm")
+                start = time.perf_counter()
+                loop(parser, code_writer)
+                code_writer.flush()
+                elapsed = time.perf_counter() - start
+                size = output_file.tell()
+            best = elapsed if best is None else min(best, elapsed)
+        if baseline is None:
+            baseline = best
+        print("  {:<20}{:>8.2f} s {:>8.1f} MB/s of assembly {:>6.2f}x"
+              .format(name, best, size / 1e6 / best, baseline / best))
+
+
+def run_program(input_path: str, options: typing.Dict[str, typing.Any],
+                max_cycles: int,
+                ram_values: typing.List[typing.Tuple[int, int]]) \
+        -> typing.Dict[str, typing.Any]:
+    """Translates a program with the pipeline of Main, assembles it and runs
+    it on the emulator.
+
+    Args:
+        input_path (str): a .vm file or a directory, as given to Main.
+        options (typing.Dict[str, typing.Any]): the translator options.
+        max_cycles (int): the cycle budget of the run.
+        ram_values (typing.List[typing.Tuple[int, int]]): (address, value)
+            pairs written to RAM before the run.
+
+    Returns:
+        typing.Dict[str, typing.Any]: the ROM size, the executed cycles,
+        whether the program halted and the translation time in seconds.
+    """
+    input_paths, _ = Main.program_paths(input_path)
+    output_file = io.StringIO()
+    start = time.perf_counter()
+    Main.translate_program(input_paths, output_file, options)
+    translation_time = time.perf_counter() - start
+    rom = HackAssembler().assemble(output_file.getvalue().splitlines())
+    emulator = HackEmulator(rom)
+    for address, value in ram_values:
+        emulator.set_ram_value(address, value)
+    emulator.run(max_cycles)
+    return {"rom": len(rom), "cycles": emulator.cycles,
+            "halted": emulator.halted, "translation_time": translation_time}
+
+
+def bench_programs(input_paths: typing.List[str],
+                   options: typing.Dict[str, typing.Any], max_cycles: int,
+                   ram_values: typing.List[typing.Tuple[int, int]],
+                   baseline: bool) -> None:
+    """Prints the ROM size, executed cycles and translation time of every
+    program of a corpus, optionally next to those of the default options."""
+    print("{:<24}{:>8}{:>12}{:>12}".format(
+        "program", "ROM", "cycles", "translate"))
+    all_halted = True
+    for input_path in input_paths:
+        result = run_program(input_path, options, max_cycles, ram_values)
+        name = os.path.basename(os.path.normpath(input_path))
+        cycles = str(result["cycles"]) + ("" if result["halted"] else "+")
+        all_halted = all_halted and result["halted"]
+        print("{:<24}{:>8}{:>12}{:>10.1f}ms".format(
+            name, result["rom"], cycles, 1000 * result["translation_time"]))
+        if baseline:
+            base = run_program(input_path, {}, max_cycles, ram_values)
+            print("{:<24}{:>+7.1%}{:>+12.1%}".format(
+                "  vs. default options",
+                result["rom"] / base["rom"] - 1,
+                result["cycles"] / base["cycles"] - 1))
+    if not all_halted:
+        print("(+: still running after " + str(max_cycles) + " cycles)")
+
+
+def bench_interpreter(input_paths: typing.List[str], max_steps: int,
+                      ram_values: typing.List[typing.Tuple[int, int]],
+                      top: int) -> None:
+    """Runs every program of a corpus on the VM interpreter, and prints its
+    executed commands, the speed of the interpreter and the functions that
+    executed the most commands."""
+    for input_path in input_paths:
+        paths, _ = Main.program_paths(input_path)
+        interpreter = VMInterpreter(WholeProgram.load_program(paths), paths)
+        for address, value in ram_values:
+            interpreter.set_ram_value(address, value)
+        start = time.perf_counter()
+        interpreter.run(max_steps)
+        elapsed = time.perf_counter() - start
+        name = os.path.basename(os.path.normpath(input_path))
+        steps = str(interpreter.steps) + ("" if interpreter.halted else "+")
+        print("{}: {} commands in {:.2f} s, {:.2f} M commands/s".format(
+            name, steps, elapsed, interpreter.steps / 1e6 / elapsed))
+        print("  {:<32}{:>10}{:>12}{:>8}".format(
+            "function", "calls", "commands", "share"))
+        for function, calls, commands in interpreter.profile()[:top]:
+            print("  {:<32}{:>10}{:>12}{:>8.1%}".format(
+                function, calls, commands, commands / interpreter.steps))
+
+
+def ram_value_argument(text: str) -> typing.Tuple[int, int]:
+    """Parses an ADDRESS=VALUE command line argument."""
+    address, value = text.split("=", 1)
+    return int(address), int(value)
+
+
+if "__main__" == __name__:
+    arg_parser = argparse.ArgumentParser(
+        prog="Bench", description="Benchmarks of the VM translator.")
+    subparsers = arg_parser.add_subparsers(dest="benchmark", required=True)
+    parser_arguments = subparsers.add_parser(
+        "parser", help="commands/second of the Parser, before and after the "
+                       "command IR")
+    parser_arguments.add_argument("--commands", type=int, default=200000)
+    parser_arguments.add_argument("--repeat", type=int, default=3)
+    writer_arguments = subparsers.add_parser(
+        "writer", help="throughput of the CodeWriter on a large file, with "
+                       "and without output buffering and template caching")
+    writer_arguments.add_argument("--commands", type=int, default=400000)
+    writer_arguments.add_argument("--repeat", type=int, default=3)
+    programs_arguments = subparsers.add_parser(
+        "programs", help="ROM size, executed cycles and translation time of "
+                         "VM programs, run on the built-in CPU emulator")
+    programs_arguments.add_argument(
+        "input_paths", nargs="+", metavar="PATH",
+        help="a .vm file or a directory, as given to the translator")
+    Main.add_translator_arguments(programs_arguments)
+    programs_arguments.add_argument(
+        "--max-cycles", type=int, default=10000000, metavar="N",
+        help="stop programs that did not halt after N cycles")
+    programs_arguments.add_argument(
+        "--set", type=ram_value_argument, action="append", default=[],
+        metavar="ADDRESS=VALUE", dest="ram_values",
+        help="write VALUE to RAM[ADDRESS] before running")
+    programs_arguments.add_argument(
+        "--baseline", action="store_true",
+        help="also show the change relative to the default options")
+    interpret_arguments = subparsers.add_parser(
+        "interpret", help="run VM programs on the VM interpreter, and show "
+                          "the functions where they spend their time")
+    interpret_arguments.add_argument(
+        "input_paths", nargs="+", metavar="PATH",
+        help="a .vm file or a directory, as given to the translator")
+    interpret_arguments.add_argument(
+        "--max-steps", type=int, default=100000000, metavar="N",
+        help="stop programs that did not halt after N commands")
+    interpret_arguments.add_argument(
+        "--set", type=ram_value_argument, action="append", default=[],
+        metavar="ADDRESS=VALUE", dest="ram_values",
+        help="write VALUE to RAM[ADDRESS] before running")
+    interpret_arguments.add_argument(
+        "--top", type=int, default=10, metavar="K",
+        help="show the K functions that executed the most commands")
+    args = arg_parser.parse_args()
+    if args.benchmark == "parser":
+        bench_parser(args.commands, args.repeat)
+    elif args.benchmark == "writer":
+        bench_writer(args.commands, args.repeat)
+    elif args.benchmark == "programs":
+        bench_programs(args.input_paths, Main.translator_options(args),
+                       args.max_cycles, args.ram_values, args.baseline)
+    elif args.benchmark == "interpret":
+        bench_interpreter(args.input_paths, args.max_steps, args.ram_values,
+                          args.top)
@@ -7,16 +7,53 @@ Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
 """
 import typing
 import os
+from Parser import Command, Opcode, command_kind
+from SourceMap import MARKER
 
 class CodeWriter:
     """Translates VM commands into Hack assembly code."""
-    labels_counter = 0
 
-    def __init__(self, output_stream: typing.TextIO) -> None:
+    # The base pointers of the segments addressed through one
+    SEGMENT_POINTERS = {"local": "LCL", "argument": "ARG", "this": "THIS",
+                        "that": "THAT"}
+    # Entries up to this index are addressed by incrementing A, which keeps
+    # D intact; further entries add the index through D.
+    MAX_INCREMENTS = 3
+    # Functions with more locals clear them in a loop
+    MAX_UNROLLED_LOCALS = 8
+    # The number of buffered pieces of code written to the output at once
+    BUFFER_CHUNKS = 4096
+    # The comparisons, whose code has unique labels
+    COMPARISONS = frozenset(("eq", "gt", "lt"))
+
+    def __init__(self, output_stream: typing.TextIO,
+                 call_routines: bool = False,
+                 compact_compare: bool = False,
+                 stack_top_in_d: bool = False,
+                 collect_stats: bool = False,
+                 source_map: bool = False,
+                 cache_templates: bool = True) -> None:
         """Initializes the CodeWriter.
 
         Args:
             output_stream (typing.TextIO): output stream.
+            call_routines (bool): if True, call and return sites jump to the
+                shared "$CALL" and "$RETURN" routines emitted by write_boot
+                instead of inlining the frame save/restore code.
+            compact_compare (bool): if True, eq, gt and lt jump to the shared
+                "$EQ", "$GT" and "$LT" routines emitted by write_boot instead
+                of inlining the comparison code.
+            stack_top_in_d (bool): if True, commands given to write_command
+                may leave the top of the stack in D instead of RAM, so that
+                the next command does not reload it (see
+                flush_stack_top).
+            collect_stats (bool): if True, stats counts the commands written
+                and the instructions they generated.
+            source_map (bool): if True, the code of every command is preceded
+                by a marker of its line and function, see SourceMap.
+            cache_templates (bool): if False, the code of every command is
+                generated anew instead of being taken from the cache of
+                write_command.
         """
         # Note that you can write to output_stream like so:
         # output_stream.write("Hello world! \n")
@@ -24,6 +61,79 @@ class CodeWriter:
         self.out_file = output_stream
         self.file_name = ""
         self.current_function = ""
+        # The number of generated labels, which also makes them unique: one
+        # per comparison, call, locals loop and division by a shift
+        self.labels_counter = 0
+        self.call_routines = call_routines
+        self.compact_compare = compact_compare
+        # Instructions saved by the shared routines, net of the routines
+        self.rom_saved = 0
+        # "commands" and "functions" map every command kind (see
+        # Parser.command_kind) and every function to the number of commands
+        # written and the number of instructions they generated
+        self.stats = None
+        if collect_stats:
+            self.stats = {"commands": {}, "functions": {}}
+        self.source_map = source_map
+        # The origin of the last marker written
+        self.__origin = None
+        # Indexed by opcode, see write_command
+        self.__dispatch = [
+            lambda command: self.write_arithmetic(command.arg1),
+            lambda command: self.write_push_pop(
+                "C_PUSH", command.arg1, command.arg2),
+            lambda command: self.write_push_pop(
+                "C_POP", command.arg1, command.arg2),
+            lambda command: self.write_label(command.arg1),
+            lambda command: self.write_goto(command.arg1),
+            lambda command: self.write_if(command.arg1),
+            lambda command: self.write_function(command.arg1, command.arg2),
+            lambda command: self.write_return(),
+            lambda command: self.write_call(command.arg1, command.arg2),
+            lambda command: self.write_compare_if(command.arg3, command.arg1),
+            lambda command: self.write_inline_return(command.arg2),
+            lambda command: self.write_tail_call(command.arg1, command.arg2),
+            lambda command: self.write_arithmetic_constant(
+                command.arg1, command.arg2),
+            lambda command: self.write_move(
+                command.arg1, command.arg2, command.arg3, command.arg4),
+            lambda command: self.write_peek(),
+            lambda command: self.write_poke(),
+            lambda command: self.write_divide_shift(command.arg2),
+        ]
+        # The code written since the last flush(), in pieces
+        self.__chunks = []
+        # The code of commands that only depends on the command and the file
+        # name, see write_command
+        self.__templates = {}
+        self.__template_opcodes = frozenset((
+            Opcode.ARITHMETIC, Opcode.PUSH, Opcode.POP, Opcode.ARITH_CONST,
+            Opcode.MOVE, Opcode.PEEK, Opcode.POKE))
+        if not cache_templates:
+            self.__template_opcodes = frozenset()
+        # Whether the top of the stack is held in D, in which case SP in RAM
+        # does not count it
+        self.top_in_d = False
+        if stack_top_in_d:
+            # The code of a command then also depends on the previous ones
+            self.__template_opcodes = frozenset()
+            # Commands without a variant that uses D expect the whole stack
+            # in RAM
+            self.__dispatch = [self.__flushing(write)
+                               for write in self.__dispatch]
+            self.__dispatch[Opcode.ARITHMETIC] = \
+                lambda command: self.__write_cached_arithmetic(command.arg1)
+            self.__dispatch[Opcode.PUSH] = \
+                lambda command: self.__write_cached_push(
+                    command.arg1, command.arg2)
+            self.__dispatch[Opcode.POP] = \
+                lambda command: self.__write_cached_pop(
+                    command.arg1, command.arg2)
+            self.__dispatch[Opcode.IF] = \
+                lambda command: self.__write_cached_if(command.arg1)
+            self.__dispatch[Opcode.ARITH_CONST] = \
+                lambda command: self.__write_cached_arithmetic_constant(
+                    command.arg1, command.arg2)
 
     def set_file_name(self, filename: str) -> None:
         """Informs the code writer that the translation of a new VM file is 
@@ -44,8 +154,195 @@ class CodeWriter:
         # input_filename, input_extension = os.path.splitext(os.path.basename(input_file.name))
 
         self.file_name, _ = os.path.splitext(os.path.basename(filename))
+        # Static variables are named after the file
+        self.__templates.clear()
         # self.file_name = filename
 
+    def write_command(self, command: Command) -> None:
+        """Writes assembly code that is the translation of the given command,
+        dispatching on its opcode.
+
+        Args:
+            command (Command): a command from Parser.commands(), possibly
+                rewritten by the Optimizer.
+        """
+        key = command
+        if self.source_map:
+            function = command.arg1 if command.opcode == Opcode.FUNCTION \
+                else self.current_function
+            self.__mark_origin(command.line + 1, function or "(top level)")
+            # The line does not change the code, and must not change what is
+            # cached
+            key = command._replace(line=-1)
+        start = len(self.__chunks)
+        written_command = self.__templates.get(key)
+        if written_command is not None:
+            self.__chunks.append(written_command)
+        elif command.opcode in self.__template_opcodes and \
+                command.arg1 not in CodeWriter.COMPARISONS:
+            self.__dispatch[command.opcode](command)
+            self.__templates[key] = "".join(self.__chunks[start:])
+        else:
+            self.__dispatch[command.opcode](command)
+        if self.stats is not None:
+            self.__record(command_kind(command),
+                          self.current_function or "(top level)", start)
+        # Flushing only between commands keeps the code of a command in the
+        # buffer while it is being cached
+        if len(self.__chunks) >= CodeWriter.BUFFER_CHUNKS:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes all the buffered code to the output stream. Must be called
+        after the last command, after flush_stack_top if it applies."""
+        self.out_file.write("".join(self.__chunks))
+        self.__chunks = []
+
+    def __emit(self, code: str) -> None:
+        self.__chunks.append(code)
+
+    def __mark_origin(self, line: int, function: str) -> None:
+        origin = str(line) + " " + function
+        if origin != self.__origin:
+            self.__origin = origin
+            self.__emit(MARKER + origin + "\n")
+
+    def __record(self, kind: str, function: str, start: int) -> None:
+        # Adds the code written from the given chunk on to the statistics
+        instructions = count_instructions("".join(self.__chunks[start:]))
+        for table, key in ((self.stats["commands"], kind),
+                           (self.stats["functions"], function)):
+            entry = table.setdefault(key, {"count": 0, "instructions": 0})
+            entry["count"] += 1
+            entry["instructions"] += instructions
+
+    def flush_stack_top(self) -> None:
+        """Writes the top of the stack back to RAM if it is held in D. Must
+        be called after the last command of a file when stack_top_in_d is
+        set."""
+        start = len(self.__chunks)
+        self.__emit(self.__flush_command())
+        if self.stats is not None and self.__chunks[start]:
+            self.__record("(stack top)",
+                          self.current_function or "(top level)", start)
+
+    def __flush_command(self) -> str:
+        if not self.top_in_d:
+            return ""
+        self.top_in_d = False
+        return "@SP\n" \
+               "M=M+1\n" \
+               "A=M-1\n" \
+               "M=D\n"
+
+    def __load_command(self) -> str:
+        # Pops the top of the stack into D, unless it is already there
+        if self.top_in_d:
+            return ""
+        self.top_in_d = True
+        return "@SP\n" \
+               "AM=M-1\n" \
+               "D=M\n"
+
+    def __flushing(self, write: typing.Callable[[Command], None]) \
+            -> typing.Callable[[Command], None]:
+        def flush_and_write(command: Command) -> None:
+            self.__emit(self.__flush_command())
+            write(command)
+        return flush_and_write
+
+    def __write_cached_push(self, segment: str, index: int) -> None:
+        written_command = self.__flush_command()
+        if segment == "stack":
+            written_command += self.__write_push(segment, index)
+        else:
+            written_command += self.__load_segment(segment, index)
+            self.top_in_d = True
+        self.__emit(written_command)
+
+    def __write_cached_pop(self, segment: str, index: int) -> None:
+        if segment == "stack" or not self.top_in_d:
+            written_command = self.__flush_command() + \
+                              self.__write_pop(segment, index)
+        else:
+            prepare_command, store_command = self.__store_segment(
+                segment, index)
+            if prepare_command:
+                # Computing the address takes D
+                written_command = "@R14\n" \
+                                  "M=D\n" + \
+                                  prepare_command + \
+                                  "@R14\n" \
+                                  "D=M\n" + \
+                                  store_command
+            else:
+                written_command = store_command
+            self.top_in_d = False
+        self.__emit(written_command)
+
+    def __write_cached_arithmetic(self, command: str) -> None:
+        binary_computations = {"add": "D+M", "sub": "M-D", "and": "D&M",
+                               "or": "D|M"}
+        unary_computations = {"neg": "-D", "not": "!D", "shiftleft": "D<<",
+                              "shiftright": "D>>"}
+        if command in binary_computations:
+            written_command = self.__load_command() + \
+                              "@SP\n" \
+                              "AM=M-1\n" \
+                              "D=" + binary_computations[command] + "\n"
+        elif command in unary_computations:
+            written_command = self.__load_command() + \
+                              "D=" + unary_computations[command] + "\n"
+        else:
+            # Comparisons branch, and are left to the RAM templates
+            self.__emit(self.__flush_command())
+            self.write_arithmetic(command)
+            return
+        self.__emit(written_command)
+
+    def __write_cached_arithmetic_constant(self, command: str,
+                                           value: int) -> None:
+        if command == "add" and (value == 1 or value == -1):
+            computation = "D=D" + ("+" if value == 1 else "-") + "1\n"
+        elif command == "add" and value == -32768:
+            computation = "@32767\n" \
+                          "D=D-A\n" \
+                          "D=D-1\n"
+        elif command == "add":
+            computation = "@" + str(abs(value)) + "\n" \
+                          "D=D" + ("+" if value > 0 else "-") + "A\n"
+        elif command == "and" and value == 0 or \
+                command == "or" and value == -1:
+            computation = "D=" + str(value) + "\n"
+        elif command == "and" or command == "or":
+            operator = "&" if command == "and" else "|"
+            if value >= 0:
+                computation = "@" + str(value) + "\n" \
+                              "D=D" + operator + "A\n"
+            else:
+                computation = "@" + str(~value) + "\n" \
+                              "A=!A\n" \
+                              "D=D" + operator + "A\n"
+        else:
+            self.__emit(self.__flush_command())
+            self.write_arithmetic_constant(command, value)
+            return
+        self.__emit(self.__load_command() + computation)
+
+    def __write_cached_if(self, label: str) -> None:
+        if not self.top_in_d:
+            self.write_if(label)
+            return
+        self.top_in_d = False
+        written_command = "@" + self.current_function + "$" + label + "\n" \
+                          "D;JNE\n"
+        self.__emit(written_command)
+
+    def __label_suffix(self) -> str:
+        # Generated labels are scoped by the file name, so that the files of a
+        # program can be translated independently and then concatenated.
+        return "." + self.file_name + "." + str(self.labels_counter)
+
     def write_arithmetic(self, command: str) -> None:
         """Writes assembly code that is the translation of the given 
         arithmetic command. For the commands eq, lt, gt, you should correctly
@@ -86,151 +383,197 @@ class CodeWriter:
                               "A=M-1\n" \
                               "M=M" + arithmetic_symbols[command] + "\n"
         elif command == "eq" or command == "gt" or command == "lt":
-            written_command = \
-                            "@SP\n" \
-                            "M=M-1\n" \
-                            "A=M\n" \
-                            "D=M\n" \
-                            "@IS_POS" + str(CodeWriter.labels_counter) + "\n" \
-                            "D;JGE\n" \
-                            "@IS_NEG" + str(CodeWriter.labels_counter) + "\n" \
-                            "0;JMP\n" \
-                            "(IS_POS" + str(CodeWriter.labels_counter) + ")\n"\
-                            "@SP\n"\
-                            "A=M-1\n"\
-                            "D=M\n"\
-                            "@CHECK_ARITH" + str(CodeWriter.labels_counter) + "\n" \
-                            "D;JGE\n"\
-                            "@SP\n"\
-                            "A=M-1 \n"
-
-            if command == "eq" or command == "gt":
-                written_command += "M=0 \n"
-            if command == "lt":
-                written_command += "M=-1 \n"
-
-            written_command +=\
-                            "@END" + str(CodeWriter.labels_counter) + "\n"\
-                            "0;JMP\n"\
-                            "(IS_NEG" + str(CodeWriter.labels_counter) + ")\n"\
-                            "@SP\n"\
-                            "A=M-1\n"\
-                            "D=M\n"\
-                            "@CHECK_ARITH" + str(CodeWriter.labels_counter) + "\n"\
-                            "D;JLT\n"\
-                            "@SP\n"\
-                            "A=M-1\n"\
-
-            if command == "eq" or command == "lt":
-                written_command += "M=0\n"
-            if command == "gt":
-                written_command += "M=-1\n"
-
-            written_command += \
-                            "@END" + str(CodeWriter.labels_counter) + "\n"\
-                            "0;JMP\n"\
-                            "(CHECK_ARITH" + str(CodeWriter.labels_counter) + ")\n"\
-                            "@SP\n"\
-                            "A=M\n"\
-                            "D=M\n"\
-                            "A=A-1\n"\
-                            "D=M-D\n"\
-                            "M=-1\n"\
-                            "@END" + str(CodeWriter.labels_counter) + "\n"
-
-            if command == "eq":
-                written_command += "D;JEQ\n"
-            if command == "gt":
-                written_command += "D;JGT\n"
-            if command == "lt":
-                written_command += "D;JLT\n"
-
-            written_command += \
-                            "@SP\n"\
-                            "A=M\n"\
-                            "A=A-1\n"\
-                            "M=0\n"\
-                            "(END" + str(CodeWriter.labels_counter) + ")\n"
-
-        self.out_file.write(written_command)
-        CodeWriter.labels_counter += 1
+            if self.compact_compare:
+                # R13 = return address, the result replaces the two operands
+                return_label = "CMP_RET" + self.__label_suffix()
+                written_command = "@" + return_label + "\n" \
+                                  "D=A\n" \
+                                  "@R13\n" \
+                                  "M=D\n" \
+                                  "@$" + command.upper() + "\n" \
+                                  "0;JMP\n" \
+                                  "(" + return_label + ")\n"
+                self.rom_saved += count_instructions(
+                    self.__write_compare(command, "")) - \
+                    count_instructions(written_command)
+            else:
+                written_command = self.__write_compare(
+                    command, self.__label_suffix())
+            self.labels_counter += 1
 
-    def __write_push(self, segment: str, index: int) -> str:
-        segment_memory = {"local": "LCL", "argument": "ARG", "this": "THIS",
-                          "that": "THAT", "pointer": "THIS", "temp": "5"}
+        self.__emit(written_command)
 
-        push_command = "@SP\n" \
-                       "A=M\n" \
-                       "M=D\n" \
-                       "@SP\n" \
-                       "M=M+1\n"
+    def write_arithmetic_constant(self, command: str, value: int) -> None:
+        """Writes assembly code that is the translation of the given
+        arithmetic command, where the operand on the top of the stack is a
+        known constant and was not pushed.
 
-        if segment == "constant":
-            written_command = "@" + str(index) + "\n" \
-                              "D=A\n"
-        elif segment == "static":
-            written_command = "@" + self.file_name + "." + str(index) + "\n" \
-                              "D=M\n"
+        Args:
+            command (str): "add", "and", "or", "eq", or "gt" or "lt" with a
+                value of 0.
+            value (int): the constant operand, between -32768 and 32767.
+        """
+        arithmetic_symbols = {"add": "+", "and": "&", "or": "|",
+                              "eq": "JEQ", "gt": "JGT", "lt": "JLT"}
 
-        elif segment == "pointer":
-            if index == 0:
-                segment = "this"
-            else:
-                segment = "that"
-            written_command = "@" + segment_memory[segment] + "\n" \
+        if command == "add" and (value == 1 or value == -1):
+            written_command = "@SP\n" \
+                              "A=M-1\n" \
+                              "M=M" + ("+" if value == 1 else "-") + "1\n"
+        elif command == "and" and value == 0 or \
+                command == "or" and value == -1:
+            written_command = "@SP\n" \
+                              "A=M-1\n" \
+                              "M=" + str(value) + "\n"
+        elif command == "add" or command == "and" or command == "or":
+            written_command = self.__load_constant(value) + \
+                              "@SP\n" \
+                              "A=M-1\n" \
+                              "M=D" + arithmetic_symbols[command] + "M\n"
+        else:
+            # Comparisons to a constant cannot overflow: eq compares the
+            # difference to 0, and gt and lt only take 0.
+            end_label = "CMP_END" + self.__label_suffix()
+            written_command = "@SP\n" \
+                              "A=M-1\n" \
                               "D=M\n"
+            if value != 0:
+                if value > 0:
+                    written_command += "@" + str(value) + "\n" \
+                                       "D=D-A\n"
+                elif value == -32768:
+                    written_command += "@32767\n" \
+                                       "D=D+A\n" \
+                                       "D=D+1\n"
+                else:
+                    written_command += "@" + str(-value) + "\n" \
+                                       "D=D+A\n"
+                written_command += "@SP\n" \
+                                   "A=M-1\n"
+            written_command += "M=-1\n" \
+                               "@" + end_label + "\n" \
+                               "D;" + arithmetic_symbols[command] + "\n" \
+                               "@SP\n" \
+                               "A=M-1\n" \
+                               "M=0\n" \
+                               "(" + end_label + ")\n"
+            self.labels_counter += 1
+        self.__emit(written_command)
 
-        elif segment == "this" or segment == "that":
-            written_command = "@" + str(index) + "\n" \
-                              "D=A\n" \
-                              "@" + segment_memory[segment] + "\n" \
-                              "A=M+D\n" \
-                              "D=M\n"
+    def __load_constant(self, value: int) -> str:
+        # Sets D to any 16-bit value; A-instructions only take 0 to 32767.
+        if value >= 0:
+            return "@" + str(value) + "\n" \
+                   "D=A\n"
+        if value == -32768:
+            return "@32767\n" \
+                   "D=!A\n"
+        return "@" + str(-value) + "\n" \
+               "D=-A\n"
 
-        elif segment == "temp":
-            written_command = "@" + segment_memory[segment] + "\n" \
-                              "D=A\n" \
-                              "@" + str(index) + "\n" \
-                              "A=D+A\n" \
-                              "D=M\n"
-        else:
+    def __write_compare(self, command: str, suffix: str) -> str:
+        # Compares by the signs first, so that x - y is only computed when it
+        # cannot overflow. The labels are made unique by the given suffix.
+        written_command = \
+                        "@SP\n" \
+                        "M=M-1\n" \
+                        "A=M\n" \
+                        "D=M\n" \
+                        "@IS_POS" + suffix + "\n" \
+                        "D;JGE\n" \
+                        "@IS_NEG" + suffix + "\n" \
+                        "0;JMP\n" \
+                        "(IS_POS" + suffix + ")\n"\
+                        "@SP\n"\
+                        "A=M-1\n"\
+                        "D=M\n"\
+                        "@CHECK_ARITH" + suffix + "\n" \
+                        "D;JGE\n"\
+                        "@SP\n"\
+                        "A=M-1 \n"
+
+        if command == "eq" or command == "gt":
+            written_command += "M=0 \n"
+        if command == "lt":
+            written_command += "M=-1 \n"
+
+        written_command +=\
+                        "@END" + suffix + "\n"\
+                        "0;JMP\n"\
+                        "(IS_NEG" + suffix + ")\n"\
+                        "@SP\n"\
+                        "A=M-1\n"\
+                        "D=M\n"\
+                        "@CHECK_ARITH" + suffix + "\n"\
+                        "D;JLT\n"\
+                        "@SP\n"\
+                        "A=M-1\n"\
+
+        if command == "eq" or command == "lt":
+            written_command += "M=0\n"
+        if command == "gt":
+            written_command += "M=-1\n"
+
+        written_command += \
+                        "@END" + suffix + "\n"\
+                        "0;JMP\n"\
+                        "(CHECK_ARITH" + suffix + ")\n"\
+                        "@SP\n"\
+                        "A=M\n"\
+                        "D=M\n"\
+                        "A=A-1\n"\
+                        "D=M-D\n"\
+                        "M=-1\n"\
+                        "@END" + suffix + "\n"
+
+        if command == "eq":
+            written_command += "D;JEQ\n"
+        if command == "gt":
+            written_command += "D;JGT\n"
+        if command == "lt":
+            written_command += "D;JLT\n"
+
+        written_command += \
+                        "@SP\n"\
+                        "A=M\n"\
+                        "A=A-1\n"\
+                        "M=0\n"\
+                        "(END" + suffix + ")\n"
+        return written_command
+
+    def __write_push(self, segment: str, index: int) -> str:
+        push_command = "@SP\n" \
+                       "M=M+1\n" \
+                       "A=M-1\n" \
+                       "M=D\n"
+
+        if segment == "stack":
+            # The word "index" words below the top of the stack, used by
+            # inlined functions (see WholeProgram.inline_small_functions)
             written_command = "@" + str(index) + "\n" \
                               "D=A\n" \
-                              "@" + segment_memory[segment] + "\n" \
-                              "A=M\n" \
-                              "A=A+D\n" \
+                              "@SP\n" \
+                              "A=M-D\n" \
                               "D=M\n"
+        else:
+            # All other addresses are known at translation time, or are a
+            # base pointer plus a constant (see __segment_address)
+            written_command = self.__load_segment(segment, index)
         written_command = written_command + push_command
         return written_command
 
-    def __write_pop(self,segment: str, index: int) -> str:
-        segment_memory = {"local": "LCL", "argument": "ARG", "this": "THIS",
-                          "that": "THAT", "pointer": "THIS", "temp": "5"}
-
+    def __write_pop(self, segment: str, index: int) -> str:
         pop_command = "@SP\n" \
-                      "M=M-1\n" \
-                      "A=M\n" \
+                      "AM=M-1\n" \
                       "D=M\n"
 
-        if segment == "static":
-            written_command = pop_command + \
-                              "@" + self.file_name + "." + str(index) + "\n" \
-                              "M=D\n"
-        elif segment == "pointer":
-            if index == 0:
-                segment = "this"
-            else:
-                segment = "that"
-            written_command = "@SP\n" \
-                              "AM = M-1\n" \
-                              "D=M \n" \
-                              "@" + segment_memory[segment] + "\n" \
-                              "M=D\n"
-        elif segment == "temp":
+        if segment == "stack":
+            # The word "index" words below the top of the stack, counted
+            # before popping
             written_command = "@" + str(index) + "\n" \
                               "D=A\n" \
-                              "@" + segment_memory[segment] + "\n" \
-                              "D=A+D\n" \
+                              "@SP\n" \
+                              "D=M-D\n" \
                               "@R13\n" \
                               "M=D\n" + \
                               pop_command + \
@@ -238,18 +581,81 @@ class CodeWriter:
                               "A=M\n" \
                               "M=D\n"
         else:
-            written_command = "@" + str(index) + "\n" \
-                              "D=A\n" \
-                              "@" + segment_memory[segment] + "\n" \
-                              "D=D+M\n" \
-                              "@R13\n" \
-                              "M=D\n" + \
-                              pop_command + \
-                              "@R13\n" \
-                              "A=M\n" \
-                              "M=D\n"
+            # The address goes through R13 only for large indices
+            prepare_command, store_command = self.__store_segment(
+                segment, index)
+            written_command = prepare_command + pop_command + store_command
         return written_command
 
+    def write_move(self, source_segment: str, source_index: int,
+                   target_segment: str, target_index: int) -> None:
+        """Writes assembly code that affects a push command followed by a pop
+        command, copying the value directly without using the stack.
+
+        Args:
+            source_segment (str): the memory segment of the push.
+            source_index (int): the index in source_segment.
+            target_segment (str): the memory segment of the pop.
+            target_index (int): the index in target_segment.
+        """
+        if (source_segment, source_index) == (target_segment, target_index):
+            return
+        prepare_command, store_command = self.__store_segment(
+            target_segment, target_index)
+        written_command = prepare_command + \
+                          self.__load_segment(source_segment, source_index) + \
+                          store_command
+        self.__emit(written_command)
+
+    def __segment_address(self, segment: str, index: int) \
+            -> typing.Tuple[str, bool]:
+        # Returns code that sets A to the address of the segment entry, and
+        # whether that code changes D. Small offsets from a base pointer are
+        # added one at a time to keep D intact.
+        if segment == "static":
+            return "@" + self.file_name + "." + str(index) + "\n", False
+        if segment == "temp":
+            return "@R" + str(5 + index) + "\n", False
+        if segment == "pointer":
+            return ("@THIS\n" if index == 0 else "@THAT\n"), False
+        base = CodeWriter.SEGMENT_POINTERS[segment]
+        if index == 0:
+            return "@" + base + "\n" \
+                   "A=M\n", False
+        if index <= CodeWriter.MAX_INCREMENTS:
+            return "@" + base + "\n" \
+                   "A=M+1\n" + \
+                   "A=A+1\n" * (index - 1), False
+        return "@" + str(index) + "\n" \
+               "D=A\n" \
+               "@" + base + "\n" \
+               "A=D+M\n", True
+
+    def __load_segment(self, segment: str, index: int) -> str:
+        # Returns code that sets D to the segment entry
+        if segment == "constant":
+            return self.__load_constant(index)
+        address_command, _ = self.__segment_address(segment, index)
+        return address_command + "D=M\n"
+
+    def __store_segment(self, segment: str, index: int) \
+            -> typing.Tuple[str, str]:
+        # Returns code to run before D is set, which may use D and R13, and
+        # code that stores D to the segment entry
+        address_command, changes_d = self.__segment_address(segment, index)
+        if not changes_d:
+            return "", address_command + "M=D\n"
+        prepare_command = "@" + str(index) + "\n" \
+                          "D=A\n" \
+                          "@" + CodeWriter.SEGMENT_POINTERS[segment] + "\n" \
+                          "D=D+M\n" \
+                          "@R13\n" \
+                          "M=D\n"
+        store_command = "@R13\n" \
+                        "A=M\n" \
+                        "M=D\n"
+        return prepare_command, store_command
+
     def write_push_pop(self, command: str, segment: str, index: int) -> None:
         """Writes assembly code that is the translation of the given 
         command, where command is either C_PUSH or C_POP.
@@ -268,7 +674,7 @@ class CodeWriter:
             written_command = self.__write_push(segment, index)
         else:  # C_POP
             written_command = self.__write_pop(segment, index)
-        self.out_file.write(written_command)
+        self.__emit(written_command)
 
     def write_label(self, label: str) -> None:
         """Writes assembly code that affects the label command. 
@@ -282,7 +688,7 @@ class CodeWriter:
             label (str): the label to write.
         """
         written_command = "(" + self.current_function + "$" + label + ")\n"
-        self.out_file.write(written_command)
+        self.__emit(written_command)
 
     def write_goto(self, label: str) -> None:
         """Writes assembly code that affects the goto command.
@@ -292,7 +698,7 @@ class CodeWriter:
         """
         written_command = "@" + self.current_function + "$" + label + "\n"\
                           "0;JMP\n"
-        self.out_file.write(written_command)
+        self.__emit(written_command)
 
     def write_if(self, label: str) -> None:
         """Writes assembly code that affects the if-goto command. 
@@ -307,10 +713,71 @@ class CodeWriter:
                           "@" + self.current_function + "$" + label + "\n"\
                           "D;JNE\n"  # if D is different than 0"
 
-        self.out_file.write(written_command)
+        self.__emit(written_command)
 
-    def __restore_address(self, address: str, index: int) -> str:
-        written_command = "@frame\n" \
+    def write_compare_if(self, condition: str, label: str) -> None:
+        """Writes assembly code that affects a comparison immediately followed
+        by an if-goto: pops two values x and y and jumps to the label if
+        "x <condition> y" holds, without materializing the boolean.
+
+        Args:
+            condition (str): one of "eq", "ne", "gt", "le", "lt" and "ge".
+            label (str): the label to go to.
+        """
+        jumps = {"eq": "JEQ", "ne": "JNE", "gt": "JGT", "le": "JLE",
+                 "lt": "JLT", "ge": "JGE"}
+        target = self.current_function + "$" + label
+        written_command = "@SP\n" \
+                          "M=M-1\n" \
+                          "AM=M-1\n" \
+                          "D=M\n"
+        if condition == "eq" or condition == "ne":
+            written_command += "A=A+1\n" \
+                               "D=D-M\n" \
+                               "@" + target + "\n" \
+                               "D;" + jumps[condition] + "\n"
+            self.__emit(written_command)
+            return
+
+        # As in write_arithmetic, x - y is only computed when the signs of x
+        # and y agree, otherwise the sign of x decides.
+        suffix = self.__label_suffix()
+        if condition == "gt" or condition == "ge":
+            x_greater, x_less = target, "CMP_END" + suffix
+        else:
+            x_greater, x_less = "CMP_END" + suffix, target
+        written_command += "@CMP_XNEG" + suffix + "\n" \
+                           "D;JLT\n" \
+                           "@SP\n" \
+                           "A=M+1\n" \
+                           "D=M\n" \
+                           "@CMP_SAME" + suffix + "\n" \
+                           "D;JGE\n" \
+                           "@" + x_greater + "\n" \
+                           "0;JMP\n" \
+                           "(CMP_XNEG" + suffix + ")\n" \
+                           "@SP\n" \
+                           "A=M+1\n" \
+                           "D=M\n" \
+                           "@CMP_SAME" + suffix + "\n" \
+                           "D;JLT\n" \
+                           "@" + x_less + "\n" \
+                           "0;JMP\n" \
+                           "(CMP_SAME" + suffix + ")\n" \
+                           "@SP\n" \
+                           "A=M\n" \
+                           "D=M\n" \
+                           "A=A+1\n" \
+                           "D=D-M\n" \
+                           "@" + target + "\n" \
+                           "D;" + jumps[condition] + "\n" \
+                           "(CMP_END" + suffix + ")\n"
+        self.__emit(written_command)
+        self.labels_counter += 1
+
+    def __restore_address(self, address: str, index: int,
+                          frame: str) -> str:
+        written_command = "@" + frame + "\n" \
                           "D=M\n" \
                           "@" + str(index) + "\n" \
                           "D=D-A\n" \
@@ -349,12 +816,38 @@ class CodeWriter:
         # repeat n_vars times:  // n_vars = number of local variables
         #   push constant 0     // initializes the local variables to 0
         self.current_function = function_name
+        self.func_counter = 0
 
+        if n_vars == 0:
+            written_command = "(" + function_name + ")\n"
+        elif n_vars == 1:
+            written_command = "(" + function_name + ")\n" \
+                              "@SP\n" \
+                              "M=M+1\n" \
+                              "A=M-1\n" \
+                              "M=0\n"
+        elif n_vars <= CodeWriter.MAX_UNROLLED_LOCALS:
+            # Clears the locals in a row, then moves SP past them once
+            written_command = "(" + function_name + ")\n" \
+                              "@SP\n" \
+                              "A=M\n" \
+                              "M=0\n" + \
+                              "A=A+1\n" \
+                              "M=0\n" * (n_vars - 1) + \
+                              "D=A+1\n" \
+                              "@SP\n" \
+                              "M=D\n"
+        else:
+            written_command = self.__write_locals_loop(function_name, n_vars)
+            self.labels_counter += 1
+        self.__emit(written_command)
+
+    def __write_locals_loop(self, function_name: str, n_vars: int) -> str:
         written_command =   "(" + function_name + ")\n" \
                             "@" + str(n_vars) + "\n" \
                             "D=A\n" \
-                            "(PUSHZERO" + str(CodeWriter.labels_counter) + ")\n" \
-                            "@END" + str(CodeWriter.labels_counter) + "\n" \
+                            "(PUSHZERO" + self.__label_suffix() + ")\n" \
+                            "@END" + self.__label_suffix() + "\n" \
                             "D;JEQ\n" \
                             "@SP\n" \
                             "A=M\n" \
@@ -362,12 +855,10 @@ class CodeWriter:
                             "@SP\n" \
                             "M=M+1\n" \
                             "D=D-1\n" \
-                            "@PUSHZERO" + str(CodeWriter.labels_counter) + "\n" \
+                            "@PUSHZERO" + self.__label_suffix() + "\n" \
                             "0;JMP\n" \
-                            "(END" + str(CodeWriter.labels_counter) + ")\n"
-        self.out_file.write(written_command)
-        CodeWriter.labels_counter += 1
-        self.func_counter = 0
+                            "(END" + self.__label_suffix() + ")\n"
+        return written_command
 
     def write_call(self, function_name: str, n_args: int) -> None:
         """Writes assembly code that affects the call command. 
@@ -424,8 +915,90 @@ class CodeWriter:
                           "0;JMP\n" \
                           "(" + return_address + ")\n"
 
+        if self.call_routines:
+            # R13 = n_args, R14 = callee, D = return address
+            routine_command = "@" + str(n_args) + "\n" \
+                              "D=A\n" \
+                              "@R13\n" \
+                              "M=D\n" \
+                              "@" + function_name + "\n" \
+                              "D=A\n" \
+                              "@R14\n" \
+                              "M=D\n" \
+                              "@" + return_address + "\n" \
+                              "D=A\n" \
+                              "@$CALL\n" \
+                              "0;JMP\n" \
+                              "(" + return_address + ")\n"
+            self.rom_saved += count_instructions(written_command) - \
+                count_instructions(routine_command)
+            written_command = routine_command
+
         self.func_counter += 1
-        self.out_file.write(written_command)
+        # Counts the return address, named after the function
+        self.labels_counter += 1
+        self.__emit(written_command)
+
+    def write_tail_call(self, function_name: str, n_args: int) -> None:
+        """Writes assembly code that affects a call command followed by a
+        return command. Instead of building a new frame, the callee takes
+        over the frame of the current function, so that it returns directly
+        to the caller of the current function.
+
+        Args:
+            function_name (str): the name of the function to call.
+            n_args (int): the number of arguments of the function.
+        """
+        # The pseudo-code of "call function_name n_args; return" is:
+        # copy the 5 words of the current frame (return address, LCL, ARG,
+        #   THIS, THAT of the caller) to the top of the stack, right after
+        #   the arguments of the callee
+        # move the arguments and the frame down to ARG
+        # LCL = SP = ARG+n_args+5
+        # goto function_name
+        # R13 and R14 point to the word before the source and the destination
+        # of each copy.
+        written_command = "@LCL\n" \
+                          "D=M\n" \
+                          "@6\n" \
+                          "D=D-A\n" \
+                          "@R13\n" \
+                          "M=D\n" \
+                          "@SP\n" \
+                          "D=M-1\n" \
+                          "@R14\n" \
+                          "M=D\n" + \
+                          self.__copy_words(5) + \
+                          "@SP\n" \
+                          "D=M\n" \
+                          "@" + str(n_args + 1) + "\n" \
+                          "D=D-A\n" \
+                          "@R13\n" \
+                          "M=D\n" \
+                          "@ARG\n" \
+                          "D=M-1\n" \
+                          "@R14\n" \
+                          "M=D\n" + \
+                          self.__copy_words(n_args + 5) + \
+                          "@R14\n" \
+                          "D=M+1\n" \
+                          "@LCL\n" \
+                          "M=D\n" \
+                          "@SP\n" \
+                          "M=D\n" \
+                          "@" + function_name + "\n" \
+                          "0;JMP\n"
+        self.__emit(written_command)
+
+    def __copy_words(self, count: int) -> str:
+        # Copies count words from after the address in R13 to after the
+        # address in R14, advancing both.
+        return ("@R13\n"
+                "AM=M+1\n"
+                "D=M\n"
+                "@R14\n"
+                "AM=M+1\n"
+                "M=D\n") * count
 
     def write_return(self) -> None:
         """Writes assembly code that affects the return command."""
@@ -442,37 +1015,206 @@ class CodeWriter:
         # LCL = *(frame-4)              // restores LCL for the caller
         # goto return_address           // go to the return address
 
+        written_command = self.__return_command("frame", "return_address")
+        if self.call_routines:
+            routine_command = "@$RETURN\n" \
+                              "0;JMP\n"
+            self.rom_saved += count_instructions(written_command) - \
+                count_instructions(routine_command)
+            written_command = routine_command
+        self.__emit(written_command)
+
+    def __return_command(self, frame: str, return_address: str) -> str:
         written_command = "@LCL\n" \
                           "D=M\n" \
-                          "@frame\n" \
+                          "@" + frame + "\n" \
                           "M=D\n" \
                           "@5\n" \
                           "D=A\n" \
-                          "@frame\n" \
+                          "@" + frame + "\n" \
                           "D=M-D\n" \
                           "A=D\n" \
                           "D=M\n" \
-                          "@return_address\n" \
+                          "@" + return_address + "\n" \
                           "M=D\n" \
                           + self.__write_pop("argument", 0) + \
                           "@ARG\n" \
                           "D=M+1\n" \
                           "@SP\n" \
                           "M=D\n" + \
-                          self.__restore_address("THAT", 1) + \
-                          self.__restore_address("THIS", 2) + \
-                          self.__restore_address("ARG", 3) + \
-                          self.__restore_address("LCL", 4) + \
-                          "@return_address\n" \
+                          self.__restore_address("THAT", 1, frame) + \
+                          self.__restore_address("THIS", 2, frame) + \
+                          self.__restore_address("ARG", 3, frame) + \
+                          self.__restore_address("LCL", 4, frame) + \
+                          "@" + return_address + "\n" \
                           "A=M\n" \
                           "0;JMP\n"
-        self.out_file.write(written_command)
+        return written_command
+
+    def write_inline_return(self, frame_size: int) -> None:
+        """Writes assembly code that ends an inlined function: the return
+        value at the top of the stack replaces the frame of the function,
+        that is its arguments, locals and working stack.
+
+        Args:
+            frame_size (int): the number of words from the first argument to
+                the top of the stack, including the return value.
+        """
+        if frame_size == 1:
+            # The return value is already in place
+            return
+        if frame_size == 2:
+            written_command = "@SP\n" \
+                              "AM=M-1\n" \
+                              "D=M\n" \
+                              "A=A-1\n" \
+                              "M=D\n"
+        else:
+            written_command = "@SP\n" \
+                              "AM=M-1\n" \
+                              "D=M\n" \
+                              "@R13\n" \
+                              "M=D\n" \
+                              "@" + str(frame_size - 2) + "\n" \
+                              "D=A\n" \
+                              "@SP\n" \
+                              "M=M-D\n" \
+                              "@R13\n" \
+                              "D=M\n" \
+                              "@SP\n" \
+                              "A=M-1\n" \
+                              "M=D\n"
+        self.__emit(written_command)
+
+    def write_peek(self) -> None:
+        """Writes assembly code that replaces the address on the top of the
+        stack by the word of RAM at that address, which is what
+        "call Memory.peek 1" computes.
+        """
+        written_command = "@SP\n" \
+                          "A=M-1\n" \
+                          "A=M\n" \
+                          "D=M\n" \
+                          "@SP\n" \
+                          "A=M-1\n" \
+                          "M=D\n"
+        self.__emit(written_command)
+
+    def write_poke(self) -> None:
+        """Writes assembly code that pops a value and an address, stores the
+        value at the address and pushes 0, which is what
+        "call Memory.poke 2" does.
+        """
+        written_command = "@SP\n" \
+                          "AM=M-1\n" \
+                          "D=M\n" \
+                          "A=A-1\n" \
+                          "A=M\n" \
+                          "M=D\n" \
+                          "@SP\n" \
+                          "A=M-1\n" \
+                          "M=0\n"
+        self.__emit(written_command)
+
+    def write_divide_shift(self, shift: int) -> None:
+        """Writes assembly code that divides the top of the stack by a power
+        of 2, rounding toward zero like Math.divide.
+
+        Args:
+            shift (int): the exponent of the divisor, between 1 and 14.
+        """
+        # The arithmetic shift rounds down, so negative dividends are first
+        # moved up by the divisor minus 1
+        positive_label = "DIV_POSITIVE" + self.__label_suffix()
+        written_command = "@SP\n" \
+                          "A=M-1\n" \
+                          "D=M\n" \
+                          "@" + positive_label + "\n" \
+                          "D;JGE\n" \
+                          "@" + str((1 << shift) - 1) + "\n" \
+                          "D=D+A\n" \
+                          "(" + positive_label + ")\n" \
+                          "@SP\n" \
+                          "A=M-1\n" \
+                          "M=D>>\n" + \
+                          "M=M>>\n" * (shift - 1)
+        self.labels_counter += 1
+        self.__emit(written_command)
+
+    def __write_routines(self) -> str:
+        # $CALL expects D = return address, R13 = n_args, R14 = callee.
+        # $RETURN uses R14/R15 as frame/return address, since the pop of the
+        # return value spills through R13.
+        written_command = "($CALL)\n" \
+                          "@SP\n" \
+                          "M=M+1\n" \
+                          "A=M-1\n" \
+                          "M=D\n" + \
+                          self.__push_segment_to_stack("LCL") + \
+                          self.__push_segment_to_stack("ARG") + \
+                          self.__push_segment_to_stack("THIS") + \
+                          self.__push_segment_to_stack("THAT") + \
+                          "@SP\n" \
+                          "D=M\n" \
+                          "@LCL\n" \
+                          "M=D\n" \
+                          "@5\n" \
+                          "D=D-A\n" \
+                          "@R13\n" \
+                          "D=D-M\n" \
+                          "@ARG\n" \
+                          "M=D\n" \
+                          "@R14\n" \
+                          "A=M\n" \
+                          "0;JMP\n" \
+                          "($RETURN)\n" + \
+                          self.__return_command("R14", "R15")
+        return written_command
 
     def write_boot(self) -> None:
+        """Writes the bootstrap code: sets SP to 256 and calls Sys.init. The
+        shared routines requested by call_routines and compact_compare are
+        emitted right after the call, which never returns.
+        """
+        if self.source_map:
+            self.__mark_origin(0, "(bootstrap)")
+        start = len(self.__chunks)
         written_command = "@256\n" \
                           "D=A\n" \
                           "@SP\n" \
                           "M=D\n"
 
-        self.out_file.write(written_command)
+        self.__emit(written_command)
         self.write_call("Sys.init", 0)
+        written_command = ""
+        if self.call_routines:
+            written_command += self.__write_routines()
+        if self.compact_compare:
+            for command in ("eq", "gt", "lt"):
+                routine = "$" + command.upper()
+                written_command += "(" + routine + ")\n" + \
+                                   self.__write_compare(command, routine) + \
+                                   "@R13\n" \
+                                   "A=M\n" \
+                                   "0;JMP\n"
+        self.rom_saved -= count_instructions(written_command)
+        self.__emit(written_command)
+        if self.stats is not None:
+            self.__record("(bootstrap)", "(bootstrap)", start)
+
+
+def count_instructions(code: str) -> int:
+    """Counts the Hack instructions in a piece of assembly code.
+
+    Args:
+        code (str): assembly code, one instruction or label per line.
+
+    Returns:
+        int: the number of lines that are neither labels nor empty.
+    """
+    count = 0
+    for line in code.splitlines():
+        line = line.strip()
+        if line and not line.startswith("(") and not line.startswith("//"):
+            count += 1
+    return count
@@ -0,0 +1,119 @@
+"""
+This file is part of nand2tetris, as taught in The Hebrew University, and
+was written by Aviv Yaish. It is an extension to the specifications given
+[here](https://www.nand2tetris.org) (Shimon Schocken and Noam Nisan, 2017),
+as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
+Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
+"""
+import typing
+
+
+class HackAssembler:
+    """
+    # HackAssembler
+
+    Translates Hack assembly into Hack machine code, in process. It supports
+    the language of the book plus the shift extension of the course, whose
+    instructions start with "101" instead of "111":
+    "A<<", "D<<", "M<<", "A>>", "D>>" and "M>>".
+
+    Labels are resolved in a first pass over the code; symbols that are not
+    labels nor predefined are allocated as variables from address 16, in
+    order of first use.
+    """
+
+    COMP = {
+        "0": "0101010", "1": "0111111", "-1": "0111010", "D": "0001100",
+        "A": "0110000", "!D": "0001101", "!A": "0110001", "-D": "0001111",
+        "-A": "0110011", "D+1": "0011111", "A+1": "0110111",
+        "D-1": "0001110", "A-1": "0110010", "D+A": "0000010",
+        "D-A": "0010011", "A-D": "0000111", "D&A": "0000000",
+        "D|A": "0010101",
+        "M": "1110000", "!M": "1110001", "-M": "1110011", "M+1": "1110111",
+        "M-1": "1110010", "D+M": "1000010", "D-M": "1010011",
+        "M-D": "1000111", "D&M": "1000000", "D|M": "1010101",
+        # Operands of commutative operations may come in either order
+        "A+D": "0000010", "M+D": "1000010", "A&D": "0000000",
+        "M&D": "1000000", "A|D": "0010101", "M|D": "1010101",
+    }
+    SHIFT_COMP = {
+        "A<<": "0100000", "D<<": "0110000", "M<<": "1100000",
+        "A>>": "0000000", "D>>": "0010000", "M>>": "1000000",
+    }
+    JUMP = {"": 0, "JGT": 1, "JEQ": 2, "JGE": 3, "JLT": 4, "JNE": 5,
+            "JLE": 6, "JMP": 7}
+    PREDEFINED = {"SP": 0, "LCL": 1, "ARG": 2, "THIS": 3, "THAT": 4,
+                  "SCREEN": 16384, "KBD": 24576}
+    PREDEFINED.update({"R" + str(i): i for i in range(16)})
+
+    def __init__(self) -> None:
+        """Initializes the symbol table with the predefined symbols."""
+        self.symbols = dict(HackAssembler.PREDEFINED)
+        self.next_variable = 16
+
+    def assemble(self, lines: typing.Iterable[str]) -> typing.List[int]:
+        """Assembles a program.
+
+        Args:
+            lines (typing.Iterable[str]): the assembly code, one instruction
+                or label per line, possibly with whitespace and comments.
+
+        Returns:
+            typing.List[int]: the machine words, one per instruction.
+        """
+        instructions = []
+        for line in lines:
+            line = "".join(line.split("//", 1)[0].split())
+            if not line:
+                continue
+            if line.startswith("("):
+                label = line[1:-1]
+                if label in self.symbols:
+                    raise ValueError("Duplicate label: " + label)
+                self.symbols[label] = len(instructions)
+            else:
+                instructions.append(line)
+        return [self.__assemble_instruction(line) for line in instructions]
+
+    def __assemble_instruction(self, line: str) -> int:
+        if line.startswith("@"):
+            symbol = line[1:]
+            if symbol.isdigit():
+                value = int(symbol)
+            else:
+                if symbol not in self.symbols:
+                    self.symbols[symbol] = self.next_variable
+                    self.next_variable += 1
+                value = self.symbols[symbol]
+            if value > 32767:
+                raise ValueError("Address out of range: " + line)
+            return value
+
+        dest, comp, jump = "", line, ""
+        if "=" in comp:
+            dest, comp = comp.split("=", 1)
+        if ";" in comp:
+            comp, jump = comp.split(";", 1)
+        if comp in HackAssembler.SHIFT_COMP:
+            bits = "101" + HackAssembler.SHIFT_COMP[comp]
+        elif comp in HackAssembler.COMP:
+            bits = "111" + HackAssembler.COMP[comp]
+        else:
+            raise ValueError("Invalid instruction: " + line)
+        if jump not in HackAssembler.JUMP or \
+                any(register not in "AMD" for register in dest):
+            raise ValueError("Invalid instruction: " + line)
+        dest_bits = ("A" in dest) << 2 | ("D" in dest) << 1 | ("M" in dest)
+        return int(bits, 2) << 6 | dest_bits << 3 | HackAssembler.JUMP[jump]
+
+
+def to_binary(words: typing.Iterable[int]) -> str:
+    """Formats machine words as the text of a .hack file.
+
+    Args:
+        words (typing.Iterable[int]): the machine words.
+
+    Returns:
+        str: one 16-character binary string per line.
+    """
+    return "".join(format(word, "016b") + "\n" for word in words)
@@ -0,0 +1,191 @@
+"""
+This file is part of nand2tetris, as taught in The Hebrew University, and
+was written by Aviv Yaish. It is an extension to the specifications given
+[here](https://www.nand2tetris.org) (Shimon Schocken and Noam Nisan, 2017),
+as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
+Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
+"""
+import array
+import typing
+
+
+RAM_SIZE = 32768
+ROM_SIZE = 32768
+
+# Every computation takes the A, D and M registers as unsigned 16-bit values
+# and returns an unsigned 16-bit value.
+COMPUTATIONS = {
+    0b0101010: lambda a, d, m: 0,
+    0b0111111: lambda a, d, m: 1,
+    0b0111010: lambda a, d, m: 0xFFFF,
+    0b0001100: lambda a, d, m: d,
+    0b0110000: lambda a, d, m: a,
+    0b0001101: lambda a, d, m: d ^ 0xFFFF,
+    0b0110001: lambda a, d, m: a ^ 0xFFFF,
+    0b0001111: lambda a, d, m: -d & 0xFFFF,
+    0b0110011: lambda a, d, m: -a & 0xFFFF,
+    0b0011111: lambda a, d, m: (d + 1) & 0xFFFF,
+    0b0110111: lambda a, d, m: (a + 1) & 0xFFFF,
+    0b0001110: lambda a, d, m: (d - 1) & 0xFFFF,
+    0b0110010: lambda a, d, m: (a - 1) & 0xFFFF,
+    0b0000010: lambda a, d, m: (d + a) & 0xFFFF,
+    0b0010011: lambda a, d, m: (d - a) & 0xFFFF,
+    0b0000111: lambda a, d, m: (a - d) & 0xFFFF,
+    0b0000000: lambda a, d, m: d & a,
+    0b0010101: lambda a, d, m: d | a,
+    0b1110000: lambda a, d, m: m,
+    0b1110001: lambda a, d, m: m ^ 0xFFFF,
+    0b1110011: lambda a, d, m: -m & 0xFFFF,
+    0b1110111: lambda a, d, m: (m + 1) & 0xFFFF,
+    0b1110010: lambda a, d, m: (m - 1) & 0xFFFF,
+    0b1000010: lambda a, d, m: (d + m) & 0xFFFF,
+    0b1010011: lambda a, d, m: (d - m) & 0xFFFF,
+    0b1000111: lambda a, d, m: (m - d) & 0xFFFF,
+    0b1000000: lambda a, d, m: d & m,
+    0b1010101: lambda a, d, m: d | m,
+}
+
+# The computations of the shift extension, "101" instructions
+SHIFT_COMPUTATIONS = {
+    0b0100000: lambda a, d, m: (a << 1) & 0xFFFF,
+    0b0110000: lambda a, d, m: (d << 1) & 0xFFFF,
+    0b1100000: lambda a, d, m: (m << 1) & 0xFFFF,
+    0b0000000: lambda a, d, m: a >> 1 | a & 0x8000,
+    0b0010000: lambda a, d, m: d >> 1 | d & 0x8000,
+    0b1000000: lambda a, d, m: m >> 1 | m & 0x8000,
+}
+
+# Whether to jump, by jump bits, given the unsigned output of the ALU
+JUMPS = (
+    None,
+    lambda out: 0 < out < 0x8000,
+    lambda out: out == 0,
+    lambda out: out < 0x8000,
+    lambda out: out >= 0x8000,
+    lambda out: out != 0,
+    lambda out: out == 0 or out >= 0x8000,
+    lambda out: True,
+)
+
+
+class HackEmulator:
+    """
+    # HackEmulator
+
+    Runs Hack machine code, including the shift extension of the course.
+    RAM and ROM are arrays of unsigned 16-bit words; values are only read
+    as signed numbers by the jump conditions and by ram_value().
+
+    The ROM is decoded once when it is loaded: every A-instruction becomes
+    its value and every C-instruction a tuple of its computation, its
+    destination bits, its jump condition and whether it reads M, so that
+    the main loop does no bit twiddling.
+
+    A program halts when it jumps to an infinite loop of the form
+    "(LABEL) @LABEL 0;JMP", which is how compiled programs end, or when the
+    program counter leaves the ROM.
+    """
+
+    def __init__(self, rom: typing.Sequence[int]) -> None:
+        """Loads a program and resets the machine.
+
+        Args:
+            rom (typing.Sequence[int]): the machine words of the program.
+        """
+        if len(rom) > ROM_SIZE:
+            raise ValueError("Program does not fit in ROM: " + str(len(rom)) +
+                             " words")
+        self.rom = array.array("H", rom)
+        self.ram = array.array("H", bytes(2 * RAM_SIZE))
+        self.__decoded = [self.__decode(word) for word in self.rom]
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+
+    def run(self, max_cycles: int) -> int:
+        """Runs the program until it halts or exhausts its cycle budget.
+
+        Args:
+            max_cycles (int): the maximal number of instructions to execute.
+
+        Returns:
+            int: the number of instructions executed by this call.
+        """
+        decoded = self.__decoded
+        ram = self.ram
+        rom_size = len(decoded)
+        a, d, pc = self.a, self.d, self.pc
+        cycles = 0
+        halted = self.halted
+        while cycles < max_cycles and not halted:
+            if not 0 <= pc < rom_size:
+                halted = True
+                break
+            instruction = decoded[pc]
+            cycles += 1
+            if instruction.__class__ is int:
+                a = instruction
+                pc += 1
+                continue
+            computation, dest, jump, reads_m = instruction
+            out = computation(a, d, ram[a & 0x7FFF] if reads_m else 0)
+            if dest & 1:
+                ram[a & 0x7FFF] = out
+            if dest & 2:
+                d = out
+            if jump is not None and jump(out):
+                # A jump that changes nothing, to the instruction before
+                # which loads the address of the jump, is an infinite loop.
+                if not dest and a == pc - 1 and decoded[a] == a:
+                    halted = True
+                pc = a
+            else:
+                pc += 1
+            if dest & 4:
+                a = out
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += cycles
+        self.halted = halted
+        return cycles
+
+    def ram_value(self, address: int) -> int:
+        """Reads a word of RAM as a signed number.
+
+        Args:
+            address (int): the address to read.
+
+        Returns:
+            int: the value, between -32768 and 32767.
+        """
+        value = self.ram[address]
+        return value - 0x10000 if value & 0x8000 else value
+
+    def set_ram_value(self, address: int, value: int) -> None:
+        """Writes a word of RAM.
+
+        Args:
+            address (int): the address to write.
+            value (int): the value, signed or unsigned.
+        """
+        self.ram[address] = value & 0xFFFF
+
+    @staticmethod
+    def __decode(word: int) \
+            -> typing.Union[int, typing.Tuple[typing.Callable, int,
+                                              typing.Optional[typing.Callable],
+                                              bool]]:
+        if not word & 0x8000:
+            return word
+        bits = word >> 6 & 0x7F
+        if word >> 13 == 0b111:
+            computation = COMPUTATIONS.get(bits)
+        elif word >> 13 == 0b101:
+            computation = SHIFT_COMPUTATIONS.get(bits)
+        else:
+            computation = None
+        if computation is None:
+            raise ValueError("Invalid instruction: " + format(word, "016b"))
+        reads_m = bool(bits & 0b1000000)
+        return computation, word >> 3 & 7, JUMPS[word & 7], reads_m
@@ -5,61 +5,500 @@ was written by Aviv Yaish. It is an extension to the specifications given
 as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
 Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
 """
+import argparse
+import collections
+import concurrent.futures
+import io
+import json
 import os
-import sys
 import typing
-from Parser import Parser
-from CodeWriter import CodeWriter
+from Parser import Command, Parser
+from CodeWriter import CodeWriter, count_instructions
+from HackAssembler import HackAssembler, to_binary
+from Peephole import Peephole
+from SourceMap import SourceMap
+from TranslationCache import TranslationCache, translator_digest
+import Optimizer
+import WholeProgram
 
 
 def translate_file(
         input_file: typing.TextIO, output_file: typing.TextIO,
-        bootstrap: bool) -> None:
+        bootstrap: bool, call_routines: bool = False,
+        compact_compare: bool = False, fuse_branches: bool = False,
+        tail_calls: bool = False, fold_constants: bool = False,
+        fuse_moves: bool = False, stack_top_in_d: bool = False,
+        intrinsics: bool = False, thread_jumps: bool = False,
+        stats: bool = False,
+        source_map: bool = False) -> typing.Dict[str, typing.Any]:
     """Translates a single file.
 
     Args:
         input_file (typing.TextIO): the file to translate.
         output_file (typing.TextIO): writes all output to this file.
+        bootstrap (bool): whether to write the bootstrap code first.
+        call_routines (bool): use the shared call/return routines.
+        compact_compare (bool): use the shared comparison routines.
+        fuse_branches (bool): fuse comparisons with the if-goto after them.
+        tail_calls (bool): reuse the frame of the caller in calls followed
+            by return.
+        fold_constants (bool): evaluate constant expressions and specialize
+            arithmetic on a constant operand.
+        fuse_moves (bool): copy values directly in push/pop pairs.
+        stack_top_in_d (bool): keep the top of the stack in D between
+            commands.
+        intrinsics (bool): replace calls to Memory.peek, Memory.poke, and to
+            Math.multiply and Math.divide by powers of 2, by inline code.
+        thread_jumps (bool): thread chains of jumps and drop the jumps to
+            the next command, the unreachable code and the unused labels of
+            every function; the report then has "jumps_removed".
+        stats (bool): also report "stats", the commands written by kind and
+            by function with the instructions they generated (see
+            CodeWriter.stats), and "labels", the number of labels generated.
+        source_map (bool): precede the code of every command with a marker
+            of its origin, to be removed by a SourceMap.
+
+    Returns:
+        typing.Dict[str, typing.Any]: counters describing the translation, to
+        be summed over all the files of a program, except for "stats".
     """
     parser = Parser(input_file)
-    code_writer = CodeWriter(output_file)
-    code_writer.set_file_name(input_file.name)
+    return translate_commands(
+        parser.commands(source_map), input_file.name, output_file, bootstrap,
+        call_routines, compact_compare, fuse_branches, tail_calls,
+        fold_constants, fuse_moves, stack_top_in_d, intrinsics, thread_jumps,
+        stats, source_map)
+
+
+def translate_commands(
+        commands: typing.Iterable[Command], file_name: str,
+        output_file: typing.TextIO, bootstrap: bool,
+        call_routines: bool = False, compact_compare: bool = False,
+        fuse_branches: bool = False, tail_calls: bool = False,
+        fold_constants: bool = False, fuse_moves: bool = False,
+        stack_top_in_d: bool = False, intrinsics: bool = False,
+        thread_jumps: bool = False, stats: bool = False,
+        source_map: bool = False) -> typing.Dict[str, typing.Any]:
+    """Translates the commands of a single file.
+
+    Args:
+        commands (typing.Iterable[Command]): the commands to translate.
+        file_name (str): the name of the file, which names its statics.
+        Other arguments are as in translate_file.
+
+    Returns:
+        typing.Dict[str, typing.Any]: see translate_file.
+    """
+    code_writer = CodeWriter(output_file, call_routines, compact_compare,
+                             stack_top_in_d, stats, source_map)
+    code_writer.set_file_name(file_name)
 
     # In case this is the first file
     if bootstrap:
         code_writer.write_boot()
 
-    while parser.has_more_commands():
-        parser.advance()
-        if parser.command_type() == "C_ARITHMETIC":
-            code_writer.write_arithmetic(parser.arg1())
-        elif parser.command_type() == "C_PUSH":
-            code_writer.write_push_pop("C_PUSH", parser.arg1(), parser.arg2())
-        elif parser.command_type() == "C_POP":
-            code_writer.write_push_pop("C_POP", parser.arg1(), parser.arg2())
-        elif parser.command_type() == "C_LABEL":
-            code_writer.write_label(parser.arg1())
-        elif parser.command_type() == "C_GOTO":
-            code_writer.write_goto(parser.arg1())
-        elif parser.command_type() == "C_IF":
-            code_writer.write_if(parser.arg1())
-        elif parser.command_type() == "C_FUNCTION":
-            code_writer.write_function(parser.arg1(), parser.arg2())
-        elif parser.command_type() == "C_RETURN":
-            code_writer.write_return()
-        elif parser.command_type() == "C_CALL":
-            code_writer.write_call(parser.arg1(), parser.arg2())
+    if intrinsics:
+        # First, so that the other passes see the shifts
+        commands = Optimizer.replace_intrinsics(commands)
+    if fuse_branches:
+        commands = Optimizer.fuse_compare_branches(commands)
+    if fold_constants:
+        commands = Optimizer.fold_constants(commands)
+    jump_counters = {"jumps_removed": 0}
+    if thread_jumps:
+        # After folding, which turns constant if-gotos into gotos
+        commands = Optimizer.thread_jumps(commands, jump_counters)
+    if fuse_moves:
+        commands = Optimizer.fuse_moves(commands)
+    if tail_calls:
+        commands = Optimizer.fuse_tail_calls(commands)
 
+    for command in commands:
+        code_writer.write_command(command)
+    code_writer.flush_stack_top()
+    code_writer.flush()
 
-if "__main__" == __name__:
-    # Parses the input path and calls translate_file on each input file.
-    # This opens both the input and the output files!
-    # Both are closed automatically when the code finishes running.
-    # If the output file does not exist, it is created automatically in the
-    # correct path, using the correct filename.
-    if not len(sys.argv) == 2:
-        sys.exit("Invalid usage, please use: VMtranslator <input path>")
-    argument_path = os.path.abspath(sys.argv[1])
+    report = {"rom_saved": code_writer.rom_saved}
+    if thread_jumps:
+        report.update(jump_counters)
+    if stats:
+        report["stats"] = dict(code_writer.stats,
+                               labels=code_writer.labels_counter)
+    return report
+
+
+def translate_path(
+        input_path: str, bootstrap: bool,
+        options: typing.Dict[str, typing.Any],
+        output_file: typing.Optional[typing.TextIO] = None,
+        commands: typing.Optional[typing.List[Command]] = None) \
+        -> typing.Tuple[str, typing.Dict[str, int]]:
+    """Translates a single file into an independent fragment of assembly.
+    This is the unit of work of the --jobs process pool, so it only takes
+    picklable arguments.
+
+    Args:
+        input_path (str): path of the .vm file to translate.
+        bootstrap (bool): whether to write the bootstrap code first.
+        options (typing.Dict[str, typing.Any]): the keyword arguments of
+            translate_file, plus "optimize", the peephole level.
+        output_file (typing.Optional[typing.TextIO]): if given, the fragment
+            is streamed to this file instead of being returned.
+        commands (typing.Optional[typing.List[Command]]): if given, these
+            commands are translated instead of the content of the file.
+
+    Returns:
+        typing.Tuple[str, typing.Dict[str, int]]: the assembly fragment (empty
+        when streamed to output_file) and the counters describing its
+        translation.
+    """
+    options = dict(options)
+    level = options.pop("optimize", 0)
+    fragment = io.StringIO()
+    stream = output_file if output_file is not None else fragment
+    if options.get("source_map"):
+        stream = source_map = SourceMap(stream)
+    if level > 0:
+        stream = Peephole(stream, level)
+    if commands is None:
+        with open(input_path, 'r') as input_file:
+            report = translate_file(input_file, stream, bootstrap, **options)
+    else:
+        report = translate_commands(commands, input_path, stream, bootstrap,
+                                    **options)
+    if level > 0:
+        stream.flush()
+        report["instructions_in"] = stream.instructions_in
+        report["instructions_out"] = stream.instructions_out
+    if options.get("source_map"):
+        source_map.flush()
+        report["instructions"] = source_map.instructions
+        report["source_map"] = source_map.ranges
+    return fragment.getvalue(), report
+
+
+def translate_program(
+        input_paths: typing.List[str], output_file: typing.TextIO,
+        options: typing.Dict[str, typing.Any], jobs: int = 1,
+        cache: typing.Optional[TranslationCache] = None,
+        program: typing.Optional[WholeProgram.Program] = None) \
+        -> typing.Dict[str, typing.Any]:
+    """Translates the files of a program into a single output file, with the
+    bootstrap code at the start of the first one.
+
+    Args:
+        input_paths (typing.List[str]): paths of the .vm files, in order.
+        output_file (typing.TextIO): writes all output to this file.
+        options (typing.Dict[str, typing.Any]): see translate_path, plus
+            the whole-program options, which load all the files at once:
+            "eliminate_dead_code", whether to drop the functions that are
+            unreachable from Sys.init, and "inline_threshold", the size of
+            the largest leaf function to inline (0 to inline none).
+        jobs (int): the number of processes translating files in parallel.
+        cache (typing.Optional[TranslationCache]): if given, unchanged files
+            are taken from this cache and new translations are stored in it.
+        program (typing.Optional[WholeProgram.Program]): if given, the
+            commands of every file, which are translated instead of the
+            content of the files; input_paths then only name the files.
+
+    Returns:
+        typing.Dict[str, typing.Any]: the counters of all the files, summed.
+        With the "stats" and "source_map" options, also "stats" and
+        "source_map", see add_file_report.
+        With whole-program options, also "inlined_calls", the number of
+        inlined calls, "eliminated_functions", the names of the dropped
+        functions, and "dead_code_rom_saved", their size.
+    """
+    options = dict(options)
+    eliminate_dead_code = options.pop("eliminate_dead_code", False)
+    inline_threshold = options.pop("inline_threshold", 0)
+    bootstraps = [index == 0 for index in range(len(input_paths))]
+    report = collections.Counter()
+    if program is None and (eliminate_dead_code or inline_threshold > 0):
+        program = WholeProgram.load_program(
+            input_paths, options.get("source_map", False))
+    elif program is None:
+        program = [None] * len(input_paths)
+    if eliminate_dead_code or inline_threshold > 0:
+        if options.get("intrinsics"):
+            # So that the replaced OS functions are dropped when unused, and
+            # their callers may become leaves
+            program = [list(Optimizer.replace_intrinsics(commands))
+                       for commands in program]
+        if inline_threshold > 0:
+            # The inlined functions are then mostly dead
+            program, report["inlined_calls"] = \
+                WholeProgram.inline_small_functions(program, inline_threshold)
+        program, eliminated = WholeProgram.eliminate_dead_functions(program)
+        report["eliminated_functions"] = WholeProgram.function_names(
+            eliminated)
+        report["dead_code_rom_saved"] = sum(
+            count_instructions(translate_path(
+                input_path, False, options, commands=commands)[0])
+            for input_path, commands in zip(input_paths, eliminated)
+            if commands)
+
+    if cache is None and jobs <= 1:
+        # Streams every file straight to the output, so that memory use does
+        # not grow with the size of the input.
+        for input_path, bootstrap, commands in zip(
+                input_paths, bootstraps, program):
+            _, file_report = translate_path(
+                input_path, bootstrap, options, output_file, commands)
+            add_file_report(report, input_path, file_report)
+        return report
+
+    results = [None] * len(input_paths)
+    if cache is not None:
+        keys = [cache.key(input_path, bootstrap, options, commands)
+                for input_path, bootstrap, commands in zip(
+                    input_paths, bootstraps, program)]
+        results = [cache.get(key) for key in keys]
+    # Only the files missing from the cache go through the translator
+    missing = [index for index in range(len(input_paths))
+               if results[index] is None]
+    missing_paths = [input_paths[index] for index in missing]
+    missing_bootstraps = [bootstraps[index] for index in missing]
+    missing_commands = [program[index] for index in missing]
+    all_options = [options] * len(missing)
+    all_outputs = [None] * len(missing)
+    if jobs > 1 and len(missing) > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            translated = list(executor.map(
+                translate_path, missing_paths, missing_bootstraps,
+                all_options, all_outputs, missing_commands))
+    else:
+        translated = map(
+            translate_path, missing_paths, missing_bootstraps, all_options,
+            all_outputs, missing_commands)
+    for index, result in zip(missing, translated):
+        results[index] = result
+        if cache is not None:
+            cache.put(keys[index], *result)
+    if cache is not None:
+        cache.evict()
+
+    for input_path, (fragment, file_report) in zip(input_paths, results):
+        output_file.write(fragment)
+        add_file_report(report, input_path, file_report)
+    return report
+
+
+def add_file_report(report: typing.Dict[str, typing.Any], input_path: str,
+                    file_report: typing.Dict[str, typing.Any]) -> None:
+    """Adds the counters of a file to those of its program.
+
+    The source map of the file is appended to the "source_map" of the
+    program, a list of {"start", "end", "file", "line", "function"} for
+    every range of ROM addresses, where end is exclusive and line is the
+    1-based line in the .vm file, or 0 for code not made from a VM line.
+
+    The statistics of the file are added to the "stats" of the program,
+    which has:
+
+    - "instructions" and "labels", the totals of the program,
+    - "commands" and "functions", the commands and the instructions they
+      generated, by command kind and by function,
+    - "files", the same totals and the number of labels of every file.
+
+    Instructions are counted as written by the CodeWriter, before the
+    peephole optimizer.
+
+    Args:
+        report (typing.Dict[str, typing.Any]): the report of the program.
+        input_path (str): path of the .vm file.
+        file_report (typing.Dict[str, typing.Any]): the report of the file,
+            as returned by translate_path.
+    """
+    file_report = dict(file_report)
+    file_stats = file_report.pop("stats", None)
+    file_source_map = file_report.pop("source_map", None)
+    # The code of a file starts after the code of the previous files
+    base = report.get("instructions", 0)
+    report.update(file_report)
+    if file_source_map is not None:
+        ranges = report.setdefault("source_map", [])
+        file_name = os.path.basename(input_path)
+        for start, end, line, function in file_source_map:
+            ranges.append({"start": base + start, "end": base + end,
+                           "file": file_name, "line": line,
+                           "function": function})
+    if file_stats is None:
+        return
+    stats = report.setdefault("stats", {
+        "instructions": 0, "labels": 0, "commands": {}, "functions": {},
+        "files": {}})
+    file_totals = {"count": 0, "instructions": 0,
+                   "labels": file_stats["labels"]}
+    for table in ("commands", "functions"):
+        for key, entry in file_stats[table].items():
+            total = stats[table].setdefault(
+                key, {"count": 0, "instructions": 0})
+            total["count"] += entry["count"]
+            total["instructions"] += entry["instructions"]
+            if table == "functions":
+                file_totals["count"] += entry["count"]
+                file_totals["instructions"] += entry["instructions"]
+    stats["files"][os.path.basename(input_path)] = file_totals
+    stats["instructions"] += file_totals["instructions"]
+    stats["labels"] += file_totals["labels"]
+
+
+def translate_sources(
+        sources: typing.Mapping[str, typing.Union[str, typing.Iterable[str]]],
+        options: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        emit: str = "asm") -> typing.Union[str, bytes]:
+    """Translates a program held in memory. This is the entry point for
+    using the translator as a library: every call parses and translates
+    with its own Parser, CodeWriter and Peephole, and no module keeps
+    mutable state, so the output only depends on the arguments, and calls
+    may run concurrently from several threads.
+
+    Args:
+        sources (typing.Mapping[str, typing.Union[str, typing.Iterable[str]]]):
+            the VM code of every file, as a string or as an iterable of
+            lines, by file name (e.g. "Main.vm"), in translation order. The
+            names only serve to name the static variables and labels.
+        options (typing.Optional[typing.Dict[str, typing.Any]]): see
+            translate_program. Defaults to no optimization.
+        emit (str): "asm" to return Hack assembly, "hack" to return the
+            content of a .hack file.
+
+    Returns:
+        typing.Union[str, bytes]: the assembly text, or the machine code as
+        the ASCII bytes of a .hack file.
+    """
+    if emit not in ("asm", "hack"):
+        raise ValueError("Unknown output format: " + emit)
+    options = options or {}
+    names = list(sources)
+    program = []
+    for source in sources.values():
+        if isinstance(source, str):
+            source = io.StringIO(source)
+        program.append(list(Parser(source).commands(
+            options.get("source_map", False))))
+    assembly = io.StringIO()
+    translate_program(names, assembly, options, program=program)
+    if emit == "asm":
+        return assembly.getvalue()
+    return to_binary(HackAssembler().assemble(
+        assembly.getvalue().splitlines())).encode("ascii")
+
+
+def translate_source(
+        source: typing.Union[str, typing.Iterable[str]],
+        file_name: str = "Main.vm",
+        options: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        emit: str = "asm") -> typing.Union[str, bytes]:
+    """Translates a single file held in memory, see translate_sources.
+
+    Args:
+        source (typing.Union[str, typing.Iterable[str]]): the VM code, as a
+            string or as an iterable of lines.
+        file_name (str): the name of the file.
+        options (typing.Optional[typing.Dict[str, typing.Any]]): see
+            translate_program.
+        emit (str): "asm" or "hack", see translate_sources.
+
+    Returns:
+        typing.Union[str, bytes]: see translate_sources.
+    """
+    return translate_sources({file_name: source}, options, emit)
+
+
+def add_translator_arguments(arg_parser: argparse.ArgumentParser) -> None:
+    """Adds the options of the translator to a command line parser, so that
+    every front end (this module, Bench) accepts the same options.
+
+    Args:
+        arg_parser (argparse.ArgumentParser): the parser to extend.
+    """
+    arg_parser.add_argument(
+        "--call-routines", action="store_true",
+        help="emit one shared call/return routine and jump to it from every "
+             "call and return site, trading cycles for ROM")
+    arg_parser.add_argument(
+        "--compact-compare", action="store_true",
+        help="emit one shared routine per comparison operator and jump to it "
+             "from every eq, gt and lt")
+    arg_parser.add_argument(
+        "--fuse-branches", action="store_true",
+        help="translate a comparison followed by if-goto (or by not and "
+             "if-goto) into a single compare-and-branch")
+    arg_parser.add_argument(
+        "--fold-constants", action="store_true",
+        help="evaluate constant expressions at translation time and "
+             "specialize arithmetic with a constant operand")
+    arg_parser.add_argument(
+        "--fuse-moves", action="store_true",
+        help="translate a push followed by a pop into a direct copy that "
+             "does not go through the stack")
+    arg_parser.add_argument(
+        "--stack-top-in-d", action="store_true",
+        help="keep the top of the stack in D between commands instead of "
+             "storing and reloading it")
+    arg_parser.add_argument(
+        "--tail-calls", action="store_true",
+        help="translate a call followed by return into a jump that reuses "
+             "the frame of the caller")
+    arg_parser.add_argument(
+        "--intrinsics", action="store_true",
+        help="replace calls to Memory.peek and Memory.poke, and "
+             "multiplications and divisions by constant powers of 2, by "
+             "inline code; assumes the standard OS")
+    arg_parser.add_argument(
+        "--thread-jumps", action="store_true",
+        help="retarget jumps to the end of goto chains, and drop jumps to "
+             "the next command, unreachable code and unused labels")
+    arg_parser.add_argument(
+        "-O", dest="optimize", type=int, choices=[0, 1, 2], default=0,
+        help="peephole optimization level of the generated assembly")
+    arg_parser.add_argument(
+        "--dce", dest="eliminate_dead_code", action="store_true",
+        help="drop the functions that are never called, starting from "
+             "Sys.init")
+    arg_parser.add_argument(
+        "--inline-threshold", type=int, default=0, metavar="N",
+        help="inline the leaf functions of at most N commands at their call "
+             "sites, then drop the functions left unused (0: never inline)")
+
+
+def translator_options(
+        args: argparse.Namespace) -> typing.Dict[str, typing.Any]:
+    """Collects the options added by add_translator_arguments.
+
+    Args:
+        args (argparse.Namespace): the parsed command line.
+
+    Returns:
+        typing.Dict[str, typing.Any]: the options of translate_program.
+    """
+    return {"call_routines": args.call_routines,
+            "compact_compare": args.compact_compare,
+            "fuse_branches": args.fuse_branches,
+            "tail_calls": args.tail_calls,
+            "fold_constants": args.fold_constants,
+            "fuse_moves": args.fuse_moves,
+            "stack_top_in_d": args.stack_top_in_d,
+            "intrinsics": args.intrinsics,
+            "thread_jumps": args.thread_jumps,
+            "optimize": args.optimize,
+            "eliminate_dead_code": args.eliminate_dead_code,
+            "inline_threshold": args.inline_threshold}
+
+
+def program_paths(argument_path: str) -> typing.Tuple[typing.List[str], str]:
+    """Finds the files of a program.
+
+    Args:
+        argument_path (str): a .vm file or a directory of .vm files.
+
+    Returns:
+        typing.Tuple[typing.List[str], str]: the paths of the .vm files, in
+        translation order, and the path of the output without extension.
+    """
+    argument_path = os.path.abspath(argument_path)
     if os.path.isdir(argument_path):
         files_to_translate = [
             os.path.join(argument_path, filename)
@@ -69,13 +508,99 @@ if "__main__" == __name__:
     else:
         files_to_translate = [argument_path]
         output_path, extension = os.path.splitext(argument_path)
-    output_path += ".asm"
-    bootstrap = True
+    input_paths = [
+        input_path for input_path in sorted(files_to_translate)
+        if os.path.splitext(input_path)[1].lower() == ".vm"]
+    return input_paths, output_path
+
+
+if "__main__" == __name__:
+    # Parses the input path and calls translate_program on its input files,
+    # which translates them (possibly in parallel) in file order.
+    # This opens both the input and the output files!
+    # Both are closed automatically when the code finishes running.
+    # If the output file does not exist, it is created automatically in the
+    # correct path, using the correct filename.
+    arg_parser = argparse.ArgumentParser(
+        prog="VMtranslator", description="Translates VM code to Hack assembly.")
+    arg_parser.add_argument("input_path", help="a .vm file or a directory")
+    add_translator_arguments(arg_parser)
+    arg_parser.add_argument(
+        "--emit", choices=["asm", "hack"], default="asm",
+        help="write Hack assembly, or assemble it in process and write "
+             "machine code")
+    arg_parser.add_argument(
+        "--jobs", type=int, default=1, metavar="N",
+        help="translate the files of a directory in N processes")
+    arg_parser.add_argument(
+        "--cache", metavar="DIR",
+        help="reuse the translations of unchanged files stored in DIR")
+    arg_parser.add_argument(
+        "--stats", metavar="FILE",
+        help="write the number of commands and generated instructions by "
+             "command kind, function and file, as JSON")
+    arg_parser.add_argument(
+        "--source-map", metavar="FILE",
+        help="write the .vm file, line and function of every range of ROM "
+             "addresses, as JSON")
+    arg_parser.add_argument(
+        "--cache-size", type=int, default=64 * 1024 * 1024, metavar="BYTES",
+        help="evict the least recently used cache entries above this size")
+    args = arg_parser.parse_args()
+    input_paths, output_path = program_paths(args.input_path)
+    output_path += "." + args.emit
+    options = translator_options(args)
+    if args.stats:
+        options["stats"] = True
+    if args.source_map:
+        options["source_map"] = True
+    cache = None
+    if args.cache:
+        cache = TranslationCache(args.cache, args.cache_size)
     with open(output_path, 'w') as output_file:
-        for input_path in files_to_translate:
-            filename, extension = os.path.splitext(input_path)
-            if extension.lower() != ".vm":
-                continue
-            with open(input_path, 'r') as input_file:
-                translate_file(input_file, output_file, bootstrap)
-            bootstrap = False
+        if args.emit == "hack":
+            # The assembler resolves labels in a first pass, so the whole
+            # program is kept in memory
+            assembly = io.StringIO()
+            report = translate_program(
+                input_paths, assembly, options, args.jobs, cache)
+            output_file.write(to_binary(HackAssembler().assemble(
+                assembly.getvalue().splitlines())))
+        else:
+            report = translate_program(
+                input_paths, output_file, options, args.jobs, cache)
+    if args.stats:
+        stats = dict(report["stats"], translator=translator_digest(),
+                     options=translator_options(args))
+        if args.optimize > 0:
+            stats["instructions_after_peephole"] = report["instructions_out"]
+        with open(args.stats, "w") as stats_file:
+            json.dump(stats, stats_file, indent=2, sort_keys=True)
+    if args.source_map:
+        with open(args.source_map, "w") as source_map_file:
+            json.dump(report["source_map"], source_map_file, indent=1)
+    if cache:
+        print("Cache: " + str(cache.hits) + " hits, " + str(cache.misses) +
+              " misses")
+    if args.call_routines or args.compact_compare:
+        print("Shared routines saved " + str(report["rom_saved"]) +
+              " ROM words in " + os.path.basename(output_path))
+    if args.thread_jumps:
+        print("Jump threading removed " + str(report["jumps_removed"]) +
+              " jumps")
+    if args.inline_threshold > 0:
+        print("Inlined " + str(report["inlined_calls"]) + " calls")
+    if args.eliminate_dead_code or args.inline_threshold > 0:
+        eliminated = report["eliminated_functions"]
+        message = "Dead code elimination removed " + str(len(eliminated)) + \
+            " functions (" + str(report["dead_code_rom_saved"]) + \
+            " ROM words)"
+        if eliminated:
+            message += ": " + ", ".join(eliminated)
+        print(message)
+    if args.optimize > 0:
+        print("Peephole -O" + str(args.optimize) + ": " +
+              str(report["instructions_in"]) + " -> " +
+              str(report["instructions_out"]) + " instructions (" +
+              str(report["instructions_out"] - report["instructions_in"]) +
+              ")")
@@ -0,0 +1,403 @@
+"""
+This file is part of nand2tetris, as taught in The Hebrew University, and
+was written by Aviv Yaish. It is an extension to the specifications given
+[here](https://www.nand2tetris.org) (Shimon Schocken and Noam Nisan, 2017),
+as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
+Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
+
+Optimization passes over the VM command stream. Each pass takes an iterable
+of Parser.Command records and yields the rewritten stream, so passes can be
+chained in front of the CodeWriter without reading the whole file.
+"""
+import typing
+from Parser import Command, Opcode
+
+
+# The condition tested by "<comparison> [not] if-goto", by negation
+BRANCH_CONDITIONS = {"eq": ("eq", "ne"), "gt": ("gt", "le"),
+                     "lt": ("lt", "ge")}
+
+
+def to_word(value: int) -> int:
+    """Wraps a number around to a signed 16-bit word, like the Hack ALU.
+
+    Args:
+        value (int): any integer.
+
+    Returns:
+        int: the value modulo 2^16, between -32768 and 32767.
+    """
+    return (value + 0x8000 & 0xFFFF) - 0x8000
+
+
+# The arithmetic commands evaluated at translation time, on signed words
+UNARY_FOLDS = {
+    "neg": lambda x: to_word(-x),
+    "not": lambda x: ~x,
+    "shiftleft": lambda x: to_word(x * 2),
+    "shiftright": lambda x: x >> 1,
+}
+BINARY_FOLDS = {
+    "add": lambda x, y: to_word(x + y),
+    "sub": lambda x, y: to_word(x - y),
+    "and": lambda x, y: x & y,
+    "or": lambda x, y: x | y,
+    "eq": lambda x, y: -1 if x == y else 0,
+    "gt": lambda x, y: -1 if x > y else 0,
+    "lt": lambda x, y: -1 if x < y else 0,
+}
+# The constant operands that leave the other operand unchanged
+IDENTITIES = {"add": 0, "and": -1, "or": 0}
+
+# The OS functions replaced by inline code, by name and number of arguments
+INTRINSIC_CALLS = {("Memory.peek", 1): Opcode.PEEK,
+                   ("Memory.poke", 2): Opcode.POKE}
+MULTIPLY = ("Math.multiply", 2)
+DIVIDE = ("Math.divide", 2)
+
+# The commands that end a basic block, and those of them after which the
+# next command is never executed
+JUMPS = (Opcode.GOTO, Opcode.IF, Opcode.COMPARE_IF)
+BLOCK_ENDS = JUMPS + (Opcode.RETURN, Opcode.TAIL_CALL)
+UNCONDITIONAL_ENDS = (Opcode.GOTO, Opcode.RETURN, Opcode.TAIL_CALL)
+
+# Segments addressed relative to the stack pointer, which moves between the
+# push and the pop of a pair
+STACK_SEGMENTS = ("stack",)
+
+
+def fuse_compare_branches(
+        commands: typing.Iterable[Command]) -> typing.Iterator[Command]:
+    """Fuses "eq/gt/lt, if-goto" and "eq/gt/lt, not, if-goto" into a single
+    COMPARE_IF command, whose arg1 is the label and arg3 the condition
+    under which to jump: one of "eq", "ne", "gt", "le", "lt" and "ge".
+
+    Args:
+        commands (typing.Iterable[Command]): the input command stream.
+
+    Yields:
+        Command: the output command stream.
+    """
+    window = []
+    for command in commands:
+        window.append(command)
+        while window:
+            first = window[0]
+            if first.opcode != Opcode.ARITHMETIC or \
+                    first.arg1 not in BRANCH_CONDITIONS:
+                yield window.pop(0)
+                continue
+            negated = len(window) > 1 and \
+                window[1].opcode == Opcode.ARITHMETIC and \
+                window[1].arg1 == "not"
+            branch = window[2 if negated else 1] \
+                if len(window) > (2 if negated else 1) else None
+            if branch is None:
+                # Wait for the rest of the pattern
+                break
+            if branch.opcode == Opcode.IF:
+                yield Command(Opcode.COMPARE_IF, branch.arg1, 0,
+                              BRANCH_CONDITIONS[first.arg1][negated],
+                              line=first.line)
+                window = []
+            else:
+                yield window.pop(0)
+    yield from window
+
+
+def fuse_tail_calls(
+        commands: typing.Iterable[Command]) -> typing.Iterator[Command]:
+    """Fuses "call, return" into a single TAIL_CALL command, with the
+    arguments of the call.
+
+    Args:
+        commands (typing.Iterable[Command]): the input command stream.
+
+    Yields:
+        Command: the output command stream.
+    """
+    call = None
+    for command in commands:
+        if call is not None:
+            if command.opcode == Opcode.RETURN:
+                yield Command(Opcode.TAIL_CALL, call.arg1, call.arg2,
+                              line=call.line)
+                call = None
+                continue
+            yield call
+            call = None
+        if command.opcode == Opcode.CALL:
+            call = command
+        else:
+            yield command
+    if call is not None:
+        yield call
+
+
+def fold_constants(
+        commands: typing.Iterable[Command]) -> typing.Iterator[Command]:
+    """Evaluates the arithmetic commands whose operands are all pushed
+    constants, and turns those whose top operand is a pushed constant into
+    ARITH_CONST commands, whose arg1 is the command and arg2 the constant.
+    Only "add", "and", "or" and "eq" take any constant, "gt" and "lt" only
+    take 0, and "sub" becomes "add" of the negated constant. An if-goto of a
+    pushed constant becomes a goto, or nothing.
+
+    Pushed constants may then be any signed 16-bit word.
+
+    Args:
+        commands (typing.Iterable[Command]): the input command stream.
+
+    Yields:
+        Command: the output command stream.
+    """
+    # The values of the constants pushed by the last commands, and the
+    # lines of the pushes
+    constants = []
+    lines = []
+    for command in commands:
+        if command.opcode == Opcode.PUSH and command.arg1 == "constant":
+            constants.append(to_word(command.arg2))
+            lines.append(command.line)
+            continue
+        if command.opcode == Opcode.ARITHMETIC:
+            operation = command.arg1
+            if operation in UNARY_FOLDS and constants:
+                constants[-1] = UNARY_FOLDS[operation](constants[-1])
+                continue
+            if operation in BINARY_FOLDS and len(constants) >= 2:
+                value = constants.pop()
+                lines.pop()
+                constants[-1] = BINARY_FOLDS[operation](constants[-1], value)
+                continue
+            if operation in BINARY_FOLDS and constants:
+                value = constants[-1]
+                if operation == "sub":
+                    operation, value = "add", to_word(-value)
+                if operation in ("add", "and", "or", "eq") or value == 0:
+                    constants.pop()
+                    lines.pop()
+                    if IDENTITIES.get(operation) != value:
+                        yield Command(Opcode.ARITH_CONST, operation, value,
+                                      line=command.line)
+                    continue
+        if command.opcode == Opcode.IF and constants:
+            lines.pop()
+            if constants.pop() == 0:
+                continue
+            command = command._replace(opcode=Opcode.GOTO)
+        for value, line in zip(constants, lines):
+            yield Command(Opcode.PUSH, "constant", value, line=line)
+        constants = []
+        lines = []
+        yield command
+    for value, line in zip(constants, lines):
+        yield Command(Opcode.PUSH, "constant", value, line=line)
+
+
+def fuse_moves(
+        commands: typing.Iterable[Command]) -> typing.Iterator[Command]:
+    """Fuses "push segment index, pop segment index" into a single MOVE
+    command, whose arg1 and arg2 are the source and arg3 and arg4 the
+    target.
+
+    Args:
+        commands (typing.Iterable[Command]): the input command stream.
+
+    Yields:
+        Command: the output command stream.
+    """
+    push = None
+    for command in commands:
+        if push is not None:
+            if command.opcode == Opcode.POP and \
+                    command.arg1 not in STACK_SEGMENTS:
+                yield Command(Opcode.MOVE, push.arg1, push.arg2,
+                              command.arg1, command.arg2, push.line)
+                push = None
+                continue
+            yield push
+            push = None
+        if command.opcode == Opcode.PUSH and \
+                command.arg1 not in STACK_SEGMENTS:
+            push = command
+        else:
+            yield command
+    if push is not None:
+        yield push
+
+
+def replace_intrinsics(
+        commands: typing.Iterable[Command]) -> typing.Iterator[Command]:
+    """Replaces calls to OS functions by inline code, assuming that the
+    program uses the standard Math and Memory classes:
+
+    - "call Memory.peek 1" and "call Memory.poke 2" become PEEK and POKE
+      commands, which access RAM directly.
+    - "call Math.multiply 2" where either operand is a pushed constant power
+      of 2 becomes shiftleft commands, and where it is 0, "and" with 0.
+      When the constant is the first operand, the second must be a push.
+    - "call Math.divide 2" where the divisor is a pushed constant power of 2
+      becomes a DIVIDE_SHIFT command, whose arg2 is the exponent.
+
+    Args:
+        commands (typing.Iterable[Command]): the input command stream.
+
+    Yields:
+        Command: the output command stream.
+    """
+    # The last commands, which may be the operands of a call
+    window = []
+    for command in commands:
+        if command.opcode == Opcode.CALL:
+            call = (command.arg1, command.arg2)
+            operand = None
+            if call in INTRINSIC_CALLS:
+                yield from window
+                window = []
+                yield Command(INTRINSIC_CALLS[call], line=command.line)
+                continue
+            if call == MULTIPLY or call == DIVIDE:
+                if window and _power_of_two(window[-1], call == MULTIPLY):
+                    operand = window.pop()
+                elif call == MULTIPLY and len(window) == 2 and \
+                        _power_of_two(window[0], True) and \
+                        window[1].opcode == Opcode.PUSH:
+                    operand = window.pop(0)
+            if operand is not None:
+                yield from window
+                window = []
+                shift = operand.arg2.bit_length() - 1
+                if call == DIVIDE:
+                    if shift > 0:
+                        yield Command(Opcode.DIVIDE_SHIFT, "", shift,
+                                      line=command.line)
+                elif operand.arg2 == 0:
+                    yield Command(Opcode.ARITH_CONST, "and", 0,
+                                  line=command.line)
+                else:
+                    yield from [Command(Opcode.ARITHMETIC, "shiftleft",
+                                        line=command.line)] * shift
+                continue
+        window.append(command)
+        if len(window) > 2:
+            yield window.pop(0)
+    yield from window
+
+
+def _power_of_two(command: Command, allow_zero: bool) -> bool:
+    # Whether a command pushes a constant power of 2, or 0
+    if command.opcode != Opcode.PUSH or command.arg1 != "constant":
+        return False
+    value = command.arg2
+    if value == 0:
+        return allow_zero
+    return 0 < value < 0x8000 and value & (value - 1) == 0
+
+
+def thread_jumps(commands: typing.Iterable[Command],
+                 counters: typing.Optional[typing.Dict[str, int]] = None) \
+        -> typing.Iterator[Command]:
+    """Cleans up the control flow of every function, whose commands are
+    split into basic blocks:
+
+    - Jumps to a label followed by a goto are retargeted to the end of the
+      chain of gotos.
+    - Blocks that cannot be reached from the start of the function are
+      dropped.
+    - A goto to the block that follows it is dropped.
+    - Labels that are no longer the target of any jump are dropped, so that
+      the code around them can be optimized together.
+
+    Labels are local to their function, so every function is buffered and
+    rewritten on its own. Functions that jump to undefined labels are left
+    unchanged.
+
+    Args:
+        commands (typing.Iterable[Command]): the input command stream.
+        counters (typing.Optional[typing.Dict[str, int]]): if given,
+            "jumps_removed" is increased by the number of goto, if-goto and
+            fused compare-and-branch commands removed.
+
+    Yields:
+        Command: the output command stream.
+    """
+    body = []
+    for command in commands:
+        if command.opcode == Opcode.FUNCTION and body:
+            yield from _thread_function(body, counters)
+            body = []
+        body.append(command)
+    if body:
+        yield from _thread_function(body, counters)
+
+
+def _thread_function(body: typing.List[Command],
+                     counters: typing.Optional[typing.Dict[str, int]]) \
+        -> typing.List[Command]:
+    # A block starts at its labels and ends at the first jump, return or
+    # label after them
+    blocks = [[]]
+    for command in body:
+        if command.opcode == Opcode.LABEL and any(
+                block_command.opcode != Opcode.LABEL
+                for block_command in blocks[-1]):
+            blocks.append([])
+        blocks[-1].append(command)
+        if command.opcode in BLOCK_ENDS:
+            blocks.append([])
+    blocks = [block for block in blocks if block]
+    label_blocks = {command.arg1: index for index, block in enumerate(blocks)
+                    for command in block if command.opcode == Opcode.LABEL}
+    if any(command.opcode in JUMPS and command.arg1 not in label_blocks
+           for command in body):
+        return body
+
+    def final_target(label: str) -> str:
+        # Follows the blocks that are only a goto, stopping at cycles
+        seen = set()
+        while label not in seen:
+            seen.add(label)
+            block = blocks[label_blocks[label]]
+            code = [command for command in block
+                    if command.opcode != Opcode.LABEL]
+            if not code or code[0].opcode != Opcode.GOTO:
+                break
+            label = code[0].arg1
+        return label
+
+    blocks = [[command._replace(arg1=final_target(command.arg1))
+               if command.opcode in JUMPS else command
+               for command in block] for block in blocks]
+
+    reachable = set()
+    pending = [0]
+    while pending:
+        index = pending.pop()
+        if index in reachable or index >= len(blocks):
+            continue
+        reachable.add(index)
+        last = blocks[index][-1]
+        if last.opcode in JUMPS:
+            pending.append(label_blocks[last.arg1])
+        if last.opcode not in UNCONDITIONAL_ENDS:
+            pending.append(index + 1)
+    blocks = [block for index, block in enumerate(blocks)
+              if index in reachable]
+
+    for index in range(len(blocks) - 1):
+        last = blocks[index][-1]
+        if last.opcode == Opcode.GOTO and any(
+                command.opcode == Opcode.LABEL and command.arg1 == last.arg1
+                for command in blocks[index + 1]):
+            blocks[index].pop()
+
+    targets = {command.arg1 for block in blocks for command in block
+               if command.opcode in JUMPS}
+    threaded = [command for block in blocks for command in block
+                if command.opcode != Opcode.LABEL or command.arg1 in targets]
+    if counters is not None:
+        counters["jumps_removed"] = counters.get("jumps_removed", 0) + \
+            sum(command.opcode in JUMPS for command in body) - \
+            sum(command.opcode in JUMPS for command in threaded)
+    return threaded
@@ -5,9 +5,70 @@ was written by Aviv Yaish. It is an extension to the specifications given
 as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
 Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
 """
+import enum
+import sys
 import typing
 
 
+class Opcode(enum.IntEnum):
+    """The type of a Command. The first nine mirror the values returned by
+    Parser.command_type(), which are "C_" followed by the name; the rest are
+    created by the Optimizer and by the WholeProgram passes."""
+    ARITHMETIC = 0
+    PUSH = 1
+    POP = 2
+    LABEL = 3
+    GOTO = 4
+    IF = 5
+    FUNCTION = 6
+    RETURN = 7
+    CALL = 8
+    COMPARE_IF = 9
+    INLINE_RETURN = 10
+    TAIL_CALL = 11
+    ARITH_CONST = 12
+    MOVE = 13
+    PEEK = 14
+    POKE = 15
+    DIVIDE_SHIFT = 16
+
+
+class Command(typing.NamedTuple):
+    """A parsed VM command, as returned by Parser.commands().
+
+    arg1 and arg2 are the values of Parser.arg1() and Parser.arg2() where
+    they apply, with the strings interned and the numbers already converted.
+    arg3 and arg4 hold the extra operands of fused commands. line is the
+    Parser.line_counter of the command when the parser was asked for line
+    numbers, and -1 otherwise; passes give the commands they create the line
+    of the commands they replace.
+    """
+    opcode: Opcode
+    arg1: str = ""
+    arg2: int = 0
+    arg3: str = ""
+    arg4: int = 0
+    line: int = -1
+
+
+ARITHMETIC_COMMANDS = ("add", "sub", "neg", "eq", "gt", "lt", "and", "or",
+                       "not", "shiftleft", "shiftright")
+# Maps the first word of a command to its opcode
+OPCODES = dict.fromkeys(ARITHMETIC_COMMANDS, Opcode.ARITHMETIC)
+OPCODES.update({"push": Opcode.PUSH, "pop": Opcode.POP,
+                "label": Opcode.LABEL, "goto": Opcode.GOTO,
+                "if-goto": Opcode.IF, "function": Opcode.FUNCTION,
+                "return": Opcode.RETURN, "call": Opcode.CALL})
+COMMAND_TYPES = {word: "C_" + opcode.name for word, opcode in OPCODES.items()}
+# Commands without numeric operands share a single record each
+SHARED_COMMANDS = {word: Command(Opcode.ARITHMETIC, word)
+                   for word in ARITHMETIC_COMMANDS}
+SHARED_COMMANDS["return"] = Command(Opcode.RETURN)
+# The first word of the commands of every opcode but ARITHMETIC
+KEYWORDS = {opcode: word for word, opcode in OPCODES.items()
+            if opcode != Opcode.ARITHMETIC}
+
+
 class Parser:
     """
     # Parser
@@ -50,18 +111,18 @@ class Parser:
         """Gets ready to parse the input file.
 
         Args:
-            input_file (typing.TextIO): input file.
+            input_file (typing.TextIO): input file, or any iterable of lines.
         """
-        # A good place to start is to read all the lines of the input:
-        # input_lines = input_file.read().splitlines()
+        # The input is read one line at a time, so that memory use does not
+        # depend on the size of the file. has_more_commands() reads ahead up
+        # to the next command and advance() makes it the current one.
         self.line_counter = -1
         self.current_command = ""
         self.current_command_words = []
-        self.input_lines = input_file.read().splitlines()
-
-        self.input_lines_words = []
-        for i in range(len(self.input_lines)):
-            self.input_lines_words.append(self.input_lines[i].split())
+        self.__input_lines = iter(input_file)
+        self.__lines_read = 0
+        self.__next_line = -1
+        self.__next_words = None
 
     def has_more_commands(self) -> bool:
         """Are there more commands in the input?
@@ -69,18 +130,16 @@ class Parser:
         Returns:
             bool: True if there are more commands, False otherwise.
         """
-        while self.line_counter < len(self.input_lines) - 1:
-            self.line_counter += 1
-            self.input_lines[self.line_counter] = \
-                self.input_lines[self.line_counter].replace(" ", "")
-            for i in range(len(self.input_lines[self.line_counter])):
-                if self.input_lines[self.line_counter][i] == "/":
-                    self.input_lines[self.line_counter] = \
-                        self.input_lines[self.line_counter][:i]
-                    break
-            if self.input_lines[self.line_counter] == "":  # ignore \n
-                continue
+        if self.__next_words is not None:
             return True
+        for line in self.__input_lines:
+            self.__lines_read += 1
+            # Strips the comment and splits the command in a single pass
+            words = line.split("//", 1)[0].split()
+            if words:  # ignore empty lines
+                self.__next_line = self.__lines_read - 1
+                self.__next_words = words
+                return True
         return False
 
     def advance(self) -> None:
@@ -88,8 +147,10 @@ class Parser:
         command. Should be called only if has_more_commands() is true. Initially
         there is no current command.
         """
-        self.current_command = self.input_lines[self.line_counter]
-        self.current_command_words = self.input_lines_words[self.line_counter]
+        self.line_counter = self.__next_line
+        self.current_command_words = self.__next_words
+        self.current_command = "".join(self.__next_words)
+        self.__next_words = None
 
     def command_type(self) -> str:
         """
@@ -100,28 +161,7 @@ class Parser:
             "C_PUSH", "C_POP", "C_LABEL", "C_GOTO", "C_IF", "C_FUNCTION",
             "C_RETURN", "C_CALL".
         """
-        arithmetics = {"add", "sub", "neg", "eq", "gt", "lt", "and", "or",
-                       "not"}
-
-        current_command_word = self.current_command_words[0]
-        if current_command_word in arithmetics:
-            return "C_ARITHMETIC"
-        elif current_command_word == "push":
-            return "C_PUSH"
-        elif current_command_word == "pop":
-            return "C_POP"
-        elif current_command_word == "label":
-            return "C_LABEL"
-        elif current_command_word == "goto":
-            return "C_GOTO"
-        elif current_command_word == "if-goto":
-            return "C_IF"
-        elif current_command_word == "function":
-            return "C_FUNCTION"
-        elif current_command_word == "return":
-            return "C_RETURN"
-        elif current_command_word == "call":
-            return "C_CALL"
+        return COMMAND_TYPES.get(self.current_command_words[0])
 
     def arg1(self) -> str:
         """
@@ -142,3 +182,83 @@ class Parser:
             "C_FUNCTION" or "C_CALL".
         """
         return int(self.current_command_words[2])
+
+    def commands(self, with_lines: bool = False) -> typing.Iterator[Command]:
+        """Iterates over the remaining commands of the input. This is the fast
+        path of the parser: it keeps line_counter up to date, but not
+        current_command and current_command_words.
+
+        Args:
+            with_lines (bool): if True, every command carries its line
+                number, so that commands are not shared between lines.
+
+        Yields:
+            Command: the next command, with the arguments that apply to its
+            opcode. Lines that are not valid commands are skipped.
+        """
+        if self.__next_words is not None:
+            # A command was already read ahead by has_more_commands()
+            self.advance()
+            command = parse_command(self.current_command_words)
+            if command is not None:
+                yield command._replace(line=self.line_counter) \
+                    if with_lines else command
+        # Arithmetic, push and pop commands repeat a lot, so their records
+        # are shared between identical lines. The number of distinct ones is
+        # bounded by the number of segment indices.
+        records = dict(SHARED_COMMANDS)
+        for line in self.__input_lines:
+            self.__lines_read += 1
+            code = line.split("//", 1)[0].strip()
+            if not code:
+                continue
+            self.line_counter = self.__lines_read - 1
+            command = records.get(code)
+            if command is None:
+                command = parse_command(code.split())
+                if command is None:
+                    continue
+                if command.opcode == Opcode.PUSH or \
+                        command.opcode == Opcode.POP:
+                    records[code] = command
+            if with_lines:
+                command = command._replace(line=self.line_counter)
+            yield command
+
+
+def parse_command(words: typing.List[str]) -> typing.Optional[Command]:
+    """Parses the words of a single command.
+
+    Args:
+        words (typing.List[str]): the command, split on whitespace.
+
+    Returns:
+        typing.Optional[Command]: the command, or None if it is not valid.
+    """
+    command = SHARED_COMMANDS.get(words[0])
+    if command is not None:
+        return command
+    opcode = OPCODES.get(words[0])
+    if opcode is None:
+        return None
+    if opcode == Opcode.LABEL or opcode == Opcode.GOTO or opcode == Opcode.IF:
+        return Command(opcode, sys.intern(words[1]))
+    return Command(opcode, sys.intern(words[1]), int(words[2]))
+
+
+def command_kind(command: Command) -> str:
+    """Names the kind of a command, for statistics.
+
+    Args:
+        command (Command): the command.
+
+    Returns:
+        str: the arithmetic command itself, "push" or "pop" followed by the
+        segment, the first word of the other VM commands, or the opcode in
+        lower case for the commands created by the passes.
+    """
+    if command.opcode == Opcode.ARITHMETIC:
+        return command.arg1
+    if command.opcode == Opcode.PUSH or command.opcode == Opcode.POP:
+        return KEYWORDS[command.opcode] + " " + command.arg1
+    return KEYWORDS.get(command.opcode, command.opcode.name.lower())
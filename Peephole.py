@@ -0,0 +1,301 @@
+"""
+This file is part of nand2tetris, as taught in The Hebrew University, and
+was written by Aviv Yaish. It is an extension to the specifications given
+[here](https://www.nand2tetris.org) (Shimon Schocken and Noam Nisan, 2017),
+as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
+Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
+"""
+import typing
+from SourceMap import MARKER
+
+
+class OriginLine(str):
+    """A line of assembly that remembers the source map marker of the
+    command it was written for, in its origin attribute."""
+
+
+class Peephole:
+    """
+    # Peephole
+
+    Sits between the CodeWriter and the output stream and rewrites the Hack
+    assembly it receives before passing it on. The CodeWriter templates are
+    concatenated blindly, so neighbouring commands often undo each other's
+    work; this pass cleans up the seams.
+
+    The input is cut into segments at labels (jump targets, where nothing is
+    known about the registers) and every segment is rewritten until no rule
+    applies:
+
+    - Level 1 only applies rewrites that are always equivalent:
+      - "@X, M=M+1, @X, M=M-1" (and the reverse) collapse to "@X".
+      - "A=M, A=A-1" becomes "A=M-1", likewise for "+1" and "+D".
+      - "D=c, A=D" becomes "AD=c", "M=c, A=M" becomes "AM=c" and
+        "M=c, D=M" becomes "MD=c".
+      - "M=D, D=M" drops the reload.
+      - "@X" is dropped when A already holds X.
+      - A "D=" whose value is overwritten before being read is dropped.
+    - Level 2 additionally assumes that stack and heap writes never alias the
+      pointer registers (RAM[0..15] and static variables), and so remembers
+      that A still holds e.g. RAM[SP]-1 across stores through A. This removes
+      the "@SP, A=M" reloads between consecutive stack operations.
+
+    Source map markers (see SourceMap) are not part of the code: every line
+    is tagged with the last marker before it, a rewritten line keeps the tag
+    of the line it replaces, and the markers are written again before the
+    optimized lines wherever the tag changes.
+    """
+
+    # Upper bound on the size of a segment without labels
+    MAX_SEGMENT = 4096
+
+    def __init__(self, output_stream: typing.TextIO, level: int = 1) -> None:
+        """Initializes the optimizer.
+
+        Args:
+            output_stream (typing.TextIO): the optimized code is written here.
+            level (int): the optimization level, 0 to 2. Level 0 passes the
+                code through unchanged.
+        """
+        self.out_file = output_stream
+        self.level = level
+        self.instructions_in = 0
+        self.instructions_out = 0
+        self.__segment = []
+        # The last marker received, and the last one written
+        self.__origin = None
+        self.__written_origin = None
+
+    def write(self, code: str) -> None:
+        """Receives a piece of assembly code from the CodeWriter.
+
+        Args:
+            code (str): assembly code, one instruction or label per line.
+        """
+        for line in code.splitlines():
+            if line.startswith(MARKER):
+                self.__origin = line
+                continue
+            line = "".join(line.split())
+            if not line:
+                continue
+            is_label = line.startswith("(")
+            if not is_label:
+                self.instructions_in += 1
+            if is_label or len(self.__segment) >= Peephole.MAX_SEGMENT:
+                self.__write_segment()
+            if self.__origin is not None:
+                line = OriginLine(line)
+                line.origin = self.__origin
+            self.__segment.append(line)
+
+    def flush(self) -> None:
+        """Optimizes and writes all pending code."""
+        self.__write_segment()
+        self.out_file.flush()
+
+    def __write_segment(self) -> None:
+        segment = self.__segment
+        self.__segment = []
+        if not segment:
+            return
+        if self.level > 0:
+            segment = self.__optimize(segment)
+        for line in segment:
+            if not line.startswith("("):
+                self.instructions_out += 1
+        if self.__origin is not None:
+            # Untagged lines were created by a rewrite and belong with the
+            # line before them
+            tagged = []
+            for line in segment:
+                origin = getattr(line, "origin", self.__written_origin)
+                if origin != self.__written_origin:
+                    tagged.append(origin)
+                    self.__written_origin = origin
+                tagged.append(line)
+            segment = tagged
+        self.out_file.write("\n".join(segment) + "\n")
+
+    def __optimize(self, lines: typing.List[str]) -> typing.List[str]:
+        changed = True
+        while changed:
+            lines, combined = self.__combine(lines)
+            lines, reloaded = self.__drop_reloads(lines)
+            lines, dead = self.__drop_dead_stores(lines)
+            changed = combined or reloaded or dead
+        return lines
+
+    def __combine(self, lines: typing.List[str]) \
+            -> typing.Tuple[typing.List[str], bool]:
+        result = []
+        changed = False
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            following = lines[i + 1] if i + 1 < len(lines) else ""
+            if line.startswith("@") and i + 3 < len(lines) and \
+                    lines[i + 2] == line and \
+                    (following, lines[i + 3]) in (("M=M+1", "M=M-1"),
+                                                  ("M=M-1", "M=M+1")):
+                result.append(line)
+                i += 4
+                changed = True
+                continue
+            if line == "A=M" and following in ("A=A-1", "A=A+1"):
+                result.append(retag("A=M" + following[3:], line))
+                i += 2
+                changed = True
+                continue
+            if line == "A=M" and following in ("A=A+D", "A=D+A"):
+                result.append(retag("A=D+M", line))
+                i += 2
+                changed = True
+                continue
+            dest, comp, jump = split_instruction(line)
+            if not jump and dest in ("D", "M"):
+                next_dest, next_comp, next_jump = split_instruction(following)
+                if not next_jump and len(next_dest) == 1 and \
+                        next_comp == dest and next_dest in "AMD" and \
+                        next_dest != dest:
+                    if dest == "M" and comp == "D" and next_dest == "D":
+                        result.append(line)
+                    else:
+                        merged = "".join(sorted(dest + next_dest,
+                                                key="AMD".index))
+                        result.append(retag(merged + "=" + comp, line))
+                    i += 2
+                    changed = True
+                    continue
+            result.append(line)
+            i += 1
+        return result, changed
+
+    def __drop_reloads(self, lines: typing.List[str]) \
+            -> typing.Tuple[typing.List[str], bool]:
+        # known is what A holds: a symbol or constant such as "SP", a pair
+        # (symbol, offset) meaning RAM[symbol] + offset (level 2 only), or
+        # None when nothing is known.
+        result = []
+        changed = False
+        known = None
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            if line.startswith("("):
+                known = None
+            elif line.startswith("@"):
+                symbol = line[1:]
+                following = lines[i + 1] if i + 1 < len(lines) else ""
+                if known == symbol:
+                    changed = True
+                    i += 1
+                    continue
+                if self.level > 1 and isinstance(known, tuple) and \
+                        known[0] == symbol and \
+                        following in ("A=M", "A=M-1", "A=M+1"):
+                    offset = {"A=M": 0, "A=M-1": -1, "A=M+1": 1}[following]
+                    if known[1] == offset:
+                        changed = True
+                        i += 2
+                        continue
+                known = symbol
+            else:
+                dest, comp, jump = split_instruction(line)
+                known = self.__track(known, dest, comp)
+            result.append(line)
+            i += 1
+        return result, changed
+
+    def __track(self, known: typing.Any, dest: str, comp: str) -> typing.Any:
+        if "M" in dest:
+            if isinstance(known, str):
+                # A store to a symbol invalidates what was loaded from it
+                if self.level > 1 and "A" in dest:
+                    return known, 0
+                if "A" in dest:
+                    return None
+            elif isinstance(known, tuple) and "A" in dest:
+                return None
+        if "A" not in dest:
+            return known
+        if self.level < 2:
+            return None
+        if isinstance(known, str) and comp in ("M", "M-1", "M+1"):
+            return known, {"M": 0, "M-1": -1, "M+1": 1}[comp]
+        if isinstance(known, tuple) and comp in ("A-1", "A+1"):
+            return known[0], known[1] + (1 if comp == "A+1" else -1)
+        return None
+
+    def __drop_dead_stores(self, lines: typing.List[str]) \
+            -> typing.Tuple[typing.List[str], bool]:
+        result = []
+        changed = False
+        # D is assumed live at the end of the segment and at every jump
+        d_live = True
+        for line in reversed(lines):
+            if line.startswith("(") or line.startswith("@"):
+                result.append(line)
+                continue
+            dest, comp, jump = split_instruction(line)
+            if jump:
+                d_live = True
+            if "D" in dest and not d_live:
+                dest = dest.replace("D", "")
+                changed = True
+                if not dest and not jump:
+                    continue
+                line = retag(join_instruction(dest, comp, jump), line)
+            if "D" in dest:
+                d_live = False
+            if "D" in comp:
+                d_live = True
+            result.append(line)
+        result.reverse()
+        return result, changed
+
+
+def retag(line: str, original: str) -> str:
+    """Gives a rewritten line the source map tag of the line it replaces.
+
+    Args:
+        line (str): the new line.
+        original (str): the replaced line, possibly an OriginLine.
+
+    Returns:
+        str: the new line, as an OriginLine if the original was one.
+    """
+    origin = getattr(original, "origin", None)
+    if origin is None:
+        return line
+    line = OriginLine(line)
+    line.origin = origin
+    return line
+
+
+def split_instruction(line: str) -> typing.Tuple[str, str, str]:
+    """Splits a C-instruction into its parts.
+
+    Args:
+        line (str): a C-instruction without whitespace, e.g. "AM=M-1".
+
+    Returns:
+        typing.Tuple[str, str, str]: the dest, comp and jump parts, where the
+        missing parts are empty strings.
+    """
+    dest, comp, jump = "", line, ""
+    if "=" in comp:
+        dest, comp = comp.split("=", 1)
+    if ";" in comp:
+        comp, jump = comp.split(";", 1)
+    return dest, comp, jump
+
+
+def join_instruction(dest: str, comp: str, jump: str) -> str:
+    """The inverse of split_instruction."""
+    line = comp
+    if dest:
+        line = dest + "=" + line
+    if jump:
+        line += ";" + jump
+    return line
@@ -0,0 +1,86 @@
+"""
+This file is part of nand2tetris, as taught in The Hebrew University, and
+was written by Aviv Yaish. It is an extension to the specifications given
+[here](https://www.nand2tetris.org) (Shimon Schocken and Noam Nisan, 2017),
+as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
+Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
+"""
+import typing
+
+
+# Starts the comment lines that carry the origin of the code after them
+MARKER = "//#"
+
+
+class SourceMap:
+    """
+    # SourceMap
+
+    Sits at the end of the output chain, after the CodeWriter or the
+    Peephole, and records where the generated code comes from.
+
+    With source_map set, the CodeWriter writes a marker line
+    "//#<line> <function>" before the code of every command whose origin
+    differs from the previous one, where line is the 1-based line of the
+    command in its .vm file (0 if unknown) and function the function being
+    translated. The Peephole carries the markers over to the code it
+    rewrites. This filter removes the markers from the output and records
+    the range of instructions that follows each of them.
+
+    Instructions are numbered from 0 at the start of the stream, so the
+    ranges of a file must be offset by the size of the files before it.
+    """
+
+    def __init__(self, output_stream: typing.TextIO) -> None:
+        """Initializes the source map.
+
+        Args:
+            output_stream (typing.TextIO): the code without the markers is
+                written here.
+        """
+        self.out_file = output_stream
+        self.instructions = 0
+        # [start, end, line, function] for every range of instructions, in
+        # order, where end is exclusive
+        self.ranges = []
+        self.__origin = None
+        self.__start = 0
+
+    def write(self, code: str) -> None:
+        """Receives a piece of assembly code.
+
+        Args:
+            code (str): assembly code, one instruction, label or marker per
+                line.
+        """
+        lines = []
+        for line in code.splitlines():
+            if line.startswith(MARKER):
+                self.__close_range()
+                line_number, function = line[len(MARKER):].split(" ", 1)
+                self.__origin = int(line_number), function
+                continue
+            lines.append(line)
+            line = line.strip()
+            if line and not line.startswith("(") and \
+                    not line.startswith("//"):
+                self.instructions += 1
+        if lines:
+            self.out_file.write("\n".join(lines) + "\n")
+
+    def flush(self) -> None:
+        """Records the last range and flushes the output stream."""
+        self.__close_range()
+        self.out_file.flush()
+
+    def __close_range(self) -> None:
+        if self.__origin is not None and self.instructions > self.__start:
+            line, function = self.__origin
+            last = self.ranges[-1] if self.ranges else None
+            if last is not None and last[1] == self.__start and \
+                    last[2] == line and last[3] == function:
+                last[1] = self.instructions
+            else:
+                self.ranges.append([self.__start, self.instructions, line,
+                                    function])
+        self.__start = self.instructions
@@ -0,0 +1,161 @@
+"""
+This file is part of nand2tetris, as taught in The Hebrew University, and
+was written by Aviv Yaish. It is an extension to the specifications given
+[here](https://www.nand2tetris.org) (Shimon Schocken and Noam Nisan, 2017),
+as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
+Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
+"""
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import typing
+
+
+class TranslationCache:
+    """
+    # TranslationCache
+
+    An on-disk cache of the assembly fragments produced for single .vm files
+    (see Main.translate_path). Every entry is keyed by a hash of:
+
+    - the content and the name of the .vm file, since static variables and
+      generated labels are named after the file (or, for whole-program
+      passes, the commands left of it),
+    - whether the fragment carries the bootstrap code,
+    - the translator options,
+    - the source code of the translator itself, so that entries written by
+      an older version are never reused.
+
+    Entries are JSON files named after their key. Reading an entry refreshes
+    its modification time, and evict() removes the least recently used
+    entries until the cache fits in its size bound.
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        """Opens the cache, creating its directory if needed.
+
+        Args:
+            directory (str): the directory holding the cache entries.
+            max_bytes (int): the total size evict() shrinks the cache to.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.__translator_digest = translator_digest()
+
+    def key(self, input_path: str, bootstrap: bool,
+            options: typing.Dict[str, typing.Any],
+            commands: typing.Optional[typing.List[typing.Any]] = None) -> str:
+        """Computes the cache key of translating a file.
+
+        Args:
+            input_path (str): path of the .vm file.
+            bootstrap (bool): whether the fragment starts with the bootstrap.
+            options (typing.Dict[str, typing.Any]): the translator options.
+            commands (typing.Optional[typing.List[typing.Any]]): if given,
+                the commands translated instead of the content of the file,
+                which are hashed instead of it.
+
+        Returns:
+            str: the key, a hexadecimal digest.
+        """
+        digest = hashlib.sha256()
+        digest.update(self.__translator_digest.encode())
+        digest.update(json.dumps(
+            [os.path.basename(input_path), bootstrap, options],
+            sort_keys=True).encode())
+        if commands is None:
+            with open(input_path, "rb") as input_file:
+                digest.update(input_file.read())
+        else:
+            digest.update(json.dumps(commands).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) \
+            -> typing.Optional[typing.Tuple[str, typing.Dict[str, int]]]:
+        """Looks up a fragment.
+
+        Args:
+            key (str): the key returned by key().
+
+        Returns:
+            typing.Optional[typing.Tuple[str, typing.Dict[str, int]]]: the
+            fragment and its report, as returned by Main.translate_path, or
+            None if the key is not cached.
+        """
+        path = self.__path(key)
+        try:
+            with open(path, "r") as entry_file:
+                entry = json.load(entry_file)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["fragment"], entry["report"]
+
+    def put(self, key: str, fragment: str,
+            report: typing.Dict[str, int]) -> None:
+        """Stores a fragment.
+
+        Args:
+            key (str): the key returned by key().
+            fragment (str): the assembly fragment.
+            report (typing.Dict[str, int]): the counters of its translation.
+        """
+        # Write to a temporary file of a unique name first, so that
+        # concurrent translators, in other processes or threads, never read
+        # a partial entry nor write to the same file.
+        descriptor, temporary_path = tempfile.mkstemp(
+            suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(descriptor, "w") as entry_file:
+                json.dump({"fragment": fragment, "report": report},
+                          entry_file)
+            os.replace(temporary_path, self.__path(key))
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the total size of
+        the cache is at most max_bytes."""
+        entries = []
+        total = 0
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+            total += status.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+
+def translator_digest() -> str:
+    """Hashes the source code of the translator.
+
+    Returns:
+        str: a hexadecimal digest of all the modules next to this one.
+    """
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(directory, "*.py"))):
+        with open(path, "rb") as source_file:
+            digest.update(source_file.read())
+    return digest.hexdigest()
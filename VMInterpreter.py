@@ -0,0 +1,327 @@
+"""
+This file is part of nand2tetris, as taught in The Hebrew University, and
+was written by Aviv Yaish. It is an extension to the specifications given
+[here](https://www.nand2tetris.org) (Shimon Schocken and Noam Nisan, 2017),
+as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
+Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
+"""
+import collections
+import os
+import typing
+from Parser import Command, Opcode
+import WholeProgram
+
+
+RAM_SIZE = 32768
+# Where the bootstrap puts the stack, and the static variables start
+STACK_BASE = 256
+STATIC_BASE = 16
+
+# The operations of the decoded program. Every VM command becomes one of
+# these, with its operands resolved to numbers.
+(PUSH_CONSTANT, PUSH_BASED, PUSH_FIXED, POP_BASED, POP_FIXED, ADD, SUB, NEG,
+ EQ, GT, LT, AND, OR, NOT, SHIFT_LEFT, SHIFT_RIGHT, GOTO, IF_GOTO, CALL,
+ FUNCTION, RETURN, HALT, NOP) = range(23)
+
+ARITHMETIC_OPERATIONS = {
+    "add": ADD, "sub": SUB, "neg": NEG, "eq": EQ, "gt": GT, "lt": LT,
+    "and": AND, "or": OR, "not": NOT, "shiftleft": SHIFT_LEFT,
+    "shiftright": SHIFT_RIGHT,
+}
+# The pointer register of the segments addressed through one
+BASE_REGISTERS = {"local": 1, "argument": 2, "this": 3, "that": 4}
+# The first address of the segments at fixed addresses
+FIXED_BASES = {"pointer": 3, "temp": 5}
+
+
+class VMInterpreter:
+    """
+    # VMInterpreter
+
+    Runs VM programs directly on the commands of the Parser, without
+    translating them to Hack, to check their behaviour and find their hot
+    spots quickly.
+
+    The machine state follows the standard mapping of the book: RAM is a
+    flat array of signed 16-bit words, with SP, LCL, ARG, THIS and THAT in
+    RAM[0..4], temp in RAM[5..12], the static variables of every file from
+    RAM[16] in order of first use, and the stack from RAM[256]. Programs that
+    define Sys.init start with the bootstrap call to it; others start at
+    their first command.
+
+    The program is decoded once when it is loaded: labels and functions are
+    resolved to command indices and every segment access to either a fixed
+    address or a pointer register and an offset, so that the main loop does
+    no lookups. Return addresses pushed by call are command indices. While
+    running, SP is kept in a local variable and written back to RAM[0] when
+    run() returns.
+
+    A program halts when it jumps to an infinite loop of the form
+    "label L, goto L", which is how compiled programs end, or when it leaves
+    its code, e.g. by returning from Sys.init.
+
+    The number of times every command ran is recorded, and profile() sums
+    them into call counts and command totals per function.
+    """
+
+    def __init__(self, program: WholeProgram.Program,
+                 file_names: typing.List[str]) -> None:
+        """Loads a program and resets the machine.
+
+        Args:
+            program (WholeProgram.Program): the commands of every file, as
+                returned by WholeProgram.load_program.
+            file_names (typing.List[str]): the name or path of every file,
+                which names its static variables.
+        """
+        commands = []
+        functions = []
+        for file_name, file_commands in zip(file_names, program):
+            file_name, _ = os.path.splitext(os.path.basename(file_name))
+            for command in file_commands:
+                if command.opcode == Opcode.FUNCTION:
+                    functions.append(command.arg1)
+                commands.append((file_name, functions[-1] if functions else
+                                 None, command))
+
+        # Labels are local to the function that defines them
+        labels = {}
+        function_indices = {}
+        for index, (_, function, command) in enumerate(commands):
+            if command.opcode == Opcode.LABEL:
+                labels[function, command.arg1] = index
+            elif command.opcode == Opcode.FUNCTION:
+                function_indices[command.arg1] = index
+
+        statics = {}
+        self.__code = [self.__decode(index, *entry, labels, function_indices,
+                                     statics)
+                       for index, entry in enumerate(commands)]
+        self.__functions = [function for _, function, _ in commands]
+        self.__counts = [0] * len(commands)
+        self.ram = [0] * RAM_SIZE
+        self.ram[0] = STACK_BASE
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+        entry_point = function_indices.get(WholeProgram.ENTRY_POINT)
+        if entry_point is not None:
+            # The bootstrap: call Sys.init with a return address past the
+            # end of the code
+            self.ram[STACK_BASE] = len(commands)
+            self.ram[0] = STACK_BASE + 5
+            self.ram[1] = STACK_BASE + 5
+            self.ram[2] = STACK_BASE
+            self.pc = entry_point
+
+    def run(self, max_steps: int) -> int:
+        """Runs the program until it halts or exhausts its step budget. A
+        stack that grows past the end of RAM raises a ValueError.
+
+        Args:
+            max_steps (int): the maximal number of commands to execute.
+
+        Returns:
+            int: the number of commands executed by this call.
+        """
+        code = self.__code
+        counts = self.__counts
+        ram = self.ram
+        end = len(code)
+        pc = self.pc
+        sp = ram[0]
+        steps = 0
+        halted = self.halted
+        try:
+            while steps < max_steps and not halted:
+                if not 0 <= pc < end:
+                    halted = True
+                    break
+                operation, x, y = code[pc]
+                counts[pc] += 1
+                steps += 1
+                pc += 1
+                if operation == PUSH_CONSTANT:
+                    ram[sp] = x
+                    sp += 1
+                elif operation == PUSH_BASED:
+                    ram[sp] = ram[ram[x] + y & 0x7FFF]
+                    sp += 1
+                elif operation == POP_BASED:
+                    sp -= 1
+                    ram[ram[x] + y & 0x7FFF] = ram[sp]
+                elif operation == PUSH_FIXED:
+                    ram[sp] = ram[x]
+                    sp += 1
+                elif operation == POP_FIXED:
+                    sp -= 1
+                    ram[x] = ram[sp]
+                elif operation == ADD:
+                    sp -= 1
+                    ram[sp - 1] = (ram[sp - 1] + ram[sp] + 0x8000 & 0xFFFF) - \
+                        0x8000
+                elif operation == SUB:
+                    sp -= 1
+                    ram[sp - 1] = (ram[sp - 1] - ram[sp] + 0x8000 & 0xFFFF) - \
+                        0x8000
+                elif operation == IF_GOTO:
+                    sp -= 1
+                    if ram[sp]:
+                        pc = x
+                elif operation == GOTO:
+                    pc = x
+                elif operation == EQ:
+                    sp -= 1
+                    ram[sp - 1] = -1 if ram[sp - 1] == ram[sp] else 0
+                elif operation == GT:
+                    sp -= 1
+                    ram[sp - 1] = -1 if ram[sp - 1] > ram[sp] else 0
+                elif operation == LT:
+                    sp -= 1
+                    ram[sp - 1] = -1 if ram[sp - 1] < ram[sp] else 0
+                elif operation == AND:
+                    sp -= 1
+                    ram[sp - 1] &= ram[sp]
+                elif operation == OR:
+                    sp -= 1
+                    ram[sp - 1] |= ram[sp]
+                elif operation == NOT:
+                    ram[sp - 1] = ~ram[sp - 1]
+                elif operation == NEG:
+                    ram[sp - 1] = (0x8000 - ram[sp - 1] & 0xFFFF) - 0x8000
+                elif operation == SHIFT_LEFT:
+                    ram[sp - 1] = (ram[sp - 1] * 2 + 0x8000 & 0xFFFF) - 0x8000
+                elif operation == SHIFT_RIGHT:
+                    ram[sp - 1] >>= 1
+                elif operation == CALL:
+                    # Slice assignments past the end would grow RAM instead
+                    # of failing
+                    if sp + 5 > RAM_SIZE:
+                        raise self.__stack_overflow(pc)
+                    ram[sp] = pc
+                    ram[sp + 1:sp + 5] = ram[1:5]
+                    sp += 5
+                    ram[2] = sp - 5 - y
+                    ram[1] = sp
+                    pc = x
+                elif operation == FUNCTION:
+                    if sp + x > RAM_SIZE:
+                        raise self.__stack_overflow(pc)
+                    ram[sp:sp + x] = [0] * x
+                    sp += x
+                elif operation == RETURN:
+                    frame = ram[1]
+                    argument = ram[2]
+                    # Without arguments, the return value overwrites the return
+                    # address
+                    pc = ram[frame - 5]
+                    ram[argument] = ram[sp - 1]
+                    sp = argument + 1
+                    ram[1:5] = ram[frame - 4:frame]
+                elif operation == HALT:
+                    halted = True
+        except IndexError:
+            raise self.__stack_overflow(pc) from None
+        finally:
+            ram[0] = sp
+            self.pc = pc
+            self.steps += steps
+            self.halted = halted
+        return steps
+
+    def ram_value(self, address: int) -> int:
+        """Reads a word of RAM.
+
+        Args:
+            address (int): the address to read.
+
+        Returns:
+            int: the value, between -32768 and 32767.
+        """
+        return self.ram[address]
+
+    def set_ram_value(self, address: int, value: int) -> None:
+        """Writes a word of RAM.
+
+        Args:
+            address (int): the address to write.
+            value (int): the value, signed or unsigned.
+        """
+        self.ram[address] = (value + 0x8000 & 0xFFFF) - 0x8000
+
+    def profile(self) -> typing.List[typing.Tuple[str, int, int]]:
+        """Summarizes where the program spent its steps so far.
+
+        Returns:
+            typing.List[typing.Tuple[str, int, int]]: (name, calls, commands)
+            for every function that ran, where calls is the number of times
+            it was entered and commands the number of its own commands that
+            were executed, not counting those of its callees. The functions
+            that executed the most commands come first. Commands outside of
+            functions are counted under the name "(top level)".
+        """
+        calls = collections.Counter()
+        totals = collections.Counter()
+        for (operation, _, _), function, count in zip(
+                self.__code, self.__functions, self.__counts):
+            if not count:
+                continue
+            name = function if function is not None else "(top level)"
+            totals[name] += count
+            if operation == FUNCTION:
+                calls[name] += count
+        return [(name, calls[name], total)
+                for name, total in totals.most_common()]
+
+    def __stack_overflow(self, pc: int) -> ValueError:
+        # pc is already past the command that overflowed
+        return ValueError("Stack overflow in " + str(self.__functions[pc - 1]))
+
+    @staticmethod
+    def __decode(index: int, file_name: str, function: typing.Optional[str],
+                 command: Command,
+                 labels: typing.Dict[typing.Tuple[typing.Optional[str], str],
+                                     int],
+                 function_indices: typing.Dict[str, int],
+                 statics: typing.Dict[typing.Tuple[str, int], int]) \
+            -> typing.Tuple[int, int, int]:
+        opcode = command.opcode
+        if opcode == Opcode.ARITHMETIC:
+            return ARITHMETIC_OPERATIONS[command.arg1], 0, 0
+        if opcode == Opcode.PUSH or opcode == Opcode.POP:
+            segment, offset = command.arg1, command.arg2
+            if segment == "constant" and opcode == Opcode.PUSH:
+                return PUSH_CONSTANT, (offset + 0x8000 & 0xFFFF) - 0x8000, 0
+            if segment in BASE_REGISTERS:
+                return (PUSH_BASED if opcode == Opcode.PUSH else POP_BASED,
+                        BASE_REGISTERS[segment], offset)
+            if segment in FIXED_BASES:
+                address = FIXED_BASES[segment] + offset
+            elif segment == "static":
+                address = statics.setdefault(
+                    (file_name, offset), STATIC_BASE + len(statics))
+            else:
+                raise ValueError("Invalid segment: " + segment)
+            return (PUSH_FIXED if opcode == Opcode.PUSH else POP_FIXED,
+                    address, 0)
+        if opcode == Opcode.LABEL:
+            return NOP, 0, 0
+        if opcode == Opcode.GOTO or opcode == Opcode.IF:
+            target = labels.get((function, command.arg1))
+            if target is None:
+                raise ValueError("Unknown label: " + command.arg1)
+            # Jumps go past the label, which does nothing
+            target += 1
+            if opcode == Opcode.GOTO and target == index:
+                return HALT, 0, 0
+            return GOTO if opcode == Opcode.GOTO else IF_GOTO, target, 0
+        if opcode == Opcode.FUNCTION:
+            return FUNCTION, command.arg2, 0
+        if opcode == Opcode.CALL:
+            target = function_indices.get(command.arg1)
+            if target is None:
+                raise ValueError("Unknown function: " + command.arg1)
+            return CALL, target, command.arg2
+        if opcode == Opcode.RETURN:
+            return RETURN, 0, 0
+        raise ValueError("Cannot interpret command: " + opcode.name)
@@ -0,0 +1,306 @@
+"""
+This file is part of nand2tetris, as taught in The Hebrew University, and
+was written by Aviv Yaish. It is an extension to the specifications given
+[here](https://www.nand2tetris.org) (Shimon Schocken and Noam Nisan, 2017),
+as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
+Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
+
+Whole-program passes. Unlike the passes of Optimizer, these need the
+commands of all the files of a program at once, so a program is loaded into
+memory as one list of Parser.Command records per file, in file order.
+"""
+import collections
+import typing
+from Parser import Command, Opcode, Parser
+
+
+# The function called by the bootstrap code
+ENTRY_POINT = "Sys.init"
+
+# The arithmetic commands that pop two values and push one
+BINARY_COMMANDS = frozenset(("add", "sub", "and", "or", "eq", "gt", "lt"))
+
+Program = typing.List[typing.List[Command]]
+
+
+def load_program(input_paths: typing.List[str],
+                 with_lines: bool = False) -> Program:
+    """Parses all the files of a program.
+
+    Args:
+        input_paths (typing.List[str]): paths of the .vm files, in order.
+        with_lines (bool): give every command its line number, see
+            Parser.commands.
+
+    Returns:
+        Program: the commands of every file.
+    """
+    program = []
+    for input_path in input_paths:
+        with open(input_path, "r") as input_file:
+            program.append(list(Parser(input_file).commands(with_lines)))
+    return program
+
+
+def split_functions(commands: typing.List[Command]) \
+        -> typing.List[typing.Tuple[typing.Optional[str],
+                                    typing.List[Command]]]:
+    """Splits the commands of a file into its functions.
+
+    Args:
+        commands (typing.List[Command]): the commands of a file.
+
+    Returns:
+        typing.List[typing.Tuple[typing.Optional[str], typing.List[Command]]]:
+        (name, commands) for every function, in order, where the commands
+        start with the function command. Commands before the first function
+        come first, with the name None.
+    """
+    functions = [(None, [])]
+    for command in commands:
+        if command.opcode == Opcode.FUNCTION:
+            functions.append((command.arg1, []))
+        functions[-1][1].append(command)
+    if not functions[0][1]:
+        del functions[0]
+    return functions
+
+
+def reachable_functions(program: Program) -> typing.Set[str]:
+    """Finds the functions reachable from the entry point, and from any code
+    outside of functions, through call commands.
+
+    Args:
+        program (Program): the commands of every file.
+
+    Returns:
+        typing.Set[str]: the names of the reachable functions.
+    """
+    callees = collections.defaultdict(set)
+    roots = [ENTRY_POINT]
+    for commands in program:
+        for name, body in split_functions(commands):
+            calls = [command.arg1 for command in body
+                     if command.opcode == Opcode.CALL]
+            if name is None:
+                roots.extend(calls)
+            else:
+                callees[name].update(calls)
+    reachable = set()
+    pending = roots
+    while pending:
+        name = pending.pop()
+        if name not in reachable:
+            reachable.add(name)
+            pending.extend(callees[name])
+    return reachable
+
+
+def eliminate_dead_functions(program: Program) \
+        -> typing.Tuple[Program, Program]:
+    """Drops the functions that can never be called. Nothing is dropped from
+    a program that does not define the entry point, as its code is not
+    started by the bootstrap.
+
+    Args:
+        program (Program): the commands of every file.
+
+    Returns:
+        typing.Tuple[Program, Program]: the commands of every file without
+        the unreachable functions, and the commands of the unreachable
+        functions of every file.
+    """
+    defined = {command.arg1 for commands in program for command in commands
+               if command.opcode == Opcode.FUNCTION}
+    if ENTRY_POINT not in defined:
+        return program, [[] for _ in program]
+    reachable = reachable_functions(program)
+    kept, eliminated = [], []
+    for commands in program:
+        kept.append([])
+        eliminated.append([])
+        for name, body in split_functions(commands):
+            if name is None or name in reachable:
+                kept[-1].extend(body)
+            else:
+                eliminated[-1].extend(body)
+    return kept, eliminated
+
+
+def function_names(program: Program) -> typing.List[str]:
+    """Lists the functions of a program.
+
+    Args:
+        program (Program): the commands of every file.
+
+    Returns:
+        typing.List[str]: the names of the functions, in order.
+    """
+    return [command.arg1 for commands in program for command in commands
+            if command.opcode == Opcode.FUNCTION]
+
+
+def stack_effect(command: Command) -> int:
+    """Computes the change to the stack pointer caused by a command, other
+    than call and return.
+
+    Args:
+        command (Command): the command.
+
+    Returns:
+        int: the number of words pushed, negative if words are popped.
+    """
+    if command.opcode == Opcode.PUSH:
+        return 1
+    if command.opcode in (Opcode.POP, Opcode.IF, Opcode.POKE):
+        return -1
+    if command.opcode == Opcode.ARITHMETIC:
+        return -1 if command.arg1 in BINARY_COMMANDS else 0
+    if command.opcode == Opcode.COMPARE_IF:
+        return -2
+    return 0
+
+
+def stack_depths(body: typing.List[Command]) \
+        -> typing.Optional[typing.List[int]]:
+    """Computes the depth of the working stack of a function before each of
+    its commands. Jack compilers only branch between points of equal depth,
+    so the depth is known statically; where it is not, or where a command is
+    unreachable, the function is rejected.
+
+    Args:
+        body (typing.List[Command]): the commands of the function, after the
+            function command.
+
+    Returns:
+        typing.Optional[typing.List[int]]: the depth before every command,
+        or None if it is not known statically.
+    """
+    label_depths = {}
+    depths = []
+    depth = 0
+    for command in body:
+        if command.opcode == Opcode.LABEL:
+            if depth is None:
+                depth = label_depths.get(command.arg1)
+            elif label_depths.setdefault(command.arg1, depth) != depth:
+                return None
+        if depth is None:
+            return None
+        depths.append(depth)
+        depth += stack_effect(command)
+        if depth < 0:
+            return None
+        if command.opcode in (Opcode.GOTO, Opcode.IF, Opcode.COMPARE_IF):
+            if label_depths.setdefault(command.arg1, depth) != depth:
+                return None
+        if command.opcode in (Opcode.GOTO, Opcode.RETURN):
+            depth = None
+    return depths
+
+
+def inline_small_functions(program: Program, threshold: int) \
+        -> typing.Tuple[Program, int]:
+    """Replaces the calls to small leaf functions by their bodies.
+
+    A function is inlined if it calls no function, has at most threshold
+    commands and a statically known stack depth (see stack_depths). Its
+    arguments and locals stay on the stack, where the call would have put
+    them, and are addressed relative to the top of the stack through the
+    "stack" pseudo-segment of the CodeWriter. Functions that set the pointer
+    segment save and restore THIS and THAT around their body, and functions
+    that use the static segment are only inlined in their own file.
+
+    Args:
+        program (Program): the commands of every file.
+        threshold (int): the maximal size of an inlined function, in VM
+            commands.
+
+    Returns:
+        typing.Tuple[Program, int]: the commands of every file, with the
+        calls inlined, and the number of inlined calls. The inlined functions
+        are left in place; eliminate_dead_functions drops the unused ones.
+    """
+    inlinable = {}
+    for index, commands in enumerate(program):
+        for name, body in split_functions(commands):
+            if name is None or name == ENTRY_POINT or \
+                    len(body) - 1 > threshold or \
+                    any(command.opcode == Opcode.CALL for command in body):
+                continue
+            depths = stack_depths(body[1:])
+            if depths is None or body[-1].opcode not in (Opcode.RETURN,
+                                                         Opcode.GOTO) or \
+                    any(command.opcode == Opcode.RETURN and depth < 1
+                        for command, depth in zip(body[1:], depths)):
+                continue
+            inlinable[name] = (index, body, depths)
+
+    inlined_program = []
+    site = 0
+    for index, commands in enumerate(program):
+        inlined_program.append([])
+        for command in commands:
+            callee = inlinable.get(command.arg1) \
+                if command.opcode == Opcode.CALL else None
+            if callee is None or callee[0] != index and any(
+                    callee_command.arg1 == "static"
+                    for callee_command in callee[1]):
+                inlined_program[-1].append(command)
+                continue
+            site += 1
+            # The inlined commands come from the line of the call
+            inlined_program[-1].extend(
+                inlined_command._replace(line=command.line)
+                for inlined_command in _inline_call(
+                    callee[1], callee[2], command.arg2, site))
+    return inlined_program, site
+
+
+def _inline_call(body: typing.List[Command], depths: typing.List[int],
+                 n_args: int, site: int) -> typing.List[Command]:
+    # The frame of an inlined function is its arguments, the saved THIS and
+    # THAT if it sets them, its locals and its working stack.
+    n_locals = body[0].arg2
+    saves_pointers = any(command.opcode == Opcode.POP and
+                         command.arg1 == "pointer" for command in body)
+    n_saved = 2 if saves_pointers else 0
+    end_label = "inline." + str(site)
+    used_end_label = False
+    inlined = []
+    if saves_pointers:
+        inlined.append(Command(Opcode.PUSH, "pointer", 0))
+        inlined.append(Command(Opcode.PUSH, "pointer", 1))
+    inlined.extend([Command(Opcode.PUSH, "constant", 0)] * n_locals)
+    for position, (command, depth) in enumerate(zip(body[1:], depths)):
+        # The number of words from the first argument to the top of the stack
+        frame_size = n_args + n_saved + n_locals + depth
+        opcode = command.opcode
+        if opcode in (Opcode.PUSH, Opcode.POP) and \
+                command.arg1 == "argument":
+            inlined.append(Command(opcode, "stack", frame_size - command.arg2))
+        elif opcode in (Opcode.PUSH, Opcode.POP) and command.arg1 == "local":
+            inlined.append(Command(
+                opcode, "stack",
+                frame_size - n_args - n_saved - command.arg2))
+        elif opcode in (Opcode.LABEL, Opcode.GOTO, Opcode.IF,
+                        Opcode.COMPARE_IF):
+            inlined.append(command._replace(
+                arg1=end_label + "." + command.arg1))
+        elif opcode == Opcode.RETURN:
+            if saves_pointers:
+                inlined.append(Command(
+                    Opcode.PUSH, "stack", frame_size - n_args))
+                inlined.append(Command(Opcode.POP, "pointer", 0))
+                inlined.append(Command(
+                    Opcode.PUSH, "stack", frame_size - n_args - 1))
+                inlined.append(Command(Opcode.POP, "pointer", 1))
+            inlined.append(Command(Opcode.INLINE_RETURN, "", frame_size))
+            if position < len(depths) - 1:
+                inlined.append(Command(Opcode.GOTO, end_label))
+                used_end_label = True
+        else:
+            inlined.append(command)
+    if used_end_label:
+        inlined.append(Command(Opcode.LABEL, end_label))
+    return inlined
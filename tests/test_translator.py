@@ -0,0 +1,1717 @@
+"""
+This file is part of nand2tetris, as taught in The Hebrew University, and
+was written by Aviv Yaish. It is an extension to the specifications given
+[here](https://www.nand2tetris.org) (Shimon Schocken and Noam Nisan, 2017),
+as allowed by the Creative Common Attribution-NonCommercial-ShareAlike 3.0
+Unported [License](https://creativecommons.org/licenses/by-nc-sa/3.0/).
+"""
+import concurrent.futures
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import typing
+import unittest
+from unittest import mock
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+from CodeWriter import count_instructions
+from CodeWriter import CodeWriter, count_instructions
+from HackAssembler import HackAssembler
+from HackEmulator import HackEmulator
+import Main
+import Optimizer
+from Parser import Opcode, Parser
+from Peephole import Peephole
+from TranslationCache import TranslationCache
+from VMInterpreter import RAM_SIZE, VMInterpreter
+
+
+# The test programs write their results from here on, through "that"
+RESULTS_BASE = 3000
+RESULTS_SIZE = 32
+MAX_CYCLES = 2000000
+MAX_STEPS = 200000
+
+# Instructions per command, see the table of the README
+SEGMENT_CODE_SIZES = [
+    ("push constant 7", 6),
+    ("push static 1", 6), ("pop static 1", 5),
+    ("push temp 3", 6), ("pop temp 3", 5),
+    ("push pointer 1", 6), ("pop pointer 0", 5),
+]
+for segment in ("local", "argument", "this", "that"):
+    SEGMENT_CODE_SIZES += [
+        ("push " + segment + " 0", 7), ("pop " + segment + " 0", 6),
+        ("push " + segment + " 1", 7), ("pop " + segment + " 1", 6),
+        ("push " + segment + " 2", 8), ("pop " + segment + " 2", 7),
+        ("push " + segment + " 3", 9), ("pop " + segment + " 3", 8),
+        ("push " + segment + " 4", 9), ("pop " + segment + " 4", 12),
+        ("push " + segment + " 9", 9), ("pop " + segment + " 9", 12),
+    ]
+
+# Instructions per push/pop pair fused by --fuse-moves. Indices up to 3 are
+# reached by incrementing A, larger source indices are added through D, and
+# larger target indices spill their address to R13.
+MOVE_CODE_SIZES = [
+    ("push constant 7", "pop static 1", 4),
+    ("push static 1", "pop pointer 1", 4),
+    ("push local 0", "pop that 0", 6),
+    ("push local 2", "pop that 0", 7),
+    ("push argument 3", "pop this 3", 10),
+    ("push local 4", "pop that 1", 8),
+    ("push local 1", "pop that 4", 12),
+    ("push local 9", "pop this 9", 14),
+    ("push static 3", "pop static 3", 0),
+    ("push local 5", "pop local 5", 0),
+]
+
+# Instructions of the prologue of a function, by number of locals: none,
+# a single push, straight-line stores up to MAX_UNROLLED_LOCALS, then a loop
+PROLOGUE_CODE_SIZES = [(0, 0), (1, 4), (2, 8), (8, 20), (9, 12)]
+
+# Snippets of assembly and their rewrites by the Peephole at level 1
+PEEPHOLE_REWRITES = [
+    ("@SP\nM=M+1\n@SP\nM=M-1\n", "@SP\n"),
+    ("@SP\nA=M\nA=A-1\nD=M\n", "@SP\nA=M-1\nD=M\n"),
+    ("@LCL\nA=M\nA=A+D\nM=D\n", "@LCL\nA=D+M\nM=D\n"),
+    ("@5\nD=A\nA=D\nM=0\n", "@5\nAD=A\nM=0\n"),
+    ("@SP\nM=D\nA=M\nM=0\n", "@SP\nAM=D\nM=0\n"),
+    ("@R13\nM=D\n@R13\nD=M\n", "@R13\nM=D\n"),
+    ("@5\nD=A\n@6\nD=A\n", "@5\n@6\nD=A\n"),
+    ("@SP\n(LOOP)\n@SP\nM=M-1\n", "@SP\n(LOOP)\n@SP\nM=M-1\n"),
+]
+
+SYS_INIT = """
+function Sys.init 0
+call Main.main 0
+pop temp 7
+label HALT
+goto HALT
+"""
+
+SEGMENTS_PROGRAM = """
+function Main.main 0
+push constant 11
+push constant 22
+push constant 33
+push constant 44
+push constant 55
+call Main.segments 5
+push constant 3000
+pop pointer 1
+pop that 10
+push constant 0
+return
+function Main.segments 6
+push constant 2000
+pop pointer 0
+push constant 3000
+pop pointer 1
+push argument 0
+pop local 0
+push argument 1
+pop local 1
+push argument 2
+pop local 2
+push argument 3
+pop local 3
+push argument 4
+pop local 5
+push local 5
+pop this 4
+push local 3
+pop this 3
+push local 2
+push local 1
+add
+pop this 1
+push this 4
+push this 3
+sub
+pop temp 0
+push temp 0
+pop static 2
+push static 2
+pop that 0
+push this 1
+pop that 1
+push local 0
+pop that 2
+push pointer 0
+pop that 3
+push local 4
+pop that 4
+push this 4
+pop that 6
+push local 5
+push constant 1
+add
+pop argument 4
+push argument 4
+pop that 7
+push local 3
+pop that 9
+push constant 7
+return
+"""
+SEGMENTS_RESULTS = [11, 55, 11, 2000, 0, 0, 55, 56, 0, 44, 7]
+
+# Every call takes 1005 words of stack, so the stack ends up crossing the
+# top of RAM within the frame of a call or in the locals of a function
+DEEP_RECURSION_PROGRAM = """
+function Main.recurse 1000
+call Main.recurse 0
+return
+"""
+
+# A loop, comparisons whose operands overflow when subtracted, wraparound
+# and recursion
+ARITHMETIC_PROGRAM = """
+function Main.main 2
+push constant 3000
+pop pointer 1
+push constant 0
+pop local 0
+push constant 10
+pop local 1
+label LOOP
+push local 1
+push constant 0
+eq
+if-goto DONE
+push local 0
+push local 1
+add
+pop local 0
+push local 1
+push constant 1
+sub
+pop local 1
+goto LOOP
+label DONE
+push local 0
+pop that 0
+push constant 32767
+push constant 1
+neg
+gt
+pop that 1
+push constant 32767
+neg
+push constant 2
+lt
+pop that 2
+push constant 5
+push constant 5
+eq
+pop that 3
+push constant 5
+push constant 5
+lt
+not
+pop that 4
+push constant 32767
+push constant 1
+add
+pop that 5
+push constant 12345
+push constant 255
+and
+push constant 4096
+or
+pop that 6
+push constant 7
+neg
+not
+pop that 7
+push constant 10
+call Main.fib 1
+pop that 8
+push constant 0
+return
+function Main.fib 0
+push argument 0
+push constant 2
+lt
+if-goto BASE
+push argument 0
+push constant 1
+sub
+call Main.fib 1
+push argument 0
+push constant 2
+sub
+call Main.fib 1
+add
+return
+label BASE
+push argument 0
+return
+"""
+ARITHMETIC_RESULTS = [55, -1, -1, -1, -1, -32768, 4153, 6, 55]
+
+# A second class with comparisons, and a static variable whose index other
+# test programs also use
+COUNTER_PROGRAM = """
+function Counter.increment 0
+push static 2
+push constant 1
+add
+pop static 2
+push static 2
+push constant 100
+gt
+if-goto WRAP
+push static 2
+return
+label WRAP
+push constant 0
+pop static 2
+push constant 0
+return
+function Counter.isZero 0
+push static 2
+push constant 0
+eq
+return
+"""
+
+# Calls to leaf functions with several returns, locals, and writes to
+# pointer, in nested calls and around a local of the caller
+LEAF_CALLS_PROGRAM = """
+function Main.main 1
+push constant 3000
+pop pointer 1
+push constant 2000
+pop pointer 0
+push constant 100
+pop local 0
+push constant 6
+push constant 7
+call Main.subtract 2
+pop that 0
+push constant 9
+push constant 4
+call Main.max 2
+push constant 3
+push constant 8
+call Main.max 2
+add
+pop that 1
+push constant 2100
+push constant 77
+call Main.setThis 2
+pop temp 0
+push pointer 0
+pop that 2
+push constant 2100
+pop pointer 0
+push this 0
+pop that 3
+push constant 4
+call Main.triple 1
+call Main.triple 1
+pop that 4
+push local 0
+pop that 5
+push constant 0
+return
+function Main.subtract 0
+push argument 0
+push argument 1
+sub
+return
+function Main.max 0
+push argument 0
+push argument 1
+gt
+if-goto FIRST
+push argument 1
+return
+label FIRST
+push argument 0
+return
+function Main.setThis 0
+push argument 0
+pop pointer 0
+push argument 1
+pop this 0
+push constant 0
+return
+function Main.triple 2
+push argument 0
+pop local 1
+push local 1
+push local 1
+add
+pop local 0
+push local 0
+push local 1
+add
+return
+"""
+LEAF_CALLS_RESULTS = [-1, 17, 2000, 77, 36, 100]
+
+# Tail calls to the same function, to functions with more and fewer
+# arguments, and between mutually recursive functions
+TAIL_CALLS_PROGRAM = """
+function Main.main 0
+push constant 3000
+pop pointer 1
+push constant 200
+push constant 0
+call Main.sum 2
+pop that 0
+push constant 7
+call Main.widen 1
+pop that 1
+push constant 40
+call Main.isEven 1
+pop that 2
+push constant 0
+return
+function Main.sum 0
+push argument 0
+push constant 0
+eq
+if-goto DONE
+push argument 0
+push constant 1
+sub
+push argument 1
+push argument 0
+add
+call Main.sum 2
+return
+label DONE
+push argument 1
+return
+function Main.widen 1
+push argument 0
+pop local 0
+push local 0
+push local 0
+push constant 1
+add
+push constant 10
+call Main.combine 3
+return
+function Main.combine 0
+push argument 0
+push argument 1
+add
+push argument 2
+sub
+call Main.negate 1
+return
+function Main.negate 0
+push argument 0
+neg
+return
+function Main.isEven 0
+push argument 0
+push constant 0
+eq
+if-goto YES
+push argument 0
+push constant 1
+sub
+call Main.isOdd 1
+return
+label YES
+push constant 1
+neg
+return
+function Main.isOdd 0
+push argument 0
+push constant 0
+eq
+if-goto NO
+push argument 0
+push constant 1
+sub
+call Main.isEven 1
+return
+label NO
+push constant 0
+return
+"""
+TAIL_CALLS_RESULTS = [20100, -5, -1]
+
+# Constant expressions that wrap around, arithmetic and comparisons with a
+# constant operand, and constant conditions
+CONSTANTS_PROGRAM = """
+function Main.main 0
+push constant 3000
+pop pointer 1
+push constant 1234
+call Main.constants 1
+pop temp 0
+push constant 0
+return
+function Main.constants 0
+push constant 32767
+push constant 2
+add
+pop that 0
+push constant 1
+neg
+push constant 32767
+sub
+pop that 1
+push constant 3
+push constant 5
+gt
+not
+neg
+pop that 2
+push argument 0
+push constant 1
+add
+push constant 1
+neg
+add
+push constant 300
+add
+pop that 3
+push argument 0
+push constant 32767
+neg
+push constant 1
+sub
+add
+pop that 4
+push argument 0
+push constant 255
+and
+push constant 0
+or
+push constant 1
+neg
+and
+pop that 5
+push argument 0
+push constant 1234
+eq
+push argument 0
+push constant 1233
+eq
+or
+pop that 6
+push argument 0
+push constant 0
+gt
+push argument 0
+push constant 0
+lt
+sub
+pop that 7
+push argument 0
+neg
+push constant 0
+lt
+pop that 8
+push constant 1
+if-goto TAKEN
+push constant 99
+pop that 9
+label TAKEN
+push constant 0
+if-goto NOT_TAKEN
+push constant 42
+pop that 10
+label NOT_TAKEN
+push argument 0
+push constant 0
+and
+push constant 1
+neg
+or
+pop that 11
+push constant 0
+return
+"""
+CONSTANTS_RESULTS = [-32767, -32768, 1, 1534, -31534, 210, -1, -1, -1, 0,
+                     42, -1]
+
+# Pops to large indices, whose address is computed while the top of the
+# stack is in D, and values live across labels, if-goto and calls
+STACK_TOP_PROGRAM = """
+function Main.main 8
+push constant 3000
+pop pointer 1
+push constant 4000
+pop pointer 0
+push constant 3
+push constant 4
+push constant 5
+add
+sub
+pop local 7
+push local 7
+pop that 0
+push constant 21
+pop this 6
+push this 6
+push local 7
+neg
+add
+pop that 12
+push constant 0
+pop local 6
+label LOOP
+push local 6
+push constant 5
+lt
+not
+if-goto END
+push local 6
+push constant 1
+add
+pop local 6
+goto LOOP
+label END
+push local 6
+pop that 1
+push constant 9
+call Main.identity 1
+push constant 1
+add
+pop that 2
+push constant 0
+return
+function Main.identity 0
+push argument 0
+return
+"""
+STACK_TOP_RESULTS = [-6, 5, 10, 0, 0, 0, 0, 0, 0, 0, 0, 0, 27]
+
+LOCALS_COUNTS = (0, 1, 2, 8, 9)
+# Functions with every kind of prologue, entered right after a function
+# that left nonzero words where their locals go. Each returns its argument
+# plus its locals, which must all be 0, and must leave the word pushed
+# before the call intact.
+LOCALS_PROGRAM = """
+function Main.main 0
+push constant 3000
+pop pointer 1
+""" + "".join("""call Main.dirty 0
+pop temp 0
+push constant 77
+push constant 5
+call Main.sum{0} 1
+add
+pop that {1}
+""".format(n_vars, index) for index, n_vars in enumerate(LOCALS_COUNTS)) + \
+    """push constant 0
+return
+function Main.dirty 12
+""" + "".join("push constant 99\npop local {}\n".format(index)
+              for index in range(12)) + \
+    """push constant 0
+return
+""" + "".join("function Main.sum{0} {0}\npush argument 0\n".format(n_vars) +
+              "".join("push local {}\nadd\n".format(index)
+                      for index in range(n_vars)) + "return\n"
+              for n_vars in LOCALS_COUNTS)
+LOCALS_RESULTS = [82] * 5
+
+# Shifts of negative numbers and into the sign bit
+SHIFTS_PROGRAM = """
+function Main.main 0
+push constant 3000
+pop pointer 1
+push constant 7
+neg
+shiftright
+pop that 0
+push constant 16384
+shiftleft
+pop that 1
+push constant 32767
+shiftleft
+pop that 2
+push constant 5
+shiftleft
+shiftleft
+shiftright
+pop that 3
+push constant 1
+neg
+shiftright
+pop that 4
+push constant 0
+return
+"""
+SHIFTS_RESULTS = [-4, -32768, -2, 10, -1]
+
+# Calls to the OS functions replaced by --intrinsics, with the constant as
+# either operand, operands that must not be replaced, and dividends of both
+# signs
+INTRINSICS_PROGRAM = """
+function Main.main 2
+push constant 3000
+pop pointer 1
+push constant 77
+pop local 0
+push constant 5
+neg
+pop local 1
+push constant 123
+push constant 0
+call Math.multiply 2
+pop that 0
+push constant 0
+push local 0
+call Math.multiply 2
+pop that 1
+push local 0
+push constant 1
+call Math.multiply 2
+pop that 2
+push constant 1
+push local 0
+call Math.multiply 2
+pop that 3
+push local 0
+push constant 8
+call Math.multiply 2
+pop that 4
+push constant 16
+push local 1
+call Math.multiply 2
+pop that 5
+push local 0
+push local 1
+add
+push constant 4
+call Math.multiply 2
+pop that 6
+push constant 4
+push local 0
+push local 1
+sub
+call Math.multiply 2
+pop that 7
+push constant 4
+call Main.seven 0
+call Math.multiply 2
+pop that 8
+push constant 7
+push constant 16384
+call Math.multiply 2
+pop that 9
+push local 0
+push constant 1
+call Math.divide 2
+pop that 10
+push constant 100
+push constant 8
+call Math.divide 2
+pop that 11
+push constant 5
+neg
+push constant 2
+call Math.divide 2
+pop that 12
+push constant 17
+neg
+push constant 4
+call Math.divide 2
+pop that 13
+push constant 16
+neg
+push constant 4
+call Math.divide 2
+pop that 14
+push constant 20
+push constant 5
+neg
+call Math.divide 2
+pop that 15
+push constant 1000
+push constant 3
+call Math.divide 2
+pop that 16
+push constant 5000
+push constant 1234
+call Memory.poke 2
+pop temp 0
+push constant 5000
+call Memory.peek 1
+pop that 17
+push constant 5001
+push constant 7
+neg
+call Memory.poke 2
+pop temp 0
+push constant 5000
+push constant 1
+add
+call Memory.peek 1
+pop that 18
+push constant 3019
+push constant 99
+call Memory.poke 2
+pop temp 0
+push local 0
+push constant 4
+push constant 1
+sub
+call Math.multiply 2
+pop that 20
+push constant 0
+return
+function Main.seven 0
+push constant 7
+return
+"""
+INTRINSICS_RESULTS = [0, 0, 77, 77, 616, -80, 288, 328, 28, -16384, 77, 12,
+                      -2, -4, -4, -4, 333, 1234, -7, 99, 231]
+
+# Math.multiply and Math.divide as in the OS, and Memory.peek and
+# Memory.poke through "that". Like the OS, divide returns 0 for -32768
+# divided by anything, since -32768 has no positive counterpart.
+MATH_PROGRAM = """
+function Math.multiply 2
+push constant 0
+pop local 0
+push constant 1
+pop local 1
+label LOOP
+push local 1
+push constant 0
+eq
+if-goto END
+push argument 1
+push local 1
+and
+push constant 0
+eq
+if-goto SKIP
+push local 0
+push argument 0
+add
+pop local 0
+label SKIP
+push argument 0
+push argument 0
+add
+pop argument 0
+push local 1
+push local 1
+add
+pop local 1
+goto LOOP
+label END
+push local 0
+return
+function Math.divide 2
+push argument 0
+push constant 0
+lt
+push argument 1
+push constant 0
+lt
+eq
+not
+pop local 0
+push argument 0
+call Math.abs 1
+push argument 1
+call Math.abs 1
+call Math.dividePositive 2
+pop local 1
+push local 0
+if-goto NEGATE
+push local 1
+return
+label NEGATE
+push local 1
+neg
+return
+function Math.abs 0
+push argument 0
+push constant 0
+lt
+if-goto NEGATIVE
+push argument 0
+return
+label NEGATIVE
+push argument 0
+neg
+return
+function Math.dividePositive 1
+push argument 1
+push argument 0
+gt
+push argument 1
+push constant 0
+lt
+or
+if-goto ZERO
+push argument 0
+push argument 1
+push argument 1
+add
+call Math.dividePositive 2
+pop local 0
+push argument 0
+push local 0
+push local 0
+add
+push argument 1
+call Math.multiply 2
+sub
+push argument 1
+lt
+if-goto EVEN
+push local 0
+push local 0
+add
+push constant 1
+add
+return
+label EVEN
+push local 0
+push local 0
+add
+return
+label ZERO
+push constant 0
+return
+"""
+MEMORY_PROGRAM = """
+function Memory.peek 0
+push argument 0
+pop pointer 1
+push that 0
+return
+function Memory.poke 0
+push argument 0
+pop pointer 1
+push argument 1
+pop that 0
+push constant 0
+return
+"""
+
+# Chains of gotos, jumps to the next label, unused labels, and code after
+# goto and return that is never executed
+JUMPS_PROGRAM = """
+function Main.main 0
+push constant 3000
+pop pointer 1
+push constant 5
+call Main.count 1
+pop that 0
+push constant 0
+call Main.choose 1
+pop that 1
+push constant 3
+call Main.choose 1
+pop that 2
+push constant 0
+return
+function Main.count 1
+push constant 0
+pop local 0
+label LOOP
+push local 0
+push constant 10
+lt
+not
+if-goto HOP1
+push local 0
+push constant 1
+add
+pop local 0
+goto HOP2
+push constant 99
+pop local 0
+label HOP2
+goto LOOP
+label HOP1
+goto HOP3
+label UNUSED
+push constant 5
+pop static 3
+label HOP3
+goto END
+label END
+label END2
+push local 0
+push argument 0
+add
+return
+push constant 7
+return
+function Main.choose 0
+push argument 0
+if-goto SECOND
+push constant 1
+goto RETURN
+label SECOND
+push constant 2
+goto RETURN
+label RETURN
+return
+label DEAD
+goto DEAD
+"""
+JUMPS_RESULTS = [15, 1, 2]
+
+# The programs run with the options of every pass, by name, with the
+# results they write
+PROGRAMS = {
+    "segments": (SEGMENTS_PROGRAM, SEGMENTS_RESULTS),
+    "arithmetic": (ARITHMETIC_PROGRAM, ARITHMETIC_RESULTS),
+    "leaf calls": (LEAF_CALLS_PROGRAM, LEAF_CALLS_RESULTS),
+    "tail calls": (TAIL_CALLS_PROGRAM, TAIL_CALLS_RESULTS),
+    "constants": (CONSTANTS_PROGRAM, CONSTANTS_RESULTS),
+    "stack top": (STACK_TOP_PROGRAM, STACK_TOP_RESULTS),
+    "locals": (LOCALS_PROGRAM, LOCALS_RESULTS),
+    "shifts": (SHIFTS_PROGRAM, SHIFTS_RESULTS),
+    "jumps": (JUMPS_PROGRAM, JUMPS_RESULTS),
+}
+
+# Arithmetic that needs no label, and commands that do
+LABELS_PROGRAM = """
+function Main.main 12
+push local 0
+push constant 1
+add
+neg
+not
+push local 1
+lt
+pop local 2
+push constant 2
+call Main.f 1
+return
+function Main.f 0
+push argument 0
+push argument 0
+or
+return
+"""
+
+
+def optimize(code: str, level: int = 1) -> str:
+    """Runs a piece of assembly through the Peephole.
+
+    Args:
+        code (str): the assembly code.
+        level (int): the optimization level.
+
+    Returns:
+        str: the optimized code.
+    """
+    output = io.StringIO()
+    peephole = Peephole(output, level)
+    peephole.write(code)
+    peephole.flush()
+    return output.getvalue()
+
+
+def write_sources(directory: str, sources: typing.Dict[str, str]) \
+        -> typing.List[str]:
+    """Writes the files of a program to a directory.
+
+    Args:
+        directory (str): the directory, which must exist.
+        sources (typing.Dict[str, str]): the VM code of every file, by file
+            name.
+
+    Returns:
+        typing.List[str]: the paths of the files, in order.
+    """
+    paths = []
+    for name, source in sources.items():
+        path = os.path.join(directory, name)
+        with open(path, "w") as source_file:
+            source_file.write(source)
+        paths.append(path)
+    return paths
+
+
+def run_main(input_path: str, *arguments: str) -> str:
+    """Runs the translator as a command.
+
+    Args:
+        input_path (str): a .vm file or a directory.
+        *arguments (str): the command line options.
+
+    Returns:
+        str: what the translator printed.
+    """
+    completed = subprocess.run(
+        [sys.executable, os.path.join(REPOSITORY, "Main.py"), input_path,
+         *arguments], stdout=subprocess.PIPE, universal_newlines=True,
+        check=True)
+    return completed.stdout
+
+
+def read_output(directory: str) -> str:
+    """Reads the .asm file translated from a directory.
+
+    Args:
+        directory (str): the directory of the program.
+
+    Returns:
+        str: the assembly code.
+    """
+    output_path = os.path.join(
+        directory, os.path.basename(directory) + ".asm")
+    with open(output_path, "r") as output_file:
+        return output_file.read()
+
+
+def translate(sources: typing.Dict[str, str],
+              options: typing.Optional[typing.Dict[str, typing.Any]] = None) \
+        -> str:
+    """Translates a program held in memory.
+
+    Args:
+        sources (typing.Dict[str, str]): the VM code of every file, by file
+            name, in translation order.
+        options (typing.Optional[typing.Dict[str, typing.Any]]): see
+            Main.translate_program.
+
+    Returns:
+        str: the assembly code.
+    """
+    return Main.translate_sources(sources, options)
+
+
+def emulate(code: str, max_cycles: int) -> HackEmulator:
+    """Assembles a program and runs it until it halts.
+
+    Args:
+        code (str): the assembly code.
+        max_cycles (int): the number of cycles to give up after.
+
+    Returns:
+        HackEmulator: the emulator, to read RAM from.
+    """
+    emulator = HackEmulator(HackAssembler().assemble(code.splitlines()))
+    emulator.run(max_cycles)
+    return emulator
+
+
+def code_size(source: str,
+              options: typing.Optional[typing.Dict[str, typing.Any]] = None) \
+        -> int:
+    """Counts the instructions generated for a piece of VM code.
+
+    Args:
+        source (str): the VM code.
+        options (typing.Optional[typing.Dict[str, typing.Any]]): see
+            Main.translate_program.
+
+    Returns:
+        int: the size of its translation, without the bootstrap code.
+    """
+    return count_instructions(translate({"Main.vm": source}, options)) - \
+        count_instructions(translate({"Main.vm": ""}, options))
+
+
+def write_files(sources: typing.Dict[str, str], **options: bool) -> str:
+    """Drives a CodeWriter over the files of a program, as Main does.
+
+    Args:
+        sources (typing.Dict[str, str]): the VM code of every file, by file
+            name.
+        **options (bool): the options of the CodeWriter.
+
+    Returns:
+        str: the assembly code.
+    """
+    output = io.StringIO()
+    code_writer = CodeWriter(output, **options)
+    for name, source in sources.items():
+        code_writer.set_file_name(name)
+        for command in Parser(io.StringIO(source)).commands():
+            code_writer.write_command(command)
+        code_writer.flush_stack_top()
+    code_writer.flush()
+    return output.getvalue()
+
+
+class PeepholeTest(unittest.TestCase):
+    """Checks the rewrites of the Peephole."""
+
+    def test_rewrites(self) -> None:
+        for code, optimized in PEEPHOLE_REWRITES:
+            with self.subTest(code=code):
+                self.assertEqual(optimize(code), optimized)
+
+    def test_stack_reloads(self) -> None:
+        code = "@SP\nAM=M-1\nD=M\n@SP\nA=M\nM=-1\n"
+        # Only level 2 knows that A still holds RAM[SP] after the load
+        self.assertEqual(optimize(code), code)
+        self.assertEqual(optimize(code, 2), "@SP\nAM=M-1\nD=M\nM=-1\n")
+
+    def test_level_0(self) -> None:
+        code = "@SP\nM=M+1\n@SP\nM=M-1\n"
+        self.assertEqual(optimize(code, 0), code)
+
+    def test_counters(self) -> None:
+        peephole = Peephole(io.StringIO())
+        peephole.write("(LOOP)\n@SP\nM=M+1\n@SP\nM=M-1\n")
+        peephole.flush()
+        self.assertEqual(peephole.instructions_in, 4)
+        self.assertEqual(peephole.instructions_out, 1)
+
+
+class ParallelTest(unittest.TestCase):
+    """Checks that translating files in parallel with --jobs does not change
+    the output."""
+
+    def test_jobs(self) -> None:
+        sources = {"Main.vm": ARITHMETIC_PROGRAM,
+                   "Counter.vm": COUNTER_PROGRAM, "Sys.vm": SYS_INIT}
+        for arguments in ([], ["--call-routines", "--compact-compare"]):
+            with self.subTest(arguments=arguments):
+                outputs = []
+                for jobs in ("1", "2"):
+                    with tempfile.TemporaryDirectory() as parent:
+                        directory = os.path.join(parent, "Prog")
+                        os.mkdir(directory)
+                        write_sources(directory, sources)
+                        run_main(directory, "--jobs", jobs, *arguments)
+                        outputs.append(read_output(directory))
+                self.assertEqual(outputs[0], outputs[1])
+
+
+class TranslationCacheTest(unittest.TestCase):
+    """Checks the on-disk cache of translated files."""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.program = os.path.join(self.directory, "Prog")
+        self.cache = os.path.join(self.directory, "cache")
+        os.mkdir(self.program)
+        write_sources(self.program, {"Main.vm": ARITHMETIC_PROGRAM,
+                                     "Counter.vm": COUNTER_PROGRAM,
+                                     "Sys.vm": SYS_INIT})
+
+    def translate(self, *arguments: str) -> typing.Tuple[str, str, str]:
+        """Translates the program with the cache.
+
+        Args:
+            *arguments (str): the command line options.
+
+        Returns:
+            typing.Tuple[str, str, str]: the assembly code, the cache
+            counters and the rest of the report that was printed.
+        """
+        lines = run_main(self.program, "--cache", self.cache,
+                         *arguments).splitlines()
+        counters = [line for line in lines if line.startswith("Cache: ")]
+        report = [line for line in lines if not line.startswith("Cache: ")]
+        self.assertEqual(len(counters), 1)
+        return read_output(self.program), counters[0], "\n".join(report)
+
+    def test_hit(self) -> None:
+        code, counters, report = self.translate("--call-routines", "-O", "1")
+        self.assertEqual(counters, "Cache: 0 hits, 3 misses")
+        self.assertTrue(report)
+        self.assertEqual(self.translate("--call-routines", "-O", "1"),
+                         (code, "Cache: 3 hits, 0 misses", report))
+        run_main(self.program, "--call-routines", "-O", "1")
+        self.assertEqual(read_output(self.program), code)
+
+    def test_miss_on_content(self) -> None:
+        self.translate()
+        with open(os.path.join(self.program, "Counter.vm"), "a") as source:
+            source.write("function Counter.reset 0\npush constant 0\n"
+                         "return\n")
+        code, counters, _ = self.translate()
+        self.assertEqual(counters, "Cache: 2 hits, 1 misses")
+        self.assertIn("(Counter.reset)", code)
+
+    def test_miss_on_options(self) -> None:
+        self.translate("--call-routines")
+        code, counters, _ = self.translate("--compact-compare")
+        self.assertEqual(counters, "Cache: 0 hits, 3 misses")
+        run_main(self.program, "--compact-compare")
+        self.assertEqual(read_output(self.program), code)
+
+    def test_miss_on_translator(self) -> None:
+        input_path = os.path.join(self.program, "Main.vm")
+        cache = TranslationCache(self.cache, 1 << 20)
+        key = cache.key(input_path, True, {})
+        cache.put(key, "@0\n", {"rom_saved": 0})
+        self.assertEqual(cache.get(key), ("@0\n", {"rom_saved": 0}))
+        with mock.patch("TranslationCache.translator_digest",
+                        return_value="0" * 64):
+            changed = TranslationCache(self.cache, 1 << 20)
+        changed_key = changed.key(input_path, True, {})
+        self.assertNotEqual(changed_key, key)
+        self.assertIsNone(changed.get(changed_key))
+
+    def test_evict(self) -> None:
+        cache = TranslationCache(self.cache, 1 << 20)
+        for time, key in enumerate(("a", "b", "c")):
+            cache.put(key, "@0\n" * 100, {"rom_saved": 0})
+            os.utime(os.path.join(self.cache, key + ".json"),
+                     (1000 + time, 1000 + time))
+        # Reading "a" makes "b" the least recently used entry
+        self.assertIsNotNone(cache.get("a"))
+        cache.max_bytes = 2 * os.path.getsize(
+            os.path.join(self.cache, "a.json"))
+        cache.evict()
+        self.assertEqual(sorted(os.listdir(self.cache)),
+                         ["a.json", "c.json"])
+
+    def test_concurrent_put(self) -> None:
+        cache = TranslationCache(self.cache, 1 << 20)
+        fragments = [str(index) * 100000 for index in range(4)]
+        cache.put("key", fragments[0], {"rom_saved": 0})
+        errors = []
+
+        def put(fragment: str) -> None:
+            try:
+                for _ in range(20):
+                    cache.put("key", fragment, {"rom_saved": 0})
+            except OSError as error:
+                errors.append(error)
+
+        def get() -> None:
+            for _ in range(100):
+                entry = cache.get("key")
+                if entry is None or entry[0] not in fragments:
+                    errors.append(entry)
+
+        threads = [threading.Thread(target=put, args=(fragment,))
+                   for fragment in fragments]
+        threads += [threading.Thread(target=get) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.cache), ["key.json"])
+
+    def test_failed_put(self) -> None:
+        cache = TranslationCache(self.cache, 1 << 20)
+        with mock.patch("json.dump", side_effect=OSError("No space left")):
+            with self.assertRaises(OSError):
+                cache.put("key", "@0\n", {"rom_saved": 0})
+        self.assertEqual(os.listdir(self.cache), [])
+
+
+class DifferentialTest(unittest.TestCase):
+    """Runs the test programs both on the VMInterpreter and translated,
+    assembled and emulated on the HackEmulator, and checks the results they
+    write."""
+
+    def assert_results(
+            self, sources: typing.Dict[str, str],
+            expected: typing.List[int],
+            options: typing.Optional[typing.Dict[str, typing.Any]] = None) \
+            -> None:
+        """Runs a program and checks RAM from RESULTS_BASE.
+
+        Args:
+            sources (typing.Dict[str, str]): the VM code of every file, by
+                file name.
+            expected (typing.List[int]): the values the program writes from
+                RESULTS_BASE on, the rest being 0.
+            options (typing.Optional[typing.Dict[str, typing.Any]]): the
+                options of the translation, see Main.translate_program.
+        """
+        expected = expected + [0] * (RESULTS_SIZE - len(expected))
+        addresses = range(RESULTS_BASE, RESULTS_BASE + RESULTS_SIZE)
+        program = [list(Parser(io.StringIO(source)).commands())
+                   for source in sources.values()]
+        interpreter = VMInterpreter(program, list(sources))
+        interpreter.run(MAX_STEPS)
+        self.assertTrue(interpreter.halted)
+        self.assertEqual(
+            [interpreter.ram_value(address) for address in addresses],
+            expected)
+
+        emulator = emulate(translate(sources, options), MAX_CYCLES)
+        self.assertTrue(emulator.halted)
+        self.assertEqual(
+            [emulator.ram_value(address) for address in addresses],
+            expected)
+
+    def assert_programs(self, options: typing.Dict[str, typing.Any]) \
+            -> None:
+        """Runs every program of PROGRAMS, see assert_results.
+
+        Args:
+            options (typing.Dict[str, typing.Any]): the options of the
+                translation.
+        """
+        for name, (program, expected) in PROGRAMS.items():
+            with self.subTest(program=name, options=options):
+                self.assert_results(
+                    {"Main.vm": program, "Sys.vm": SYS_INIT}, expected,
+                    options)
+
+    def test_translation(self) -> None:
+        self.assert_programs({})
+        self.assert_programs({"call_routines": True, "compact_compare": True})
+        self.assert_programs({"fuse_branches": True})
+
+    def test_peephole(self) -> None:
+        self.assert_programs({"optimize": 1})
+        self.assert_programs({"optimize": 2})
+        self.assert_programs({"optimize": 2, "call_routines": True,
+                              "compact_compare": True, "fuse_branches": True})
+
+    def test_inlining(self) -> None:
+        self.assert_programs({"inline_threshold": 20})
+        self.assert_programs({"inline_threshold": 20, "optimize": 2,
+                              "stack_top_in_d": True})
+        # Every leaf was inlined, and then dropped
+        code = translate({"Main.vm": LEAF_CALLS_PROGRAM, "Sys.vm": SYS_INIT},
+                         {"inline_threshold": 20})
+        self.assertNotIn("(Main.max)", code)
+        self.assertNotIn("(Main.triple)", code)
+
+    def test_tail_calls(self) -> None:
+        self.assert_programs({"tail_calls": True})
+        self.assert_programs({"tail_calls": True, "call_routines": True})
+        self.assert_programs({"tail_calls": True, "optimize": 2,
+                              "stack_top_in_d": True, "fuse_branches": True})
+
+    def test_tail_calls_stack(self) -> None:
+        # Without tail calls, 20000 frames would not fit in RAM
+        program = TAIL_CALLS_PROGRAM.replace("push constant 200\n",
+                                             "push constant 20000\n")
+        emulator = emulate(
+            translate({"Main.vm": program, "Sys.vm": SYS_INIT},
+                      {"tail_calls": True}), 10 * MAX_CYCLES)
+        self.assertTrue(emulator.halted)
+        expected = (20000 * 20001 // 2 + 0x8000 & 0xFFFF) - 0x8000
+        self.assertEqual(emulator.ram_value(RESULTS_BASE), expected)
+
+    def test_fold_constants(self) -> None:
+        self.assert_programs({"fold_constants": True})
+        self.assert_programs({"fold_constants": True, "fuse_branches": True})
+        self.assert_programs({"fold_constants": True, "optimize": 2,
+                              "stack_top_in_d": True})
+
+    def test_fuse_moves(self) -> None:
+        self.assert_programs({"fuse_moves": True})
+        self.assert_programs({"fuse_moves": True, "fold_constants": True,
+                              "fuse_branches": True})
+        # Inlined code has moves between stack-relative entries, which are
+        # left unfused
+        self.assert_programs({"fuse_moves": True, "inline_threshold": 20,
+                              "optimize": 2})
+
+    def test_stack_top_in_d(self) -> None:
+        self.assert_programs({"stack_top_in_d": True})
+        self.assert_programs({"stack_top_in_d": True, "call_routines": True,
+                              "compact_compare": True})
+        self.assert_programs({"stack_top_in_d": True, "fuse_moves": True,
+                              "intrinsics": True, "optimize": 1})
+
+    def test_intrinsics(self) -> None:
+        sources = {"Main.vm": INTRINSICS_PROGRAM, "Math.vm": MATH_PROGRAM,
+                   "Memory.vm": MEMORY_PROGRAM, "Sys.vm": SYS_INIT}
+        for options in ({}, {"intrinsics": True},
+                        {"intrinsics": True, "fold_constants": True,
+                         "optimize": 2},
+                        {"intrinsics": True, "stack_top_in_d": True,
+                         "fuse_moves": True},
+                        {"intrinsics": True, "eliminate_dead_code": True},
+                        {"intrinsics": True, "inline_threshold": 20}):
+            with self.subTest(options=options):
+                self.assert_results(sources, INTRINSICS_RESULTS, options)
+
+    def test_divide_rounding(self) -> None:
+        # Math.divide of the OS returns 0 for -32768 / 2, where the shift
+        # of --intrinsics computes the exact quotient
+        sources = {"Main.vm": """
+function Main.main 0
+push constant 3000
+pop pointer 1
+push constant 32767
+neg
+push constant 1
+sub
+push constant 2
+call Math.divide 2
+pop that 0
+push constant 0
+return
+""", "Math.vm": MATH_PROGRAM, "Sys.vm": SYS_INIT}
+        self.assert_results(sources, [0])
+        emulator = emulate(translate(sources, {"intrinsics": True}),
+                           MAX_CYCLES)
+        self.assertTrue(emulator.halted)
+        self.assertEqual(emulator.ram_value(RESULTS_BASE), -16384)
+
+    def test_thread_jumps(self) -> None:
+        self.assert_programs({"thread_jumps": True})
+        self.assert_programs({"thread_jumps": True, "fold_constants": True,
+                              "fuse_branches": True})
+        self.assert_programs({"thread_jumps": True, "optimize": 2,
+                              "stack_top_in_d": True, "tail_calls": True})
+
+
+class CodeSizeTest(unittest.TestCase):
+    """Checks the size of the code generated for single commands."""
+
+    def test_push_pop(self) -> None:
+        for command, size in SEGMENT_CODE_SIZES:
+            with self.subTest(command=command):
+                self.assertEqual(code_size(command), size)
+
+    def test_call_return(self) -> None:
+        self.assertEqual(code_size("call Main.f 2"), 44)
+        self.assertEqual(code_size("return"), 57)
+        options = {"call_routines": True}
+        self.assertEqual(code_size("call Main.f 2", options), 12)
+        self.assertEqual(code_size("return", options), 2)
+
+    def test_function_prologue(self) -> None:
+        for n_vars, size in PROLOGUE_CODE_SIZES:
+            with self.subTest(n_vars=n_vars):
+                self.assertEqual(
+                    code_size("function Main.f " + str(n_vars)), size)
+
+    def test_fold_constants(self) -> None:
+        # Folded to a single push
+        self.assertEqual(code_size("push constant 2\n"
+                                   "push constant 3\n"
+                                   "add", {"fold_constants": True}),
+                         code_size("push constant 5"))
+
+    def test_fuse_moves(self) -> None:
+        for push, pop, size in MOVE_CODE_SIZES:
+            with self.subTest(push=push, pop=pop):
+                self.assertEqual(code_size(push + "\n" + pop,
+                                           {"fuse_moves": True}), size)
+        self.assertEqual(code_size("push local 2\npop that 0"), 14)
+        # Stack-relative entries are left to push and pop
+        for push, pop in (("push stack 1", "pop local 0"),
+                          ("push local 0", "pop stack 2")):
+            with self.subTest(push=push, pop=pop):
+                self.assertEqual(
+                    code_size(push + "\n" + pop, {"fuse_moves": True}),
+                    code_size(push) + code_size(pop))
+
+
+class OptimizerTest(unittest.TestCase):
+    """Checks the command stream produced by the Optimizer passes."""
+
+    def test_fuse_moves(self) -> None:
+        commands = list(Optimizer.fuse_moves(Parser(io.StringIO(
+            "push stack 1\npop local 0\npush local 0\npop stack 2\n"
+            "push local 1\npop static 0\n")).commands()))
+        self.assertEqual([command.opcode for command in commands],
+                         [Opcode.PUSH, Opcode.POP, Opcode.PUSH, Opcode.POP,
+                          Opcode.MOVE])
+        self.assertEqual(commands[-1][1:5], ("local", 1, "static", 0))
+
+    def test_replace_intrinsics(self) -> None:
+        commands = list(Optimizer.replace_intrinsics(
+            Parser(io.StringIO(INTRINSICS_PROGRAM)).commands()))
+        calls = [command.arg1 for command in commands
+                 if command.opcode == Opcode.CALL]
+        # The multiplies whose constant is followed by more than a single
+        # push, and the divides by -5 and 3
+        self.assertEqual(calls, ["Math.multiply", "Main.seven",
+                                 "Math.multiply", "Math.divide",
+                                 "Math.divide", "Math.multiply"])
+        opcodes = [command.opcode for command in commands]
+        self.assertEqual(opcodes.count(Opcode.DIVIDE_SHIFT), 4)
+        self.assertEqual(opcodes.count(Opcode.PEEK), 2)
+        self.assertEqual(opcodes.count(Opcode.POKE), 3)
+
+    def test_thread_jumps(self) -> None:
+        counters = {}
+        commands = list(Optimizer.thread_jumps(
+            Parser(io.StringIO(JUMPS_PROGRAM)).commands(), counters))
+        # The gotos of the blocks at HOP1, HOP2 and HOP3, which are no
+        # longer reached, the second goto RETURN, which falls through, and
+        # the goto after DEAD
+        self.assertEqual(counters["jumps_removed"], 5)
+        labels = [command.arg1 for command in commands
+                  if command.opcode == Opcode.LABEL]
+        self.assertEqual(labels, ["LOOP", "END", "SECOND", "RETURN"])
+        self.assertNotIn(99, [command.arg2 for command in commands])
+        # The threaded if-goto skips HOP1 and HOP3
+        self.assertIn("END", [command.arg1 for command in commands
+                              if command.opcode == Opcode.IF])
+
+
+class TemplateCacheTest(unittest.TestCase):
+    """Checks that the template cache of the CodeWriter does not change its
+    output."""
+
+    def test_same_code(self) -> None:
+        # Both files use static 2, whose code must not be shared
+        sources = {"Main.vm": SEGMENTS_PROGRAM, "Counter.vm": COUNTER_PROGRAM,
+                   "Sys.vm": SYS_INIT}
+        for options in ({}, {"call_routines": True, "compact_compare": True},
+                        {"stack_top_in_d": True}):
+            with self.subTest(options=options):
+                code = write_files(sources, **options)
+                self.assertEqual(
+                    write_files(sources, cache_templates=False, **options),
+                    code)
+                self.assertIn("@Main.2\n", code)
+                self.assertIn("@Counter.2\n", code)
+
+
+class TranslationApiTest(unittest.TestCase):
+    """Checks the in-process translation API."""
+
+    def test_lines(self) -> None:
+        for name, (program, _) in PROGRAMS.items():
+            with self.subTest(program=name):
+                self.assertEqual(
+                    Main.translate_sources(
+                        {"Main.vm": program.splitlines(True),
+                         "Sys.vm": io.StringIO(SYS_INIT)}),
+                    Main.translate_sources(
+                        {"Main.vm": program, "Sys.vm": SYS_INIT}))
+
+    def test_command_line(self) -> None:
+        for arguments, options in (
+                ([], {}),
+                (["-O", "2", "--call-routines", "--fuse-branches"],
+                 {"optimize": 2, "call_routines": True,
+                  "fuse_branches": True})):
+            with self.subTest(arguments=arguments):
+                with tempfile.TemporaryDirectory() as directory:
+                    input_path, = write_sources(
+                        directory, {"Main.vm": ARITHMETIC_PROGRAM})
+                    run_main(input_path, *arguments)
+                    with open(os.path.join(directory, "Main.asm"), "r") \
+                            as output_file:
+                        code = output_file.read()
+                self.assertEqual(Main.translate_source(
+                    ARITHMETIC_PROGRAM, options=options), code)
+
+    def test_threads(self) -> None:
+        jobs = [({"Main.vm": program, "Sys.vm": SYS_INIT}, options)
+                for program, _ in PROGRAMS.values()
+                for options in ({}, {"optimize": 2, "fold_constants": True},
+                                {"stack_top_in_d": True,
+                                 "inline_threshold": 20})]
+        expected = [Main.translate_sources(*job) for job in jobs]
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            for _ in range(3):
+                self.assertEqual(
+                    list(executor.map(
+                        lambda job: Main.translate_sources(*job), jobs)),
+                    expected)
+
+
+class VMInterpreterTest(unittest.TestCase):
+    """Checks the behaviour of the VMInterpreter on invalid programs."""
+
+    def test_stack_overflow(self) -> None:
+        program = [list(Parser(io.StringIO(
+            DEEP_RECURSION_PROGRAM)).commands())]
+        interpreter = VMInterpreter(program, ["Main.vm"])
+        with self.assertRaisesRegex(ValueError, "Stack overflow in Main"):
+            interpreter.run(MAX_STEPS)
+        self.assertEqual(len(interpreter.ram), RAM_SIZE)
+
+
+class StatsTest(unittest.TestCase):
+    """Checks the statistics collected with the "stats" option."""
+
+    def test_labels(self) -> None:
+        program = [list(Parser(io.StringIO(source)).commands())
+                   for source in (LABELS_PROGRAM, SYS_INIT)]
+        for options in ({}, {"stack_top_in_d": True},
+                        {"compact_compare": True, "call_routines": True},
+                        {"fold_constants": True, "fuse_branches": True}):
+            with self.subTest(options=options):
+                report = Main.translate_program(
+                    ["Main.vm", "Sys.vm"], io.StringIO(),
+                    dict(options, stats=True), program=program)
+                # The bootstrap, 2 calls, 1 comparison and 1 locals loop
+                self.assertEqual(report["stats"]["labels"], 5)
+
+
+class SourceMapTest(unittest.TestCase):
+    """Checks the source map written with the "source_map" option."""
+
+    def translate(self, sources: typing.Dict[str, str],
+                  options: typing.Dict[str, typing.Any]) \
+            -> typing.Tuple[str, typing.List[typing.Dict[str, typing.Any]]]:
+        """Translates a program from disk with a source map.
+
+        Args:
+            sources (typing.Dict[str, str]): the VM code of every file, by
+                file name.
+            options (typing.Dict[str, typing.Any]): the other options.
+
+        Returns:
+            typing.Tuple[str, typing.List[typing.Dict[str, typing.Any]]]: the
+            assembly code and the source map.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            output = io.StringIO()
+            report = Main.translate_program(
+                write_sources(directory, sources), output,
+                dict(options, source_map=True))
+        return output.getvalue(), report["source_map"]
+
+    def test_ranges(self) -> None:
+        programs = [{"Main.vm": program, "Sys.vm": SYS_INIT}
+                    for program, _ in PROGRAMS.values()]
+        # The ranges of the third file start after the first two
+        programs.append({"Sys.vm": SYS_INIT, "Main.vm": TAIL_CALLS_PROGRAM,
+                         "Counter.vm": COUNTER_PROGRAM})
+        for sources in programs:
+            for options in ({}, {"optimize": 2},
+                            {"optimize": 2, "stack_top_in_d": True,
+                             "fuse_moves": True, "inline_threshold": 20},
+                            {"call_routines": True, "compact_compare": True,
+                             "fold_constants": True, "thread_jumps": True}):
+                with self.subTest(sources=list(sources), options=options):
+                    code, ranges = self.translate(sources, options)
+                    # The code does not depend on the source map
+                    self.assertEqual(code, translate(sources, options))
+                    # and the ranges tile the ROM
+                    self.assertEqual(
+                        [entry["start"] for entry in ranges],
+                        [0] + [entry["end"] for entry in ranges[:-1]])
+                    self.assertEqual(ranges[-1]["end"],
+                                     count_instructions(code))
+
+    def test_lines(self) -> None:
+        lines = SEGMENTS_PROGRAM.splitlines()
+        for options in ({}, {"optimize": 2}):
+            with self.subTest(options=options):
+                code, ranges = self.translate(
+                    {"Main.vm": SEGMENTS_PROGRAM, "Sys.vm": SYS_INIT},
+                    options)
+                instructions = [line for line in code.splitlines()
+                                if not line.startswith("(")]
+                pushes = 0
+                for entry in ranges:
+                    if entry["file"] != "Main.vm" or entry["line"] == 0:
+                        continue
+                    words = lines[entry["line"] - 1].split()
+                    if words[:2] == ["push", "constant"]:
+                        # Its code starts by loading the constant
+                        self.assertEqual(instructions[entry["start"]],
+                                         "@" + words[2])
+                        pushes += 1
+                self.assertEqual(pushes, 11)
+
+
+if __name__ == "__main__":
+    unittest.main()